@@ -1,15 +1,88 @@
 #  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
 
-from .base import Session, Base, engine
-from .answer import Answer
-from .company import Company
-from .component import Component
-from .criterion import Criterion
-from .delivery_partner import DeliveryPartner
-from .formstack_utilities import FormstackSubmissionHelper, FormstackForm, FormstackUtility
-from .formstacksubmission import FormstackSubmission
-from .measure import Measure
-from .onelineuser import OnlineUser
-from .quickstartuser import QuickstartUser
-from .quickstartanswer import QuickstartAnswer, QuickstartLikertAnswer
-from .quickstartquestion import QuickstartQuestion
\ No newline at end of file
+"""
+The names below are imported from their modules on first use, so that `import rtb_model` loads neither SQLAlchemy,
+pandas nor requests and reads no configuration. Run `python -m rtb_model.import_check` to measure the import time.
+"""
+
+import importlib
+import typing
+
+from decouple import config as _config
+
+if typing.TYPE_CHECKING:
+    from .base import Session, Base, configure, create_all, get_engine, read_only
+    from .answer import Answer
+    from .answercount import AnswerCount, AnswerCountState
+    from .company import Company
+    from .component import Component
+    from .criterion import Criterion
+    from .delivery_partner import DeliveryPartner
+    from .formstack_utilities import FormstackSubmissionHelper, FormstackForm, FormstackUtility
+    from .formstack_transport import FormstackError, FormstackHTTPError
+    from .formstacksubmission import FormstackSubmission
+    from .formstacksyncstate import FormstackSyncState
+    from .measure import Measure
+    from .onelineuser import OnlineUser
+    from .quickstartuser import QuickstartUser
+    from .quickstartanswer import QuickstartAnswer, QuickstartLikertAnswer
+    from .quickstartquestion import QuickstartQuestion
+    from .formstack_sync import FormstackSync
+    from .catalog import ReferenceCatalog, get_catalog, invalidate_catalog
+    from . import rollup, telemetry
+
+# The module each public name is imported from
+_EXPORTS = {
+    'Session': 'base', 'Base': 'base', 'configure': 'base', 'create_all': 'base', 'get_engine': 'base',
+    'read_only': 'base',
+    'Answer': 'answer',
+    'AnswerCount': 'answercount', 'AnswerCountState': 'answercount',
+    'Company': 'company',
+    'Component': 'component',
+    'Criterion': 'criterion',
+    'DeliveryPartner': 'delivery_partner',
+    'FormstackSubmissionHelper': 'formstack_utilities', 'FormstackForm': 'formstack_utilities',
+    'FormstackUtility': 'formstack_utilities',
+    'FormstackError': 'formstack_transport', 'FormstackHTTPError': 'formstack_transport',
+    'FormstackSubmission': 'formstacksubmission',
+    'FormstackSyncState': 'formstacksyncstate',
+    'Measure': 'measure',
+    'OnlineUser': 'onelineuser',
+    'QuickstartUser': 'quickstartuser',
+    'QuickstartAnswer': 'quickstartanswer', 'QuickstartLikertAnswer': 'quickstartanswer',
+    'QuickstartQuestion': 'quickstartquestion',
+    'FormstackSync': 'formstack_sync',
+    'ReferenceCatalog': 'catalog', 'get_catalog': 'catalog', 'invalidate_catalog': 'catalog',
+}
+# Submodules that used to be imported with the package, and are still available as its attributes
+_SUBMODULES = ('rollup', 'telemetry')
+
+__all__ = list(_EXPORTS) + list(_SUBMODULES)
+
+
+def __getattr__(name: str):
+    if name in _EXPORTS:
+        module = importlib.import_module(f'.{_EXPORTS[name]}', __name__)
+        if name == 'Base':
+            # So that `rtb_model.Base.metadata` (e.g. in migrations) holds every table, as it did when every model was
+            # imported with the package
+            module.load_models()
+        value = getattr(module, name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module(f'.{name}', __name__)
+    elif name == 'engine':
+        # `rtb_model.engine` is built on first access rather than at import time.
+        return importlib.import_module('.base', __name__).get_engine()
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> typing.List[str]:
+    return sorted(set(globals()) | set(__all__))
+
+
+# Telemetry is enabled by importing it, so it is still imported with the package when asked for
+if _config('RTB_TELEMETRY', default=False, cast=bool):
+    from . import telemetry
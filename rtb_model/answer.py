@@ -1,33 +1,53 @@
 #  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
 
+import functools
 from uuid import uuid4
 
-from sqlalchemy import Column, Enum, Integer, ForeignKey
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column, Enum, Index, Integer, ForeignKey, event
 from sqlalchemy.orm import relationship, backref
 
 from . import base
+from .column_types import GUID
 
 
 class Answer(base.Base):
     __tablename__ = 'answer'
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    id = Column(GUID(), primary_key=True, default=uuid4)
     response = Column(Enum('Yes', 'No', 'Unsure', 'Not applicable', name='answer_response'))
 
     # Relationship to Submission
-    formstack_submission_id = Column(Integer, ForeignKey('formstacksubmission.id'))
+    formstack_submission_id = Column(Integer, ForeignKey('formstacksubmission.id'), index=True)
     formstack_submission = relationship("FormstackSubmission", backref=backref("formstacksubmission"))
 
     # Relationship to Measure
-    measure_id = Column(UUID(as_uuid=True), ForeignKey('measure.id'))
+    measure_id = Column(GUID(), ForeignKey('measure.id'), index=True)
     measure = relationship("Measure", backref=backref("measure"))
 
     # Relationship to OnlineUser
-    online_user_id = Column(UUID(as_uuid=True), ForeignKey('onlineuser.id'))
+    online_user_id = Column(GUID(), ForeignKey('onlineuser.id'))
     online_user = relationship("OnlineUser", backref=backref("onlineuser"))
 
+    __table_args__ = (
+        # Also serves lookups by online_user_id alone, so that column has no index of its own
+        Index('ix_answer_online_user_id_measure_id', 'online_user_id', 'measure_id'),
+    )
+
     def __repr__(self):
-        return f'Response: {self.response} to measure: {self.measure} by user: {self.online_user.first_name} {self.online_user.last_name}'
+        attribute = functools.partial(base.repr_attribute, self)
+        return f'Response: {attribute("response")} to measure: {attribute("measure")} ' \
+               f'by user: {attribute("online_user.first_name")} {attribute("online_user.last_name")}'
 
     def __str__(self):
         return self.__repr__()
+
+
+def _rollup_listener(name: str):
+    def listener(*args):
+        # `rollup` (which maintains the answer counts) is imported on the first flush rather than with this module
+        from . import rollup
+        return getattr(rollup, name)(*args)
+    return listener
+
+
+event.listen(base.Session, 'before_flush', _rollup_listener('_read_answers_before_flush'))
+event.listen(base.Session, 'after_flush', _rollup_listener('_count_flushed_answers'))
@@ -0,0 +1,35 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+from sqlalchemy import Column, DateTime, ForeignKey, Integer
+
+from . import base
+from .column_types import GUID
+from .answer import Answer
+
+
+class AnswerCount(base.Base):
+    """
+    The number of answers by a company's users to the measures of a criterion with each response. Maintained by
+    `rollup`; answers without a response are not counted.
+    """
+    __tablename__: str = 'answercount'
+    company_id = Column(GUID(), ForeignKey('company.id', ondelete='CASCADE'), primary_key=True)
+    criterion_id = Column(GUID(), ForeignKey('criterion.id', ondelete='CASCADE'), primary_key=True)
+    response = Column(Answer.__table__.c.response.type, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'{self.count} answers of {self.response} to criterion {self.criterion_id} by company {self.company_id}'
+
+
+class AnswerCountState(base.Base):
+    """
+    When a company's answer counts were last rebuilt. The counts are stale if the company has been updated since.
+    """
+    __tablename__: str = 'answercountstate'
+    company_id = Column(GUID(), ForeignKey('company.id', ondelete='CASCADE'), primary_key=True)
+    # Database time (UTC) of the last rebuild, comparable with `Company.date_last_update`
+    date_rebuilt = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'Answer counts of company {self.company_id} rebuilt {self.date_rebuilt}'
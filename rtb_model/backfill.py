@@ -0,0 +1,329 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Re-ingests the historic submissions to a form across a pool of processes:
+
+    python -m rtb_model.backfill FORM_ID [--workers 4] [--shard-size 100] [--min-time ...] [--max-time ...] [--force]
+
+Fetching is bound by the Formstack rate limit, while parsing submissions and building their rows is bound by the
+CPU. The parent process therefore pages through the form's submissions on its own, with the shared (rate-limited)
+transport, and hands each page to the pool as a shard of submission ids with their data. Each worker process has its
+own database engine and Formstack transport, builds the shard's companies and users with
+`formstack_sync.ingest_submission_batch` and commits it, so throughput grows with the number of workers until the
+database or the rate limit is the bottleneck. Few shards are handed out ahead of the workers, so memory use does not
+grow with the size of the form.
+
+Submissions already ingested whose data has not changed are skipped, unless `force` is set. A submission that
+cannot be written is reported as failed; a shard that fails as a whole (e.g. the database connection was lost or its
+worker died) is retried up to `retries` times. When a worker dies it takes the pool with it, so the shards that were
+queued and had not started yet are resubmitted to a new pool without using up a retry. Progress is logged every
+`progress_interval` seconds. Unlike `FormstackSync`, a backfill does not move the form's watermark.
+"""
+
+import argparse
+import concurrent.futures
+import datetime as dt
+import itertools
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import typing
+
+from concurrent.futures.process import BrokenProcessPool
+
+from . import base, formstack_scheduler, formstack_transport
+from .formstack_sync import AnswerExtractor, ingest_submission_batch, is_unchanged
+from .formstack_utilities import FormstackForm, FormstackSubmissionHelper, form_cache, parse_formstack_time
+from .formstacksubmission import FormstackSubmission
+
+logger = logging.getLogger(__name__)
+
+
+class ShardResult:
+    def __init__(self, shard: int):
+        self.shard = shard
+        self.new = 0
+        self.updated = 0
+        self.skipped = 0
+        self.failed: typing.List[int] = list()
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return f'Shard {self.shard}: {self.new} new, {self.updated} updated, {self.skipped} skipped, ' \
+               f'{len(self.failed)} failed in {self.seconds:.1f}s'
+
+
+class BackfillResult:
+    def __init__(self, form_id: int, workers: int):
+        self.form_id = form_id
+        self.workers = workers
+        self.shards = 0
+        self.new = 0
+        self.updated = 0
+        self.skipped = 0
+        self.failed: typing.List[int] = list()
+        # Shards that still failed after every retry, with the ids of their submissions
+        self.failed_shards: typing.Dict[int, typing.List[int]] = dict()
+        self.retries = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return f'Backfill of form #{self.form_id} with {self.workers} workers: {self.new} new, {self.updated} ' \
+               f'updated, {self.skipped} skipped, {len(self.failed)} failed in {self.shards} shards ' \
+               f'({len(self.failed_shards)} failed, {self.retries} retries), ' \
+               f'{self.submissions_per_second:.1f} submissions/s'
+
+    @property
+    def submissions(self) -> int:
+        return self.new + self.updated + self.skipped + len(self.failed)
+
+    @property
+    def submissions_per_second(self) -> float:
+        return self.submissions / self.seconds if self.seconds else 0.0
+
+    def add(self, shard: ShardResult) -> None:
+        self.shards += 1
+        self.new += shard.new
+        self.updated += shard.updated
+        self.skipped += shard.skipped
+        self.failed.extend(shard.failed)
+
+
+# Set in each worker by `_init_worker`
+_worker_options: typing.Dict[str, typing.Any] = dict()
+
+
+def _init_worker(engine_settings: dict, transport_options: typing.Optional[dict], form_json: dict, form_id: int,
+                 force: bool, answers: typing.Optional[AnswerExtractor], started) -> None:
+    # Forked workers would rebuild the engine and the transport's connection pool on first use anyway; configuring
+    # them here also covers workers that are spawned, which inherit nothing
+    base.configure(**engine_settings)
+    if transport_options is not None:
+        formstack_transport.configure(**transport_options)
+    # The form definition comes from the parent, so workers do not need to fetch it
+    form_cache.put(FormstackForm(form_id, json_data=form_json))
+    _worker_options.update(form_id=form_id, force=force, answers=answers, started=started)
+
+
+def _ingest_shard(shard: int, payloads: typing.List[dict]) -> ShardResult:
+    start = time.perf_counter()
+    result = ShardResult(shard)
+    # Written straight to the pipe, so the parent knows the shard ran even if this worker dies
+    _worker_options['started'].put(shard)
+    form_id = _worker_options['form_id']
+    form = form_cache.get(form_id)
+
+    session = base.Session()
+    try:
+        ingested = {submission.id: submission for submission in session.query(FormstackSubmission)
+                    .filter(FormstackSubmission.id.in_([int(payload['id']) for payload in payloads]))}
+        helpers = list()
+        for payload in payloads:
+            submission_id = int(payload['id'])
+            timestamp = parse_formstack_time(payload['timestamp']).replace(tzinfo=None)
+            existing = ingested.get(submission_id)
+            if not _worker_options['force'] and is_unchanged(existing, payload):
+                result.skipped += 1
+                continue
+            helpers.append((FormstackSubmissionHelper(submission_id, json_data=dict(payload, form=form_id),
+                                                      form=form), timestamp))
+
+        result.failed = ingest_submission_batch(session, helpers, ingested, answers=_worker_options['answers'])
+        failed = set(result.failed)
+        written = [helper.submission_id for helper, _ in helpers if helper.submission_id not in failed]
+        result.updated = sum(1 for submission_id in written if submission_id in ingested)
+        result.new = len(written) - result.updated
+        session.commit()
+    finally:
+        session.close()
+
+    result.seconds = time.perf_counter() - start
+    logger.debug(result)
+    return result
+
+
+def _transport_options() -> typing.Optional[dict]:
+    # Only a live transport can be rebuilt in a worker from its settings; any other (e.g. a replay) is inherited by
+    # forked workers and built from the environment by spawned ones
+    transport = formstack_transport.get_transport()
+    if not isinstance(transport, formstack_transport.FormstackTransport):
+        return None
+    connect_timeout, read_timeout = transport.timeout
+    return dict(base_url=transport.base_url, access_token=transport.access_token, connect_timeout=connect_timeout,
+                read_timeout=read_timeout, max_retries=transport.max_retries, backoff_factor=transport.backoff_factor,
+                max_backoff=transport.max_backoff, pool_maxsize=1)
+
+
+class Backfill:
+    """
+    Re-ingests every submission to a form, or those made between `min_time` and `max_time`, across `workers`
+    processes. See the module documentation.
+    :param workers: processes in the pool. Defaults to the number of CPUs.
+    :param shard_size: submissions per shard, and per page fetched from Formstack (at most 100).
+    :param force: re-ingest submissions even if they were already ingested at their current version.
+    :param answers: builds the `Answer` rows of a submission, which then replace its existing answers. Must be
+        picklable (e.g. a module-level function) unless the workers are forked.
+    :param start_method: the `multiprocessing` start method of the pool. Defaults to the platform's.
+    """
+
+    def __init__(self, form_id: int, workers: int = None, shard_size: int = 100, retries: int = 2,
+                 force: bool = False, answers: AnswerExtractor = None, progress_interval: float = 10.0,
+                 start_method: str = None):
+        self.form_id = int(form_id)
+        self.workers = workers or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self.retries = retries
+        self.force = force
+        self.answers = answers
+        self.progress_interval = progress_interval
+        self.start_method = start_method
+
+    def _executor(self, form: FormstackForm, started) -> concurrent.futures.ProcessPoolExecutor:
+        engine_settings = dict(base.engine_settings(), pool_size=1, max_overflow=0)
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context(self.start_method),
+            initializer=_init_worker, initargs=(engine_settings, _transport_options(), form.json_data, self.form_id,
+                                                self.force, self.answers, started))
+
+    def run(self, min_time: dt.datetime = None, max_time: dt.datetime = None) -> BackfillResult:
+        """
+        :return: the counts of new, updated, skipped and failed submissions, and the shards that could not be
+            ingested.
+        """
+        result = BackfillResult(self.form_id, self.workers)
+        start = time.perf_counter()
+        last_progress = start
+        logger.info(f'Backfilling form {self.form_id} from {min_time or "the beginning"} to {max_time or "now"} '
+                    f'with {self.workers} workers')
+
+        with formstack_scheduler.background():
+            form = form_cache.get(self.form_id)
+            payloads = form.iter_submissions(data=True, min_time=min_time, max_time=max_time,
+                                             per_page=self.shard_size)
+            shards: typing.Dict[int, typing.List[dict]] = dict()
+            attempts: typing.Dict[int, int] = dict()
+            pending: typing.Dict[concurrent.futures.Future, typing.Tuple[int, typing.Any]] = dict()
+            # The ids of the shards that workers have started, each sent as the worker starts it
+            started_queue = multiprocessing.get_context(self.start_method).SimpleQueue()
+            started: typing.Set[int] = set()
+            # The pools in which at least one shard started, and the pool each shard was last submitted to
+            ran: typing.Set[concurrent.futures.ProcessPoolExecutor] = set()
+            placed: typing.Dict[int, concurrent.futures.ProcessPoolExecutor] = dict()
+            executor = self._executor(form, started_queue)
+
+            def submit(shard_id: int) -> None:
+                nonlocal executor
+                try:
+                    future = executor.submit(_ingest_shard, shard_id, shards[shard_id])
+                except BrokenProcessPool:
+                    # The pool broke before its failed futures were seen; they are handled once they are, and this
+                    # shard goes to a new pool
+                    executor.shutdown(wait=False)
+                    executor = self._executor(form, started_queue)
+                    future = executor.submit(_ingest_shard, shard_id, shards[shard_id])
+                pending[future] = (shard_id, executor)
+                placed[shard_id] = executor
+
+            try:
+                shard_ids = itertools.count()
+                exhausted = False
+                while not exhausted or pending:
+                    # Keep every worker busy with one shard queued behind it, without reading further ahead
+                    while not exhausted and len(pending) < self.workers * 2:
+                        shard = self._next_shard(payloads)
+                        if not shard:
+                            exhausted = True
+                            break
+                        shard_id = next(shard_ids)
+                        shards[shard_id], attempts[shard_id] = shard, 0
+                        submit(shard_id)
+                    if not pending:
+                        break
+
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    while not started_queue.empty():
+                        shard_id = started_queue.get()
+                        started.add(shard_id)
+                        ran.add(placed[shard_id])
+                    for future in done:
+                        shard_id, shard_executor = pending.pop(future)
+                        try:
+                            shard_result = future.result()
+                        except Exception as e:
+                            broken = isinstance(e, BrokenProcessPool)
+                            if broken and shard_executor is executor:
+                                # A worker died and took the pool with it; its shards are resubmitted to a new pool
+                                executor.shutdown(wait=False)
+                                executor = self._executor(form, started_queue)
+                            if broken and shard_id not in started and shard_executor in ran:
+                                # Never ran, so the failure is not the shard's own. (If no shard ran in the pool,
+                                # its workers could not start, and every shard uses up a retry.)
+                                submit(shard_id)
+                                continue
+                            started.discard(shard_id)
+                            if attempts[shard_id] >= self.retries:
+                                logger.error(f'Could not ingest shard {shard_id} of form {self.form_id}: {e}')
+                                result.failed_shards[shard_id] = [int(payload['id'])
+                                                                  for payload in shards.pop(shard_id)]
+                                del placed[shard_id]
+                                continue
+                            attempts[shard_id] += 1
+                            result.retries += 1
+                            logger.warning(f'Could not ingest shard {shard_id} of form {self.form_id} ({e}); '
+                                           f'retrying ({attempts[shard_id]} of {self.retries})')
+                            submit(shard_id)
+                            continue
+                        result.add(shard_result)
+                        started.discard(shard_id)
+                        del shards[shard_id], attempts[shard_id], placed[shard_id]
+
+                    if time.perf_counter() - last_progress >= self.progress_interval:
+                        last_progress = time.perf_counter()
+                        result.seconds = last_progress - start
+                        logger.info(f'Backfill of form {self.form_id}: {result.submissions} submissions in '
+                                    f'{result.shards} shards, {len(result.failed)} failed, '
+                                    f'{result.submissions_per_second:.1f} submissions/s')
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+        result.seconds = time.perf_counter() - start
+        logger.info(result)
+        return result
+
+    def _next_shard(self, payloads: typing.Iterator[dict]) -> typing.List[dict]:
+        shard = list()
+        for payload in payloads:
+            shard.append(payload)
+            if len(shard) >= self.shard_size:
+                break
+        return shard
+
+
+def backfill(form_id: int, min_time: dt.datetime = None, max_time: dt.datetime = None, **kwargs) -> BackfillResult:
+    """
+    Shorthand for `Backfill(form_id, **kwargs).run(min_time, max_time)`.
+    """
+    return Backfill(form_id, **kwargs).run(min_time=min_time, max_time=max_time)
+
+
+def main(argv: typing.List[str] = None) -> int:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(message)s')
+    parser = argparse.ArgumentParser(prog='python -m rtb_model.backfill', description=__doc__.split('\n\n')[0])
+    parser.add_argument('form_id', type=int)
+    parser.add_argument('--workers', type=int, default=None, help='processes to ingest with (default: CPUs)')
+    parser.add_argument('--shard-size', type=int, default=100)
+    parser.add_argument('--retries', type=int, default=2, help='times to retry a shard that fails')
+    parser.add_argument('--min-time', type=dt.datetime.fromisoformat, default=None, help='UTC, e.g. 2020-01-31')
+    parser.add_argument('--max-time', type=dt.datetime.fromisoformat, default=None, help='UTC, e.g. 2020-12-31')
+    parser.add_argument('--force', action='store_true', help='also re-ingest submissions that are up to date')
+    args = parser.parse_args(argv)
+
+    result = backfill(args.form_id, min_time=args.min_time, max_time=args.max_time, workers=args.workers,
+                      shard_size=args.shard_size, retries=args.retries, force=args.force)
+    return 1 if result.failed or result.failed_shards else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,33 +1,423 @@
 #  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
 
-from sqlalchemy import create_engine
+import contextlib
+import importlib
+import os
+import threading
+import typing
+
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-
-from decouple import config
-
-DATABASE_ENVIRONMENT = config('DATABASE_ENVIRONMENT')
-
-if DATABASE_ENVIRONMENT in ("PROD", "PRODUCTION"):
-    database_url = config('PROD_DATABASE_URL')
-    database_port = config('PROD_DATABASE_PORT')
-    database_username = config('PROD_DATABASE_USERNAME')
-    database_password = config('PROD_DATABASE_PASSWORD')
-    database_name = config('PROD_DATABASE_NAME')
-elif DATABASE_ENVIRONMENT in ("TEST", "TESTING"):
-    database_url = config('TEST_DATABASE_URL')
-    database_port = config('TEST_DATABASE_PORT')
-    database_username = config('TEST_DATABASE_USERNAME')
-    database_password = config('TEST_DATABASE_PASSWORD')
-    database_name = config('TEST_DATABASE_NAME')
-else:
-    raise ValueError('DATABASE_ENVIRONMENT environment variable must be one of the following: '
-                     f'PROD, PRODUCTION, TEST, TESTING. Current value: {DATABASE_ENVIRONMENT}')
-
-DATABASE_CONNECTION_URL = f'postgresql://{database_username}:' \
-                          f'{database_password}@' \
-                          f'{database_url}:{database_port}/{database_name}'
-
-engine = create_engine(DATABASE_CONNECTION_URL)
-Session = sessionmaker(bind=engine)
+from sqlalchemy.orm import Mapper, Session as SQLAlchemySession, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from decouple import Csv, config as env_config
+
+from .replicas import ReplicaSet
+
 Base = declarative_base()
+# Lets SQLAlchemy 2.0 map the models, some of which annotate relationships with the related class rather than Mapped[]
+Base.__allow_unmapped__ = True
+
+# Every module declaring a model. Models refer to each other by name, so all of them are imported before mappers are
+# configured, however few of them the caller imported.
+MODEL_MODULES = ('answer', 'answercount', 'company', 'component', 'criterion', 'delivery_partner',
+                 'formstacksubmission', 'formstacksyncstate', 'measure', 'onelineuser', 'quickstartanswer',
+                 'quickstartquestion', 'quickstartuser')
+
+
+def load_models() -> None:
+    """
+    Imports every model, so that `Base.metadata` holds every table. `rtb_model.Base` calls this on first access; code
+    using `base.Base.metadata` directly (e.g. to create the schema) should call it first.
+    """
+    for module in MODEL_MODULES:
+        importlib.import_module(f'.{module}', __package__)
+
+
+event.listen(Mapper, 'before_configured', load_models)
+
+# Whether model reprs may load attributes from the database. See `safe_repr`.
+_repr_state = threading.local()
+_repr_lazy_loads_default = env_config('RTB_REPR_LAZY_LOADS', default=True, cast=bool)
+UNLOADED = '<not loaded>'
+
+_engine: typing.Optional[Engine] = None
+_engine_pid: typing.Optional[int] = None
+_engine_settings: typing.Dict[str, typing.Any] = dict()
+# The read replicas of `_engine`, built with it. See `get_replicas`.
+_replicas: typing.Optional[ReplicaSet] = None
+_engine_lock = threading.RLock()
+# Engines (and replica sets) inherited from a parent process. References are kept so that their connections, which
+# still belong to the parent, are never garbage collected (and so closed) in the child.
+_inherited_engines: typing.List[typing.Union[Engine, ReplicaSet]] = list()
+# Called with every engine built by `get_engine`, e.g. to add event listeners. See `on_engine_created`.
+_engine_listeners: typing.List[typing.Callable[[Engine], None]] = list()
+
+
+def get_database_url() -> str:
+    """
+    Builds the database URL from the environment. Only called when an engine is first needed, so that importing the
+    models does not require (or read) any database configuration. A DATABASE_URL environment variable (e.g.
+    `sqlite://` or `sqlite:///local.db`) is used as is, in place of the DATABASE_ENVIRONMENT configuration.
+    :return: a SQLAlchemy database URL.
+    """
+    database_url = env_config('DATABASE_URL', default='')
+    if database_url:
+        return database_url
+
+    database_environment = env_config('DATABASE_ENVIRONMENT')
+
+    if database_environment in ("PROD", "PRODUCTION"):
+        prefix = 'PROD'
+    elif database_environment in ("TEST", "TESTING"):
+        prefix = 'TEST'
+    else:
+        raise ValueError('DATABASE_ENVIRONMENT environment variable must be one of the following: '
+                         f'PROD, PRODUCTION, TEST, TESTING. Current value: {database_environment}')
+
+    database_url = env_config(f'{prefix}_DATABASE_URL')
+    database_port = env_config(f'{prefix}_DATABASE_PORT')
+    database_username = env_config(f'{prefix}_DATABASE_USERNAME')
+    database_password = env_config(f'{prefix}_DATABASE_PASSWORD')
+    database_name = env_config(f'{prefix}_DATABASE_NAME')
+
+    return f'postgresql://{database_username}:' \
+           f'{database_password}@' \
+           f'{database_url}:{database_port}/{database_name}'
+
+
+def configure(url: str = None, pool_size: int = None, max_overflow: int = None, pool_pre_ping: bool = None,
+              pool_recycle: int = None, pool_timeout: int = None, statement_timeout: int = None,
+              replica_urls: typing.Sequence[str] = None, replica_check_interval: float = None,
+              replica_max_lag: float = None, **engine_kwargs) -> None:
+    """
+    Sets the options used to build the engine. Any existing engine is disposed of and rebuilt on next use.
+
+    Options not given here fall back to the DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_PRE_PING,
+    DATABASE_POOL_RECYCLE, DATABASE_POOL_TIMEOUT, DATABASE_STATEMENT_TIMEOUT, DATABASE_REPLICA_URLS (separated by
+    commas), DATABASE_REPLICA_CHECK_INTERVAL and DATABASE_REPLICA_MAX_LAG environment variables.
+    :param url: database URL. Defaults to the URL built from the DATABASE_ENVIRONMENT configuration. A `sqlite://`
+        URL (in memory) or `sqlite:///path` URL (a file) builds the schema-compatible SQLite engine used by tests and
+        local runs; the pool and timeout options do not apply to it.
+    :param pool_size: number of connections kept open in the pool.
+    :param max_overflow: number of connections allowed beyond `pool_size` under load.
+    :param pool_pre_ping: test connections for liveness when they are checked out of the pool.
+    :param pool_recycle: seconds after which a pooled connection is replaced. -1 disables recycling.
+    :param pool_timeout: seconds to wait for a connection from a full pool.
+    :param statement_timeout: server-side statement timeout in milliseconds. 0 disables the timeout.
+    :param replica_urls: URLs of read replicas of the database. Replica engines are built with the same options.
+        See `RoutingSession` for which queries are sent to them.
+    :param replica_check_interval: seconds between health checks of each replica.
+    :param replica_max_lag: most seconds a replica may be behind the primary. 0 disables the check.
+    :param engine_kwargs: any further keyword arguments are passed to `sqlalchemy.create_engine`.
+    """
+    global _engine_settings
+    settings = dict(url=url, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=pool_pre_ping,
+                    pool_recycle=pool_recycle, pool_timeout=pool_timeout, statement_timeout=statement_timeout,
+                    replica_urls=replica_urls, replica_check_interval=replica_check_interval,
+                    replica_max_lag=replica_max_lag)
+    settings = {key: value for key, value in settings.items() if value is not None}
+    settings.update(engine_kwargs)
+
+    with _engine_lock:
+        dispose()
+        _engine_settings = settings
+
+
+def engine_settings() -> typing.Dict[str, typing.Any]:
+    """
+    :return: a copy of the options set by the last `configure` call, e.g. to configure the engine of another process
+        the same way.
+    """
+    with _engine_lock:
+        return dict(_engine_settings)
+
+
+def _enable_foreign_keys(dbapi_connection, connection_record) -> None:
+    # SQLite only enforces foreign keys (and so ON DELETE CASCADE) when asked to, per connection
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+def _build_sqlite_engine(url, settings: typing.Dict[str, typing.Any]) -> Engine:
+    for option in ('statement_timeout', 'pool_size', 'max_overflow', 'pool_pre_ping', 'pool_recycle', 'pool_timeout'):
+        settings.pop(option, None)
+    connect_args = settings.setdefault('connect_args', dict())
+    # Sessions are used from worker threads (e.g. by the webhook receiver)
+    connect_args.setdefault('check_same_thread', False)
+    if url.database in (None, '', ':memory:') or url.query.get('mode') == 'memory':
+        # Every connection to an in-memory database would otherwise get a new, empty database
+        settings.setdefault('poolclass', StaticPool)
+
+    engine = create_engine(url, **settings)
+    event.listen(engine, 'connect', _enable_foreign_keys)
+    return engine
+
+
+def _build_engine(url: str = None) -> Engine:
+    settings = dict(_engine_settings)
+    for option in ('replica_urls', 'replica_check_interval', 'replica_max_lag'):
+        settings.pop(option, None)
+    url = make_url(url or settings.pop('url', None) or get_database_url())
+    settings.pop('url', None)
+    if url.get_backend_name() == 'sqlite':
+        return _build_sqlite_engine(url, settings)
+
+    statement_timeout = settings.pop('statement_timeout',
+                                     env_config('DATABASE_STATEMENT_TIMEOUT', default=0, cast=int))
+
+    options = dict(pool_size=env_config('DATABASE_POOL_SIZE', default=5, cast=int),
+                   max_overflow=env_config('DATABASE_MAX_OVERFLOW', default=10, cast=int),
+                   pool_pre_ping=env_config('DATABASE_POOL_PRE_PING', default=True, cast=bool),
+                   pool_recycle=env_config('DATABASE_POOL_RECYCLE', default=1800, cast=int),
+                   pool_timeout=env_config('DATABASE_POOL_TIMEOUT', default=30, cast=int))
+    options.update(settings)
+
+    if statement_timeout:
+        connect_args = options.setdefault('connect_args', dict())
+        connect_args['options'] = f"{connect_args.get('options', '')} -c statement_timeout={statement_timeout}".strip()
+
+    return create_engine(url, **options)
+
+
+def _build_replicas() -> ReplicaSet:
+    urls = _engine_settings.get('replica_urls')
+    if urls is None:
+        urls = env_config('DATABASE_REPLICA_URLS', default='', cast=Csv())
+    check_interval = _engine_settings.get('replica_check_interval',
+                                          env_config('DATABASE_REPLICA_CHECK_INTERVAL', default=30.0, cast=float))
+    max_lag = _engine_settings.get('replica_max_lag', env_config('DATABASE_REPLICA_MAX_LAG', default=0.0, cast=float))
+    return ReplicaSet([_build_engine(url) for url in urls], check_interval=check_interval, max_lag=max_lag)
+
+
+def create_all() -> None:
+    """
+    Creates every table that does not exist yet, e.g. to set up an empty SQLite database for tests. Databases that
+    are kept should be migrated instead.
+    """
+    load_models()
+    Base.metadata.create_all(get_engine())
+
+
+def get_engine() -> Engine:
+    """
+    Returns the engine for this process, building it (and its replicas) on first use. A process forked after the
+    engine was built gets its own engine rather than sharing the parent's pooled connections.
+    :return: the engine for this process.
+    """
+    global _engine, _engine_pid, _replicas
+    with _engine_lock:
+        if _engine is None or _engine_pid != os.getpid():
+            if _engine is not None:
+                _inherited_engines.extend((_engine, _replicas))
+            _engine = _build_engine()
+            _replicas = _build_replicas()
+            _engine_pid = os.getpid()
+            for engine in [_engine] + [replica.engine for replica in _replicas.replicas]:
+                for listener in _engine_listeners:
+                    listener(engine)
+        return _engine
+
+
+def get_replicas() -> ReplicaSet:
+    """
+    :return: the read replicas of this process's engine. The set is empty if no replica URLs are configured.
+    """
+    with _engine_lock:
+        get_engine()
+        return _replicas
+
+
+def on_engine_created(listener: typing.Callable[[Engine], None]) -> None:
+    """
+    Calls `listener` with the engine and each replica engine now, if they have been built in this process, and with
+    every engine built from now on (after `configure`, or in a forked process).
+    """
+    with _engine_lock:
+        if listener in _engine_listeners:
+            return
+        _engine_listeners.append(listener)
+        if _engine is not None and _engine_pid == os.getpid():
+            for engine in [_engine] + [replica.engine for replica in _replicas.replicas]:
+                listener(engine)
+
+
+def dispose() -> None:
+    """
+    Closes all pooled connections and discards the engine and its replicas. The next call to `get_engine` builds new
+    ones.
+    """
+    global _engine, _engine_pid, _replicas
+    with _engine_lock:
+        if _engine is not None and _engine_pid == os.getpid():
+            _engine.dispose()
+            _replicas.dispose()
+        _engine = None
+        _engine_pid = None
+        _replicas = None
+
+
+def _reset_after_fork() -> None:
+    # The child must never use (or close) the connections it inherited from the parent, so the engine is set aside
+    # without being disposed of. A new lock is also needed in case the fork happened while it was held.
+    global _engine, _engine_pid, _engine_lock, _replicas
+    _engine_lock = threading.RLock()
+    if _engine is not None:
+        _inherited_engines.extend((_engine, _replicas))
+    _engine = None
+    _engine_pid = None
+    _replicas = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+@contextlib.contextmanager
+def safe_repr(enabled: bool = True) -> typing.Iterator[None]:
+    """
+    Within this block (on this thread), model reprs only show attributes that are already loaded, and show `UNLOADED`
+    in place of the rest, so that logging an object never queries the database or fails on a detached object. Set the
+    RTB_REPR_LAZY_LOADS environment variable to False to make this the default.
+    :param enabled: False to allow lazy loads again within an enclosing `safe_repr` block.
+    """
+    previous = getattr(_repr_state, 'lazy_loads', None)
+    _repr_state.lazy_loads = not enabled
+    try:
+        yield
+    finally:
+        _repr_state.lazy_loads = previous
+
+
+def repr_attribute(obj, path: str) -> typing.Any:
+    """
+    Follows a dotted attribute path (e.g. 'criterion.component.number') from `obj` for use in a repr. Outside of
+    `safe_repr` this is plain attribute access. Within it, `UNLOADED` is returned rather than loading any attribute.
+    """
+    lazy_loads = getattr(_repr_state, 'lazy_loads', None)
+    if lazy_loads is None:
+        lazy_loads = _repr_lazy_loads_default
+
+    for name in path.split('.'):
+        if obj is None:
+            return None
+        if not lazy_loads:
+            state = inspect(obj, raiseerr=False)
+            # Transient and pending objects have nothing to load, so their attributes are always safe to read
+            if state is not None and state.has_identity and name in state.unloaded:
+                return UNLOADED
+        obj = getattr(obj, name)
+    return obj
+
+
+class RoutingSession(SQLAlchemySession):
+    """
+    A session that sends reads to the read replicas (see `configure`), while it is read-only, and everything else to
+    the primary.
+
+    A session is read-only if it was created with `read_only=True` (see `read_only`) or within its `read_only()`
+    block. Its SELECTs then go to a healthy replica, chosen in turn for each transaction, and to the primary if there
+    is none. Flushes, INSERTs, UPDATEs, DELETEs, SELECT ... FOR UPDATE and textual SQL always go to the primary.
+
+    Replicas lag behind the primary, so once a session has written it reads from the primary until it is closed,
+    to see its own writes. Reads within its `primary()` block also go to the primary, e.g. to see what another
+    session has just written. Sessions that are not read-only (the default) only use the primary.
+    """
+
+    def __init__(self, *args, read_only: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._read_only = int(read_only)
+        self._primary = 0
+        # Whether the session has written since it was last closed
+        self.wrote = False
+        self._replica: typing.Optional[Engine] = None
+
+    @contextlib.contextmanager
+    def read_only(self) -> typing.Iterator['RoutingSession']:
+        """
+        Sends the reads made within this block to a replica, unless the session has written.
+        """
+        self._read_only += 1
+        try:
+            yield self
+        finally:
+            self._read_only -= 1
+
+    @contextlib.contextmanager
+    def primary(self) -> typing.Iterator['RoutingSession']:
+        """
+        Sends the reads made within this block to the primary, even if the session is read-only.
+        """
+        self._primary += 1
+        try:
+            yield self
+        finally:
+            self._primary -= 1
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        bind = super().get_bind(mapper=mapper, clause=clause, **kw)
+        # Sessions bound to anything other than this process's engine (e.g. a connection in tests) are not routed
+        if bind is not _engine or _engine_pid != os.getpid():
+            return bind
+
+        if self._flushing or getattr(clause, 'is_dml', False) or getattr(clause, '_for_update_arg', None) is not None:
+            self.wrote = True
+            return bind
+        if not getattr(clause, 'is_select', False) or not self._read_only or self._primary or self.wrote:
+            return bind
+
+        if self._replica is None:
+            self._replica = _replicas.choose() if _replicas else None
+            if self._replica is None:
+                return bind
+        return self._replica
+
+    def close(self) -> None:
+        super().close()
+        self.wrote = False
+
+
+def _forget_replica(session: RoutingSession, transaction) -> None:
+    # The next transaction may read from a different replica
+    if transaction.parent is None:
+        session._replica = None
+
+
+event.listen(RoutingSession, 'after_transaction_end', _forget_replica)
+
+
+class _LazySessionmaker(sessionmaker):
+    """
+    A sessionmaker that binds each new session to `get_engine()` at creation time, unless a bind is given explicitly.
+    """
+
+    def __call__(self, **local_kw):
+        if local_kw.get('bind') is None and self.kw.get('bind') is None:
+            local_kw['bind'] = get_engine()
+        return super().__call__(**local_kw)
+
+
+Session = _LazySessionmaker(class_=RoutingSession)
+
+
+@contextlib.contextmanager
+def read_only() -> typing.Iterator[RoutingSession]:
+    """
+    A new read-only session for dashboards, reports and exports, whose reads go to the read replicas. See
+    `RoutingSession`. The session is closed (and anything it did not commit rolled back) at the end of the block.
+    """
+    session = Session(read_only=True)
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def __getattr__(name: str):
+    # `engine` used to be built at import time; it is still available as a module attribute for existing callers.
+    if name == 'engine':
+        return get_engine()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
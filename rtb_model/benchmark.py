@@ -0,0 +1,243 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Benchmarks the ingest path offline, against Formstack traffic recorded with `formstack_replay`:
+
+    python -m rtb_model.benchmark CASSETTE_DIR FORM_ID [--latency 0.05] [--write] [--output results.json]
+                                  [--baseline baseline.json] [--tolerance 0.2]
+
+Each stage runs over every submission in turn:
+
+- fetch: the form and its pages of submissions, served from the cassette with the simulated latency,
+- parse: a `FormstackSubmissionHelper` and its record for each submission,
+- extract: `Company.from_formstack` and `OnlineUser.from_formstack` for each submission,
+- extract_batch: `Company.rows_from_formstack` and `OnlineUser.rows_from_formstack` over all the submissions, and
+- write: the upserts of each company and its users (only with --write). These are rolled back, so the database is
+  left as it was, but need the schema and a database configured as usual.
+
+Submissions/s counts fetch, parse, extract and write, the path `FormstackSync` takes. Stage times are the best of
+`repeat` runs. Allocations are measured in a separate run under `tracemalloc`, as tracing slows down what it
+measures: `allocated` is the memory a stage still held when it finished and `peak` the most it held at once.
+
+With --baseline, the run fails (exit status 1) if a stage is more than `tolerance` slower per submission than in the
+baseline, so regressions show up before release. Recordings need to be made with the same `per_page` as the
+benchmark.
+"""
+
+import argparse
+import collections
+import contextlib
+import itertools
+import json
+import logging
+import sys
+import time
+import tracemalloc
+import typing
+
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from . import base
+from .company import Company
+from .formstack_replay import replaying
+from .formstack_sync import write_submission
+from .formstack_utilities import FormstackForm, FormstackSubmissionHelper
+from .onelineuser import OnlineUser
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('fetch', 'parse', 'extract', 'extract_batch', 'write')
+# The stages `FormstackSync` runs, which make up the submissions/s figure
+INGEST_STAGES = ('fetch', 'parse', 'extract', 'write')
+
+
+class StageResult:
+    def __init__(self, name: str, seconds: float, submissions: int, allocated: int = None, peak: int = None):
+        self.name = name
+        self.seconds = seconds
+        self.submissions = submissions
+        self.allocated = allocated
+        self.peak = peak
+
+    def __repr__(self):
+        memory = f', {self.allocated / 1024:.0f} KiB allocated, {self.peak / 1024:.0f} KiB peak' \
+            if self.peak is not None else ''
+        return f'{self.name}: {self.seconds * 1000:.1f} ms, {self.per_submission * 1e6:.0f} µs/submission{memory}'
+
+    @property
+    def per_submission(self) -> float:
+        return self.seconds / self.submissions if self.submissions else 0.0
+
+    def to_dict(self) -> dict:
+        return dict(seconds=self.seconds, submissions=self.submissions, allocated=self.allocated, peak=self.peak)
+
+
+class BenchmarkResult:
+    def __init__(self, submissions: int, stages: typing.Dict[str, StageResult]):
+        self.submissions = submissions
+        self.stages = stages
+
+    def __repr__(self):
+        return '\n'.join([f'{self.submissions} submissions, {self.submissions_per_second:.1f} submissions/s'] +
+                         [repr(stage) for stage in self.stages.values()])
+
+    @property
+    def submissions_per_second(self) -> float:
+        seconds = sum(stage.seconds for name, stage in self.stages.items() if name in INGEST_STAGES)
+        return self.submissions / seconds if seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return dict(submissions=self.submissions, submissions_per_second=self.submissions_per_second,
+                    stages={name: stage.to_dict() for name, stage in self.stages.items()})
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'BenchmarkResult':
+        return cls(data['submissions'], {name: StageResult(name, **stage) for name, stage in data['stages'].items()})
+
+    def regressions(self, baseline: 'BenchmarkResult', tolerance: float = 0.2) -> typing.List[str]:
+        """
+        :return: a description of each stage that is more than `tolerance` (a fraction) slower per submission than in
+            `baseline`.
+        """
+        regressions = list()
+        for name, stage in self.stages.items():
+            before = baseline.stages.get(name)
+            if before is not None and before.per_submission and \
+                    stage.per_submission > before.per_submission * (1 + tolerance):
+                regressions.append(f'{name} took {stage.per_submission * 1e6:.0f} µs/submission, up from '
+                                   f'{before.per_submission * 1e6:.0f} µs')
+        return regressions
+
+
+class _StageRecorder:
+    def __init__(self, trace: bool):
+        self.trace = trace
+        self.seconds: typing.Dict[str, float] = collections.OrderedDict()
+        self.allocated: typing.Dict[str, int] = dict()
+        self.peak: typing.Dict[str, int] = dict()
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> typing.Iterator[None]:
+        if self.trace:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = time.perf_counter() - start
+            if self.trace:
+                current, peak = tracemalloc.get_traced_memory()
+                self.allocated[name] = current - start_memory
+                self.peak[name] = peak - start_memory
+
+
+def _run_stages(form_id: int, limit: typing.Optional[int], per_page: int, session: typing.Optional[SQLAlchemySession],
+                recorder: _StageRecorder) -> int:
+    with recorder.stage('fetch'):
+        # Not from `form_cache`, so that every run fetches the form
+        form = FormstackForm(form_id)
+        payloads = list(itertools.islice(form.iter_submissions(data=True, per_page=per_page), limit))
+
+    with recorder.stage('parse'):
+        helpers = [FormstackSubmissionHelper(int(payload['id']), json_data=dict(payload, form=form_id), form=form)
+                   for payload in payloads]
+        for helper in helpers:
+            helper.get_record()
+
+    with recorder.stage('extract'):
+        extracted = [(Company.from_formstack(helper), OnlineUser.from_formstack(helper)) for helper in helpers]
+
+    with recorder.stage('extract_batch'):
+        if helpers:
+            Company.rows_from_formstack(helpers)
+            OnlineUser.rows_from_formstack(helpers)
+
+    if session is not None:
+        savepoint = session.begin_nested()
+        try:
+            with recorder.stage('write'):
+                for company, users in extracted:
+                    write_submission(session, company, users)
+                session.flush()
+        finally:
+            savepoint.rollback()
+    return len(payloads)
+
+
+def run_benchmark(cassette_dir: str, form_id: int, latency: float = 0.0, limit: int = None, per_page: int = 100,
+                  session: SQLAlchemySession = None, repeat: int = 3, trace_allocations: bool = True) -> BenchmarkResult:
+    """
+    Benchmarks each stage of ingesting the submissions to a form, from a cassette. See the module documentation.
+    :param latency: simulated latency of each Formstack request, in seconds.
+    :param limit: only ingest this many submissions.
+    :param session: benchmark the database writes in this session. They are rolled back.
+    :param repeat: time each stage this many times and keep the best.
+    :param trace_allocations: also measure each stage's allocations, in one more run.
+    """
+    form_id = int(form_id)
+    seconds = collections.defaultdict(list)
+    allocated, peak = dict(), dict()
+    submissions = 0
+    with replaying(cassette_dir, latency=latency):
+        for _ in range(max(repeat, 1)):
+            recorder = _StageRecorder(trace=False)
+            submissions = _run_stages(form_id, limit, per_page, session, recorder)
+            for name, value in recorder.seconds.items():
+                seconds[name].append(value)
+
+        if trace_allocations:
+            recorder = _StageRecorder(trace=True)
+            tracemalloc.start()
+            try:
+                _run_stages(form_id, limit, per_page, session, recorder)
+            finally:
+                tracemalloc.stop()
+            allocated, peak = recorder.allocated, recorder.peak
+
+    return BenchmarkResult(submissions, collections.OrderedDict(
+        (name, StageResult(name, min(seconds[name]), submissions, allocated.get(name), peak.get(name)))
+        for name in STAGES if name in seconds))
+
+
+def main(argv: typing.List[str] = None) -> int:
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(prog='python -m rtb_model.benchmark', description=__doc__.split('\n\n')[0])
+    parser.add_argument('cassette_dir')
+    parser.add_argument('form_id', type=int)
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per Formstack request')
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--per-page', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--write', action='store_true', help='also benchmark the database writes (rolled back)')
+    parser.add_argument('--no-allocations', action='store_true')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='fail if slower than the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    session = base.Session() if args.write else None
+    try:
+        result = run_benchmark(args.cassette_dir, args.form_id, latency=args.latency, limit=args.limit,
+                               per_page=args.per_page, session=session, repeat=args.repeat,
+                               trace_allocations=not args.no_allocations)
+    finally:
+        if session is not None:
+            session.rollback()
+            session.close()
+    logger.info(result)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result.to_dict(), file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = result.regressions(BenchmarkResult.from_dict(json.load(file)), args.tolerance)
+        for regression in regressions:
+            logger.error(f'Regression: {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,307 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import collections
+import csv
+import enum
+import io
+import itertools
+import logging
+import os
+import typing
+from uuid import UUID
+
+from sqlalchemy import Table, or_
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from . import rollup
+from .answer import Answer
+from .catalog import get_catalog
+from .formstacksubmission import FormstackSubmission
+from .onelineuser import OnlineUser
+from .quickstartanswer import QuickstartAnswer, QuickstartLikertAnswer
+from .quickstartquestion import QuickstartQuestion
+from .quickstartuser import QuickstartUser
+
+logger = logging.getLogger(__name__)
+
+
+class BulkWriteError(ValueError):
+    pass
+
+
+class BulkMethod(enum.Enum):
+    COPY = 'copy'
+    EXECUTEMANY = 'executemany'
+
+
+class _BulkWriter:
+    """
+    Streams rows into a table in chunks, either with PostgreSQL's COPY or with a batched executemany. COPY falls back
+    to executemany on other databases. Each row is a tuple in the order of `fields`, or a dict keyed by them;
+    `resolve_chunk` turns a chunk of such rows into tuples of column values in the order of `columns`.
+    """
+
+    def __init__(self, session: SQLAlchemySession, table: Table, fields: typing.Sequence[str],
+                 columns: typing.Sequence[str], chunk_size: int, method: BulkMethod, commit: bool):
+        self.session = session
+        self.table = table
+        self.fields = list(fields)
+        self.columns = list(columns)
+        self.chunk_size = chunk_size
+        self.method = BulkMethod(method)
+        if self.method is BulkMethod.COPY and session.get_bind().dialect.name != 'postgresql':
+            self.method = BulkMethod.EXECUTEMANY
+        self.commit = commit
+
+    def _as_tuple(self, row) -> tuple:
+        if isinstance(row, dict):
+            return tuple(row.get(field) for field in self.fields)
+        return tuple(row)
+
+    def resolve_chunk(self, rows: typing.List[tuple]) -> typing.List[tuple]:
+        raise NotImplementedError
+
+    def after_chunk(self, values: typing.List[tuple]) -> None:
+        """
+        Called with each chunk of column values once written, before it is committed.
+        """
+        pass
+
+    def write(self, rows: typing.Iterable) -> int:
+        written = 0
+        rows = iter(rows)
+        while True:
+            chunk = [self._as_tuple(row) for row in itertools.islice(rows, self.chunk_size)]
+            if not chunk:
+                break
+            values = self.resolve_chunk(chunk)
+            if self.method is BulkMethod.COPY:
+                self._copy(values)
+            else:
+                self._executemany(values)
+            self.after_chunk(values)
+            if self.commit:
+                self.session.commit()
+            written += len(values)
+            logger.debug(f'Wrote {written} rows to {self.table.name}')
+        return written
+
+    def _copy(self, values: typing.List[tuple]) -> None:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in values:
+            # Unquoted empty fields are NULL in COPY's CSV format
+            writer.writerow(['' if value is None else value for value in row])
+        buffer.seek(0)
+
+        cursor = self.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(f'COPY {self.table.name} ({", ".join(self.columns)}) FROM STDIN WITH (FORMAT csv)',
+                               buffer)
+        finally:
+            cursor.close()
+
+    def _executemany(self, values: typing.List[tuple]) -> None:
+        self.session.execute(self.table.insert(), [dict(zip(self.columns, row)) for row in values])
+
+
+def _new_ids(count: int) -> typing.List[str]:
+    """
+    :return: `count` random (version 4) UUIDs as hex strings, which both COPY and executemany accept. Cutting them from
+        one block of random bytes is several times faster than calling `uuid4` for each.
+    """
+    data = os.urandom(16 * count).hex()
+    # The version (4) and variant (10xx) bits of RFC 4122 are set in the 13th and 17th hex digits
+    return [f'{data[i:i + 12]}4{data[i + 13:i + 16]}{"89ab"[int(data[i + 16], 16) & 3]}{data[i + 17:i + 32]}'
+            for i in range(0, 32 * count, 32)]
+
+
+def _uuid_hex(value) -> typing.Optional[str]:
+    if isinstance(value, UUID):
+        return value.hex
+    try:
+        return UUID(str(value)).hex
+    except ValueError:
+        return None
+
+
+def _resolve_by_email(session: SQLAlchemySession, model, keys: typing.Iterable) -> typing.Dict[typing.Any, str]:
+    """
+    Maps each key, which is either the id of a `model` row or the email of exactly one, to the row's id. Ids and emails
+    are looked up together, in one query.
+    :raises BulkWriteError: if a key is neither the id of a row nor the email of exactly one.
+    """
+    keys = set(keys) - {None}
+    ids = {key: _uuid_hex(key) for key in keys}
+    emails = {key for key, value in ids.items() if value is None}
+    ids = {key: value for key, value in ids.items() if value is not None}
+    resolved = {None: None}
+    if not keys:
+        return resolved
+
+    found_ids, found_emails = set(), dict()
+    for row_id, email in session.query(model.id, model.email).filter(
+            or_(model.id.in_([UUID(value) for value in set(ids.values())]), model.email.in_(emails))):
+        found_ids.add(row_id.hex)
+        if email in emails:
+            if email in found_emails and found_emails[email] != row_id.hex:
+                raise BulkWriteError(f'More than one {model.__name__} has the email {email}; give its id instead')
+            found_emails[email] = row_id.hex
+    missing = sorted(str(key) for key, value in ids.items() if value not in found_ids)
+    if missing:
+        raise BulkWriteError(f'No {model.__name__} with the id(s): {", ".join(missing)}')
+    missing = emails - set(found_emails)
+    if missing:
+        raise BulkWriteError(f'No {model.__name__} with the email(s): {", ".join(sorted(missing))}')
+    resolved.update(ids)
+    resolved.update(found_emails)
+    return resolved
+
+
+def _resolve_submissions(session: SQLAlchemySession, keys: typing.Iterable) -> typing.Dict[typing.Any, int]:
+    """
+    Maps each key, the id of a `FormstackSubmission` as an int or a string, to the id. They are checked in one query.
+    :raises BulkWriteError: if a key is not the id of a submission.
+    """
+    resolved = {None: None}
+    for key in set(keys) - {None}:
+        try:
+            resolved[key] = int(key)
+        except (TypeError, ValueError):
+            raise BulkWriteError(f'{key!r} is not a Formstack submission id') from None
+    ids = set(resolved.values()) - {None}
+    if ids:
+        found = {row_id for row_id, in session.query(FormstackSubmission.id).filter(FormstackSubmission.id.in_(ids))}
+        missing = ids - found
+        if missing:
+            raise BulkWriteError(f'No FormstackSubmission with the id(s): {", ".join(map(str, sorted(missing)))}')
+    return resolved
+
+
+class AnswerWriter(_BulkWriter):
+    """
+    Writes `Answer` rows given as `(response, measure, online_user, formstack_submission_id)` tuples or dicts with
+    those keys. `measure` is a `Measure` id or identifier such as 'C3.R2.M4', and `online_user` is an `OnlineUser` id or
+    email address.
+    """
+    fields = ('response', 'measure', 'online_user', 'formstack_submission_id')
+
+    def __init__(self, session: SQLAlchemySession, chunk_size: int, method: BulkMethod, commit: bool):
+        super().__init__(session, Answer.__table__, self.fields,
+                         ('id', 'response', 'measure_id', 'online_user_id', 'formstack_submission_id'),
+                         chunk_size, method, commit)
+        self.responses = frozenset(Answer.__table__.c.response.type.enums)
+        # Every measure is resolved up front from the reference catalog; there are only a few hundred of them
+        self.measures = dict()
+        self.criteria = dict()
+        catalog = get_catalog(session)
+        for measure in catalog.measures:
+            for key in (catalog.identifier(measure), measure.id, str(measure.id), measure.id.hex):
+                self.measures[key] = measure.id.hex
+            self.criteria[measure.id.hex] = measure.criterion_id.hex
+        # The company of each user written so far, for the answer counts
+        self.companies = dict()
+
+    def resolve_chunk(self, rows: typing.List[tuple]) -> typing.List[tuple]:
+        users = _resolve_by_email(self.session, OnlineUser, (row[2] for row in rows))
+        submissions = _resolve_submissions(self.session, (row[3] for row in rows))
+        values = list()
+        for answer_id, (response, measure, online_user, formstack_submission_id) in zip(_new_ids(len(rows)), rows):
+            if response is not None and response not in self.responses:
+                raise BulkWriteError(f'{response!r} is not a valid answer response')
+            try:
+                measure_id = self.measures[measure] if measure is not None else None
+            except KeyError:
+                raise BulkWriteError(f'No measure {measure!r}') from None
+            values.append((answer_id, response, measure_id, users[online_user], submissions[formstack_submission_id]))
+        return values
+
+    def after_chunk(self, values: typing.List[tuple]) -> None:
+        if not rollup.maintaining(self.session):
+            return
+        # Answers are counted by user, measure and response first, as a chunk has many answers of each user
+        answers = collections.Counter((online_user_id, measure_id, response)
+                                      for _, response, measure_id, online_user_id, _ in values
+                                      if response is not None and measure_id is not None
+                                      and online_user_id is not None)
+        users = {online_user_id for online_user_id, _, _ in answers} - set(self.companies)
+        if users:
+            self.companies.update((user_id.hex, company_id.hex if company_id is not None else None)
+                                  for user_id, company_id in self.session.query(OnlineUser.id, OnlineUser.company_id)
+                                  .filter(OnlineUser.id.in_(users)))
+        totals = collections.Counter()
+        for (online_user_id, measure_id, response), count in answers.items():
+            company_id = self.companies.get(online_user_id)
+            if company_id is not None:
+                totals[(company_id, self.criteria[measure_id], response)] += count
+        rollup.add_answer_counts(self.session, totals)
+
+
+class QuickstartAnswerWriter(_BulkWriter):
+    """
+    Writes `QuickstartAnswer` rows given as `(answer, question, quickstart_user)` tuples or dicts with those keys.
+    `answer` is a `QuickstartLikertAnswer`, its name or its value, `question` is a `QuickstartQuestion` id or question
+    text, and `quickstart_user` is a `QuickstartUser` id or email address.
+    """
+    fields = ('answer', 'question', 'quickstart_user')
+
+    def __init__(self, session: SQLAlchemySession, chunk_size: int, method: BulkMethod, commit: bool):
+        super().__init__(session, QuickstartAnswer.__table__, self.fields,
+                         ('id', 'answer', 'question_id', 'quickstart_user_id'), chunk_size, method, commit)
+        self.questions = dict()
+        for question_id, question_text in session.query(QuickstartQuestion.id, QuickstartQuestion.question_text):
+            self.questions[question_text] = question_id.hex
+            self.questions[question_id] = question_id.hex
+            self.questions[str(question_id)] = question_id.hex
+            self.questions[question_id.hex] = question_id.hex
+
+    @staticmethod
+    def _answer_name(answer) -> typing.Optional[str]:
+        if answer is None:
+            return None
+        try:
+            if isinstance(answer, QuickstartLikertAnswer):
+                return answer.name
+            if isinstance(answer, str) and not answer.isdigit():
+                return QuickstartLikertAnswer[answer].name
+            return QuickstartLikertAnswer(int(answer)).name
+        except (KeyError, ValueError):
+            raise BulkWriteError(f'{answer!r} is not a valid quickstart answer') from None
+
+    def resolve_chunk(self, rows: typing.List[tuple]) -> typing.List[tuple]:
+        users = _resolve_by_email(self.session, QuickstartUser, (row[2] for row in rows))
+        values = list()
+        for answer_id, (answer, question, quickstart_user) in zip(_new_ids(len(rows)), rows):
+            try:
+                question_id = self.questions[question] if question is not None else None
+            except KeyError:
+                raise BulkWriteError(f'No quickstart question {question!r}') from None
+            values.append((answer_id, self._answer_name(answer), question_id, users[quickstart_user]))
+        return values
+
+
+def bulk_insert_answers(session: SQLAlchemySession, rows: typing.Iterable, chunk_size: int = 10000,
+                        method: typing.Union[BulkMethod, str] = BulkMethod.COPY, commit: bool = True) -> int:
+    """
+    Inserts many `Answer` rows without building ORM objects. See `AnswerWriter` for the row format.
+    :param session: session to write with. `BulkMethod.COPY` is only used with PostgreSQL; other databases use
+        `BulkMethod.EXECUTEMANY` instead.
+    :param rows: an iterable of rows. It is consumed one chunk at a time, so it may be a generator of any length.
+    :param chunk_size: number of rows sent (and committed, if `commit`) at a time.
+    :param method: `BulkMethod.COPY` streams each chunk with COPY; `BulkMethod.EXECUTEMANY` uses a batched INSERT.
+    :param commit: commit after each chunk. Otherwise the caller commits (or rolls back) everything at the end.
+    :return: the number of rows written.
+    :raises BulkWriteError: if a row has an invalid response or refers to a measure, user or Formstack submission
+        that does not exist.
+    """
+    return AnswerWriter(session, chunk_size, method, commit).write(rows)
+
+
+def bulk_insert_quickstart_answers(session: SQLAlchemySession, rows: typing.Iterable, chunk_size: int = 10000,
+                                   method: typing.Union[BulkMethod, str] = BulkMethod.COPY,
+                                   commit: bool = True) -> int:
+    """
+    Inserts many `QuickstartAnswer` rows without building ORM objects. See `QuickstartAnswerWriter` for the row
+    format, and `bulk_insert_answers` for the other parameters.
+    """
+    return QuickstartAnswerWriter(session, chunk_size, method, commit).write(rows)
@@ -0,0 +1,156 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import itertools
+import logging
+import threading
+import typing
+from uuid import UUID
+
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from . import base
+from .component import Component
+from .criterion import Criterion
+from .measure import Measure
+from .quickstartquestion import QuickstartQuestion
+
+logger = logging.getLogger(__name__)
+
+ReferenceObject = typing.Union[Component, Criterion, Measure]
+
+
+class ReferenceCatalog:
+    """
+    An in-memory copy of the assessment's reference data: every `Component`, `Criterion`, `Measure` and
+    `QuickstartQuestion`. Objects are detached from any session, with `Criterion.component` and `Measure.criterion`
+    already loaded, so reading an identifier never queries the database.
+
+    Objects are looked up by identifier ('C3', 'C3.R2' or 'C3.R2.M4') or by id, and identifiers by object or id, all
+    in O(1).
+    """
+
+    def __init__(self, components: typing.Iterable[Component], criteria: typing.Iterable[Criterion],
+                 measures: typing.Iterable[Measure], quickstart_questions: typing.Iterable[QuickstartQuestion],
+                 version: int = 0):
+        self.version = version
+        self.components = list(components)
+        self.criteria = list(criteria)
+        self.measures = list(measures)
+        self.quickstart_questions = list(quickstart_questions)
+
+        self._by_identifier: typing.Dict[str, ReferenceObject] = dict()
+        self._by_id: typing.Dict[UUID, typing.Any] = dict()
+        self._identifiers: typing.Dict[UUID, str] = dict()
+        for obj in itertools.chain(self.components, self.criteria, self.measures):
+            identifier = obj.identifier
+            self._by_identifier[identifier] = obj
+            self._by_id[obj.id] = obj
+            self._identifiers[obj.id] = identifier
+        for question in self.quickstart_questions:
+            self._by_id[question.id] = question
+
+    @classmethod
+    def load(cls, session: SQLAlchemySession, version: int = 0) -> 'ReferenceCatalog':
+        """
+        Loads the component/criterion/measure tree in one query and the quickstart questions in another. The objects
+        are loaded in a private session on the same connection as `session`, so none of the caller's objects are
+        affected.
+        """
+        connection = session.connection()
+        # A session bound to a connection takes over its innermost transaction, and on SQLAlchemy 1.4 ends it when it
+        # is closed. It is given a savepoint of its own, so that the caller's transaction (or savepoint) is untouched
+        savepoint = connection.begin_nested()
+        catalog_session = SQLAlchemySession(bind=connection)
+        try:
+            return cls._load(catalog_session, version)
+        finally:
+            catalog_session.close()
+            if savepoint.is_active:
+                savepoint.rollback()
+
+    @classmethod
+    def _load(cls, session: SQLAlchemySession, version: int) -> 'ReferenceCatalog':
+        components, criteria, measures = dict(), dict(), dict()
+        for component, criterion, measure in session.query(Component, Criterion, Measure) \
+                .outerjoin(Criterion, Criterion.component_id == Component.id) \
+                .outerjoin(Measure, Measure.criterion_id == Criterion.id):
+            components[component.id] = component
+            if criterion is not None:
+                criteria[criterion.id] = criterion
+            if measure is not None:
+                measures[measure.id] = measure
+        quickstart_questions = session.query(QuickstartQuestion).all()
+
+        # Many-to-one relationships are resolved from the session's identity map, so loading them here issues no
+        # further queries. They must be loaded before the objects are detached.
+        for criterion in criteria.values():
+            criterion.component
+        for measure in measures.values():
+            measure.criterion
+        for question in quickstart_questions:
+            question.component
+        for obj in itertools.chain(components.values(), criteria.values(), measures.values(), quickstart_questions):
+            session.expunge(obj)
+
+        logger.info(f'Loaded reference catalog: {len(components)} components, {len(criteria)} criteria, '
+                    f'{len(measures)} measures, {len(quickstart_questions)} quickstart questions')
+        return cls(components.values(), criteria.values(), measures.values(), quickstart_questions, version=version)
+
+    def __getitem__(self, identifier: str) -> ReferenceObject:
+        return self._by_identifier[identifier]
+
+    def __contains__(self, identifier: str) -> bool:
+        return identifier in self._by_identifier
+
+    def get(self, identifier: str, default: typing.Any = None) -> typing.Optional[ReferenceObject]:
+        return self._by_identifier.get(identifier, default)
+
+    def by_id(self, object_id: UUID) -> typing.Any:
+        return self._by_id[object_id]
+
+    def identifier(self, obj_or_id: typing.Union[ReferenceObject, UUID]) -> str:
+        """
+        :return: the identifier (e.g. 'C3.R2.M4') of a component, criterion or measure, given the object or its id.
+        """
+        return self._identifiers[getattr(obj_or_id, 'id', obj_or_id)]
+
+    def __repr__(self):
+        return f'Reference catalog v{self.version}: {len(self.components)} components, {len(self.criteria)} ' \
+               f'criteria, {len(self.measures)} measures, {len(self.quickstart_questions)} quickstart questions'
+
+
+_catalog: typing.Optional[ReferenceCatalog] = None
+_version = 0
+_lock = threading.Lock()
+
+
+def get_catalog(session: SQLAlchemySession = None) -> ReferenceCatalog:
+    """
+    Returns this process's reference catalog, loading it on first use and after each `invalidate_catalog()`.
+    :param session: session to load the catalog with if needed. Defaults to a new `Session`.
+    """
+    global _catalog
+    with _lock:
+        if _catalog is None or _catalog.version != _version:
+            if session is not None:
+                _catalog = ReferenceCatalog.load(session, version=_version)
+            else:
+                session = base.Session()
+                try:
+                    _catalog = ReferenceCatalog.load(session, version=_version)
+                    session.commit()
+                finally:
+                    session.close()
+        return _catalog
+
+
+def invalidate_catalog() -> int:
+    """
+    Marks the cached catalog as out of date, so that it is reloaded on next use. Call this after changing any
+    component, criterion, measure or quickstart question.
+    :return: the new catalog version.
+    """
+    global _version
+    with _lock:
+        _version += 1
+        return _version
@@ -0,0 +1,83 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Column types that work on every supported database, so that the schema can also be created on SQLite (see
+`base.configure`).
+"""
+
+import uuid
+
+from sqlalchemy import CHAR, DateTime, String
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.types import TypeDecorator
+
+
+class GUID(TypeDecorator):
+    """
+    A UUID, stored as PostgreSQL's native UUID type, or as 32 hexadecimal characters elsewhere. Values are read as
+    `uuid.UUID`s; `uuid.UUID`s and their string forms (with or without hyphens) can be written.
+    """
+    impl = CHAR(32)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.UUID(as_uuid=True))
+        return dialect.type_descriptor(CHAR(32))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, uuid.UUID):
+            value = uuid.UUID(str(value))
+        return value if dialect.name == 'postgresql' else value.hex
+
+    def process_result_value(self, value, dialect):
+        if value is None or isinstance(value, uuid.UUID):
+            return value
+        return uuid.UUID(value)
+
+
+class utc_now(FunctionElement):
+    """
+    The database's current time in UTC, as a timestamp without time zone (like the values of
+    `dt.datetime.utcnow()`).
+    """
+    type = DateTime()
+    name = 'utc_now'
+    inherit_cache = True
+
+
+@compiles(utc_now)
+def _compile_utc_now(element, compiler, **kw):
+    return "timezone('UTC', now())"
+
+
+@compiles(utc_now, 'sqlite')
+def _compile_utc_now_sqlite(element, compiler, **kw):
+    # In the format SQLAlchemy writes datetimes to SQLite in, so that they compare correctly as text
+    return "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
+class guid_text(FunctionElement):
+    """
+    A `GUID` column as text, in the canonical hyphenated form of `str(uuid.UUID)` on every database.
+    """
+    type = String()
+    name = 'guid_text'
+    inherit_cache = True
+
+
+@compiles(guid_text)
+def _compile_guid_text(element, compiler, **kw):
+    return f'CAST({compiler.process(element.clauses, **kw)} AS VARCHAR)'
+
+
+@compiles(guid_text, 'sqlite')
+def _compile_guid_text_sqlite(element, compiler, **kw):
+    # Stored as 32 lower case hexadecimal characters (see `GUID.process_bind_param`)
+    column = compiler.process(element.clauses, **kw)
+    return " || '-' || ".join(f'substr({column}, {start}, {length})'
+                              for start, length in ((1, 8), (9, 4), (13, 4), (17, 4), (21, 12)))
@@ -1,20 +1,22 @@
 #  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
 
 import datetime as dt
+import typing
 from uuid import uuid4
 
-from sqlalchemy import Boolean, CHAR, Column, DateTime, Integer, String
-from sqlalchemy.dialects.postgresql import BIGINT, UUID
+from sqlalchemy import BIGINT, Boolean, CHAR, Column, DateTime, Index, Integer, String, UniqueConstraint
 
 from . import base
-from .formstack_utilities import FormstackSubmissionHelper
+from .column_types import GUID
+from .field_map import FieldMap
+from .formstack_utilities import FORMSTACK_TIME_FORMAT, FORMSTACK_TIMEZONE, FormstackSubmissionHelper
 
 
 class Company(base.Base):
     __tablename__: str = 'company'
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    id = Column(GUID(), primary_key=True, default=uuid4)
     company_name = Column(String)
-    abn = Column(BIGINT)
+    abn = Column(BIGINT, index=True)
     abs_group = Column(CHAR)
     abs_subdivision = Column(Integer)
     business_size = Column(String)
@@ -28,53 +30,122 @@ class Company(base.Base):
     date_last_update = Column(DateTime)
     date_complete = Column(DateTime, nullable=True)
 
-    # managing_delivery_partner_id = Column(UUID(as_uuid=True), ForeignKey('deliverypartner.id'))
+    __table_args__ = (
+        # Used to match re-ingested submissions to their existing company, see `upsert.upsert_companies`. Also serves
+        # lookups by submission_id, so that column has no index of its own
+        UniqueConstraint('submission_id', name='uq_company_submission_id'),
+        Index('uq_company_abn_without_submission', 'abn', unique=True,
+              postgresql_where=submission_id.is_(None), sqlite_where=submission_id.is_(None)),
+    )
+
+    # managing_delivery_partner_id = Column(GUID(), ForeignKey('deliverypartner.id'))
     # managing_delivery_partner = relationship("DeliveryPartner", backref=backref("deliverypartner"))
 
     def __str__(self):
-        return f"{self.company_name}: ABN #{self.abn}"
+        return f"{base.repr_attribute(self, 'company_name')}: ABN #{base.repr_attribute(self, 'abn')}"
 
     def __repr__(self):
         return self.__str__()
 
+    abs_groups = 'ABCDEFGHIJKLMNOPQRS'
+    formstack_field_map = FieldMap(fields={
+        'company_name': 87125019,
+        'abn': 87125021,
+        'abs_group': 87125022,
+        'business_size': 87125270,
+        'annual_turnover': 87125311,
+        'operate_locations': 87125313,
+        # The ABS subdivision is asked in a separate field for each ABS group
+        'abs_A': 87125025,
+        'abs_B': 87125166,
+        'abs_C': 87125193,
+        'abs_D': 87125210,
+        'abs_E': 87125234,
+        'abs_F': 87125236,
+        'abs_G': 87125237,
+        'abs_H': 87125239,
+        'abs_I': 87125245,
+        'abs_J': 87125246,
+        'abs_K': 87125248,
+        'abs_L': 87125249,
+        'abs_M': 87125250,
+        'abs_N': 87125253,
+        'abs_O': 87125254,
+        'abs_P': 87125255,
+        'abs_Q': 87125256,
+        # R and S are read from the same field, as they were by the lookup table this map replaced; the form's field
+        # for S is unconfirmed. Answers start with their group's letter (e.g. 'R90'), so an answer is only used as the
+        # subdivision of a company in that group, and an S company never gets an R subdivision.
+        'abs_R': 87125257,
+        'abs_S': 87125257,
+    })
+    operate_location_options = ['Australia', 'New Zealand', 'Internationally']
+
     @classmethod
     def from_formstack(cls, formstack_submission: FormstackSubmissionHelper):
-        data = formstack_submission.get_data()
-
-        abs_group_to_field_id = {
-            'A': 87125025,
-            'B': 87125166,
-            'C': 87125193,
-            'D': 87125210,
-            'E': 87125234,
-            'F': 87125236,
-            'G': 87125237,
-            'H': 87125239,
-            'I': 87125245,
-            'J': 87125246,
-            'K': 87125248,
-            'L': 87125249,
-            'M': 87125250,
-            'N': 87125253,
-            'O': 87125254,
-            'P': 87125255,
-            'Q': 87125256,
-            'R': 87125257,
-            'S': 87125257,
-        }
-        operate_locations = data.loc[87125313].value.split('\n')
-        params = {'company_name': data.loc[87125019].value, 'abn': data.loc[87125021].value,
-                  'abs_group': data.loc[87125022].value.strip()[0], 'business_size': data.loc[87125270].value,
+        data = cls.formstack_field_map.compile(formstack_submission.form).extract(formstack_submission.get_record())
+
+        operate_locations = data['operate_locations'].split('\n')
+        params = {'company_name': data['company_name'], 'abn': data['abn'],
+                  'abs_group': data['abs_group'].strip()[0], 'business_size': data['business_size'],
                   'operate_australia': 'Australia' in operate_locations,
                   'operate_new_zealand': 'New Zealand' in operate_locations,
                   'operate_internationally': 'Internationally' in operate_locations,
-                  'operate_other': [x for x in operate_locations if
-                                    x not in ['Australia', 'New Zealand', 'Internationally']],
-                  'annual_turnover': data.loc[87125311].value, 'submission_id': formstack_submission.submission_id,
+                  'operate_other': '\n'.join(x for x in operate_locations
+                                              if x not in cls.operate_location_options) or None,
+                  'annual_turnover': data['annual_turnover'], 'submission_id': formstack_submission.submission_id,
                   'date_submit': formstack_submission.timestamp,
                   'date_last_update': dt.datetime.utcnow()
                   }
-        params['abs_subdivision'] = data.loc[abs_group_to_field_id[params['abs_group']]].value.strip()[1:3]
+        abs_subdivision = (data[f"abs_{params['abs_group']}"] or '').strip()
+        params['abs_subdivision'] = abs_subdivision[1:3] if abs_subdivision[:1] == params['abs_group'] else None
 
         # noinspection PyArgumentList
         return cls(**params)
+
+    @classmethod
+    def rows_from_formstack(cls, formstack_submissions: typing.Iterable[FormstackSubmissionHelper]):
+        """
+        Builds the company of each submission as a row of column values, in one vectorised pass over the batch. All
+        submissions must be to the same form.
+        :return: a DataFrame with one row per submission and one column per `from_formstack` parameter.
+        """
+        import numpy as np
+        import pandas as pd
+
+        formstack_submissions = list(formstack_submissions)
+        if not formstack_submissions:
+            return pd.DataFrame()
+        extractor = cls.formstack_field_map.compile(formstack_submissions[0].form)
+        data = extractor.extract_batch(submission.get_record() for submission in formstack_submissions)
+
+        abs_group = data['abs_group'].str.strip().str[0]
+        # Pick each row's subdivision from the column of its ABS group
+        abs_columns = data[[f'abs_{group}' for group in cls.abs_groups]].to_numpy()
+        abs_index = abs_group.map({group: i for i, group in enumerate(cls.abs_groups)})
+        known = abs_index.notna().to_numpy()
+        abs_subdivision = np.full(len(data), None, dtype=object)
+        abs_subdivision[known] = abs_columns[known, abs_index[known].astype(int).to_numpy()]
+        abs_subdivision = pd.Series(abs_subdivision, index=data.index, dtype=object).str.strip()
+        # Answers for another group (see `formstack_field_map`) are not used
+        abs_subdivision = abs_subdivision.where(abs_subdivision.str[:1] == abs_group, None)
+
+        date_submit = pd.to_datetime(data['timestamp'], format=FORMSTACK_TIME_FORMAT) \
+            .dt.tz_localize(FORMSTACK_TIMEZONE).dt.tz_convert('UTC')
+
+        return pd.DataFrame({
+            'company_name': data['company_name'],
+            'abn': data['abn'],
+            'abs_group': abs_group,
+            'abs_subdivision': abs_subdivision.str[1:3],
+            'business_size': data['business_size'],
+            'operate_australia': data['operate_locations'].str.contains('(?m)^Australia$'),
+            'operate_new_zealand': data['operate_locations'].str.contains('(?m)^New Zealand$'),
+            'operate_internationally': data['operate_locations'].str.contains('(?m)^Internationally$'),
+            'operate_other': data['operate_locations'].str.split('\n').map(
+                lambda x: '\n'.join(y for y in x if y not in cls.operate_location_options) or None),
+            'annual_turnover': data['annual_turnover'],
+            'submission_id': data['submission_id'],
+            'date_submit': date_submit,
+            'date_last_update': dt.datetime.utcnow(),
+        })
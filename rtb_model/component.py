@@ -3,19 +3,19 @@
 from uuid import uuid4
 
 from sqlalchemy import Column, Integer, String
-from sqlalchemy.dialects.postgresql import UUID
 
 from . import base
+from .column_types import GUID
 
 
 class Component(base.Base):
     __tablename__: str = "component"
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    id = Column(GUID(), primary_key=True, default=uuid4)
     number = Column(Integer, unique=True)
     name = Column(String, unique=True)
 
     def __repr__(self):
-        return f'{self.identifier}: {self.name}'
+        return f'C{base.repr_attribute(self, "number")}: {base.repr_attribute(self, "name")}'
 
     def __str__(self):
         return self.__repr__()
@@ -1,31 +1,46 @@
 #  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
 
+import functools
 from uuid import uuid4
 
-from sqlalchemy import Column, Integer, String, ForeignKey, Text
-from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, Integer, String, ForeignKey, Text, inspect
+from sqlalchemy.orm import relationship, backref, object_session
 
 from . import base
+from .column_types import GUID
 
 
 class Criterion(base.Base):
     __tablename__: str = "criterion"
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    id = Column(GUID(), primary_key=True, default=uuid4)
     number = Column(Integer)
     name = Column(String, unique=True)
     short_name = Column(String, unique=True)
-    component_id = Column(UUID(as_uuid=True), ForeignKey('component.id'))
+    component_id = Column(GUID(), ForeignKey('component.id'), index=True)
     component = relationship("Component", backref=backref("component"))
     advice = Column(Text)
     introductory_text = Column(Text)
 
     def __repr__(self):
-        return f'{self.identifier}: {self.name}'
+        attribute = functools.partial(base.repr_attribute, self)
+        return f'C{attribute("component.number")}.R{attribute("number")}: {attribute("name")}'
 
     def __str__(self):
         return self.__repr__()
 
     @property
     def identifier(self):
+        """
+        The criterion's identifier, e.g. 'C3.R2'. If `component` is not loaded, this is read from the reference catalog
+        (see `get_catalog`) rather than loading the component.
+        """
+        state = inspect(self)
+        if state.has_identity and 'component' in state.unloaded:
+            from .catalog import get_catalog
+            try:
+                return get_catalog(object_session(self)).identifier(state.identity[0])
+            except KeyError:
+                # Added since the catalog was loaded
+                pass
         return f'C{self.component.number}.R{self.number}'
+
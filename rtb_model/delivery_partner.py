@@ -3,15 +3,15 @@
 from uuid import uuid4
 
 from sqlalchemy import Column, String
-from sqlalchemy.dialects.postgresql import UUID
 
 from . import base
+from .column_types import GUID
 
 
 class DeliveryPartner(base.Base):
     __tablename__: str = 'deliverypartner'
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    id = Column(GUID(), primary_key=True, default=uuid4)
     prefix = Column(String(10))
     first_name = Column(String)
     last_name = Column(String)
@@ -0,0 +1,266 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Streams answers and companies to CSV or Parquet files for analysis.
+
+Each export is one SQL query that joins in everything it outputs (company and user columns, and the component,
+criterion and measure identifiers), so no ORM objects are built and no relationships are loaded. Rows are read from a
+server-side cursor and written a chunk at a time, so memory use is bounded by `chunk_size` however large the export.
+
+Parquet output needs pyarrow (`pip install rtb_model[parquet]`).
+"""
+
+import csv
+import datetime as dt
+import enum
+import logging
+import os
+import typing
+from uuid import UUID
+
+from sqlalchemy import Boolean, DateTime, Integer, String, cast, func, literal, select
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from .answer import Answer
+from .column_types import guid_text
+from .company import Company
+from .component import Component
+from .criterion import Criterion
+from .formstacksubmission import FormstackSubmission
+from .measure import Measure
+from .onelineuser import OnlineUser
+
+logger = logging.getLogger(__name__)
+
+Destination = typing.Union[str, os.PathLike, typing.IO]
+
+
+class ExportFormat(enum.Enum):
+    CSV = 'csv'
+    PARQUET = 'parquet'
+
+
+def _text(column):
+    # UUIDs are sent as text, which is cheaper to fetch than UUID objects and is what both formats store
+    return guid_text(column)
+
+
+def _component_identifier():
+    return literal('C') + cast(Component.number, String)
+
+
+def _criterion_identifier():
+    return _component_identifier() + literal('.R') + cast(Criterion.number, String)
+
+
+def _measure_identifier():
+    return _criterion_identifier() + literal('.M') + cast(Measure.number, String)
+
+
+def _answer_columns():
+    return [
+        _text(Answer.id).label('answer_id'),
+        _text(Company.id).label('company_id'),
+        Company.company_name.label('company_name'),
+        Company.abn.label('abn'),
+        _text(OnlineUser.id).label('online_user_id'),
+        OnlineUser.first_name.label('first_name'),
+        OnlineUser.last_name.label('last_name'),
+        OnlineUser.email.label('email'),
+        OnlineUser.job_title.label('job_title'),
+        _component_identifier().label('component'),
+        _criterion_identifier().label('criterion'),
+        _measure_identifier().label('measure'),
+        Measure.text.label('measure_text'),
+        cast(Answer.response, String).label('response'),
+        Answer.formstack_submission_id.label('formstack_submission_id'),
+        _answer_date().label('date_submit'),
+    ]
+
+
+def _answer_date():
+    # Answers are dated by their submission, or by their company's submission if they have none
+    return func.coalesce(FormstackSubmission.date_submit, Company.date_submit)
+
+
+def _company_columns():
+    return [_text(Company.id).label('company_id')] + \
+           [column.label(column.name) for column in Company.__table__.columns if column.name != 'id']
+
+
+def _in_range(column, start: dt.datetime = None, end: dt.datetime = None) -> list:
+    conditions = list()
+    if start is not None:
+        conditions.append(column >= start)
+    if end is not None:
+        conditions.append(column < end)
+    return conditions
+
+
+def answer_export_statement(company_ids: typing.Iterable[UUID] = None, start: dt.datetime = None,
+                            end: dt.datetime = None, components: typing.Iterable[typing.Union[int, str]] = None):
+    """
+    The query behind `export_answers`, with one row per answer, for use with other tools.
+    :param company_ids: only export the answers of these companies.
+    :param start: only export answers submitted at or after this (naive, UTC) time.
+    :param end: only export answers submitted before this (naive, UTC) time.
+    :param components: only export answers to the measures of these components, given by number or identifier
+        (e.g. 3 or 'C3').
+    """
+    statement = select(*_answer_columns()) \
+        .select_from(Answer.__table__
+                     .join(OnlineUser.__table__, Answer.online_user_id == OnlineUser.id)
+                     .join(Company.__table__, OnlineUser.company_id == Company.id)
+                     .join(Measure.__table__, Answer.measure_id == Measure.id)
+                     .join(Criterion.__table__, Measure.criterion_id == Criterion.id)
+                     .join(Component.__table__, Criterion.component_id == Component.id)
+                     .outerjoin(FormstackSubmission.__table__,
+                                Answer.formstack_submission_id == FormstackSubmission.id))
+    if company_ids is not None:
+        statement = statement.where(OnlineUser.company_id.in_(list(company_ids)))
+    if components is not None:
+        numbers = [int(str(component).lstrip('Cc')) for component in components]
+        statement = statement.where(Component.number.in_(numbers))
+    for condition in _in_range(_answer_date(), start, end):
+        statement = statement.where(condition)
+    return statement.order_by(Company.id, OnlineUser.id, Component.number, Criterion.number, Measure.number)
+
+
+def company_export_statement(company_ids: typing.Iterable[UUID] = None, start: dt.datetime = None,
+                             end: dt.datetime = None):
+    """
+    The query behind `export_companies`, with one row per company. See `answer_export_statement`; companies are dated
+    by their `date_submit`.
+    """
+    statement = select(*_company_columns())
+    if company_ids is not None:
+        statement = statement.where(Company.id.in_(list(company_ids)))
+    for condition in _in_range(Company.date_submit, start, end):
+        statement = statement.where(condition)
+    return statement.order_by(Company.date_submit, Company.id)
+
+
+def _arrow_type(sql_type):
+    import pyarrow as pa
+
+    if isinstance(sql_type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(sql_type, Boolean):
+        return pa.bool_()
+    if isinstance(sql_type, Integer):
+        return pa.int64()
+    return pa.string()
+
+
+class _CSVWriter:
+    def __init__(self, file: typing.IO, columns: typing.List[str]):
+        self.writer = csv.writer(file)
+        self.writer.writerow(columns)
+
+    def write(self, rows: typing.List[tuple]) -> None:
+        self.writer.writerows(rows)
+
+    def close(self) -> None:
+        pass
+
+
+class _ParquetWriter:
+    def __init__(self, file, columns: typing.List[str], sql_types: typing.List[typing.Any]):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.schema = pa.schema([pa.field(name, _arrow_type(sql_type)) for name, sql_type in zip(columns, sql_types)])
+        self.writer = pq.ParquetWriter(file, self.schema)
+
+    def write(self, rows: typing.List[tuple]) -> None:
+        import pyarrow as pa
+
+        # Each chunk is written as one row group
+        columns = list(zip(*rows))
+        self.writer.write_table(pa.Table.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, self.schema)], schema=self.schema))
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+def _format_of(destination: Destination, export_format) -> ExportFormat:
+    if export_format is not None:
+        return ExportFormat(export_format)
+    name = os.fspath(destination) if isinstance(destination, (str, os.PathLike)) else getattr(destination, 'name', '')
+    return ExportFormat.PARQUET if str(name).endswith('.parquet') else ExportFormat.CSV
+
+
+def export(session: SQLAlchemySession, statement, destination: Destination,
+           export_format: typing.Union[ExportFormat, str] = None, chunk_size: int = 10000) -> int:
+    """
+    Streams the rows of a query to a CSV or Parquet file.
+    :param statement: a select, e.g. from `answer_export_statement`. Its column labels become the file's columns.
+    :param destination: a path, or a file object opened for writing (text for CSV, binary for Parquet).
+    :param export_format: `ExportFormat.CSV` or `ExportFormat.PARQUET`. Defaults to Parquet for paths ending
+        '.parquet' and CSV otherwise.
+    :param chunk_size: rows fetched from the server, and written, at a time.
+    :return: the number of rows written.
+    """
+    export_format = _format_of(destination, export_format)
+    # `selected_columns` is new in SQLAlchemy 1.4
+    selected = list(getattr(statement, 'selected_columns', None) or statement.columns)
+    columns = [column.name for column in selected]
+
+    opened = isinstance(destination, (str, os.PathLike))
+    if opened:
+        file = open(destination, 'w', newline='') if export_format is ExportFormat.CSV else open(destination, 'wb')
+    else:
+        file = destination
+    try:
+        if export_format is ExportFormat.CSV:
+            writer = _CSVWriter(file, columns)
+        else:
+            writer = _ParquetWriter(file, columns, [column.type for column in selected])
+        # A server-side cursor, so the server sends the rows as they are fetched rather than all at once. The statement
+        # is passed on, so that a read-only session reads from a replica (see `base.RoutingSession`)
+        connection = session.connection(bind_arguments=dict(clause=statement))
+        result = connection.execution_options(stream_results=True).execute(statement)
+        written = 0
+        try:
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                writer.write([tuple(row) for row in rows])
+                written += len(rows)
+                logger.debug(f'Exported {written} rows')
+        finally:
+            result.close()
+            writer.close()
+    finally:
+        if opened:
+            file.close()
+    logger.info(f'Exported {written} rows to {destination}')
+    return written
+
+
+def export_answers(session: SQLAlchemySession, destination: Destination,
+                   export_format: typing.Union[ExportFormat, str] = None, chunk_size: int = 10000,
+                   company_ids: typing.Iterable[UUID] = None, start: dt.datetime = None, end: dt.datetime = None,
+                   components: typing.Iterable[typing.Union[int, str]] = None) -> int:
+    """
+    Exports answers, one row per answer, with their company, user and measure. See `answer_export_statement` for the
+    filters and `export` for the other parameters.
+    :return: the number of answers written.
+    """
+    return export(session, answer_export_statement(company_ids, start, end, components), destination,
+                  export_format, chunk_size)
+
+
+def export_companies(session: SQLAlchemySession, destination: Destination,
+                     export_format: typing.Union[ExportFormat, str] = None, chunk_size: int = 10000,
+                     company_ids: typing.Iterable[UUID] = None, start: dt.datetime = None,
+                     end: dt.datetime = None) -> int:
+    """
+    Exports companies, one row per company with every company column. See `company_export_statement` for the filters
+    and `export` for the other parameters.
+    :return: the number of companies written.
+    """
+    return export(session, company_export_statement(company_ids, start, end), destination, export_format,
+                  chunk_size)
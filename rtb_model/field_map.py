@@ -0,0 +1,131 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import threading
+import typing
+
+from .formstack_record import FormstackSubmissionRecord
+
+
+class FieldMapError(ValueError):
+    pass
+
+
+class FieldMap:
+    """
+    A declarative mapping of named columns to Formstack field ids, e.g.
+
+        FieldMap(fields={'company_name': 87125019, 'abn': 87125021})
+
+    Forms that repeat a block of fields (such as up to five users) are declared with `repeated`, giving the field id
+    of each column in each repetition:
+
+        FieldMap(fields={'num_users': 87125326},
+                 repeated={'email': [87125332, 87125337], 'job_title': [87125333, 87125338]})
+
+    A field map is checked against a form's fields once, by `compile(form)`, which returns the extractor used to
+    read submissions of that form.
+    """
+
+    def __init__(self, fields: typing.Mapping[str, int], repeated: typing.Mapping[str, typing.Sequence[int]] = None,
+                 optional: typing.Iterable[str] = ()):
+        self.fields = dict(fields)
+        self.repeated = {name: list(field_ids) for name, field_ids in (repeated or dict()).items()}
+        self.optional = frozenset(optional)
+        self.repeat_count = len(next(iter(self.repeated.values()))) if self.repeated else 0
+        if any(len(field_ids) != self.repeat_count for field_ids in self.repeated.values()):
+            raise FieldMapError('Every repeated column must list the same number of field ids')
+        self._compiled: typing.Dict[int, CompiledFieldMap] = dict()
+        self._lock = threading.Lock()
+
+    def field_ids(self, required_only: bool = False) -> typing.Dict[int, str]:
+        """
+        :return: every field id in the map, with the name of the column it is read into.
+        """
+        ids = {field_id: name for name, field_id in self.fields.items()
+               if not (required_only and name in self.optional)}
+        for name, field_ids in self.repeated.items():
+            if not (required_only and name in self.optional):
+                ids.update({field_id: f'{name}[{i}]' for i, field_id in enumerate(field_ids, 1)})
+        return ids
+
+    def validate(self, form) -> None:
+        """
+        Checks that every required field in the map exists on `form`.
+        :raises FieldMapError: if any required field is missing from the form.
+        """
+        # Read from the form's JSON rather than `form.get_fields()`, so that validating a map does not import pandas
+        known_ids = {int(field['id']) for field in (form.json_data or dict()).get('fields') or ()
+                     if field.get('type') != 'section'}
+        missing = {field_id: name for field_id, name in self.field_ids(required_only=True).items()
+                   if field_id not in known_ids}
+        if missing:
+            raise FieldMapError(f'Form {form.form_id} has no field(s) for: '
+                                + ', '.join(f'{name} (#{field_id})' for field_id, name in missing.items()))
+
+    def compile(self, form) -> 'CompiledFieldMap':
+        """
+        Validates the map against `form` and returns its extractor. Extractors are cached per form, so only the first
+        call for each form does any work.
+        """
+        form_id = int(form.form_id)
+        with self._lock:
+            compiled = self._compiled.get(form_id)
+            if compiled is None or compiled.form is not form:
+                self.validate(form)
+                compiled = CompiledFieldMap(self, form)
+                self._compiled[form_id] = compiled
+            return compiled
+
+
+class CompiledFieldMap:
+    """
+    Extracts the columns of a `FieldMap` from submissions of one form, either from a single record into a dict or
+    from a batch of records into a single DataFrame.
+    """
+
+    def __init__(self, field_map: FieldMap, form):
+        self.field_map = field_map
+        self.form = form
+        self._names = list(field_map.fields)
+        self._ids = [field_map.fields[name] for name in self._names]
+        self._repeated_names = list(field_map.repeated)
+        self._repeated_ids = [field_map.repeated[name] for name in self._repeated_names]
+
+    def extract(self, record: FormstackSubmissionRecord) -> typing.Dict[str, typing.Any]:
+        """
+        :return: the value of each column, or None where the submission has no value. Repeated columns are lists with
+            one value per repetition.
+        """
+        get = record.get
+        values = {name: get(field_id) for name, field_id in zip(self._names, self._ids)}
+        for name, field_ids in zip(self._repeated_names, self._repeated_ids):
+            values[name] = [get(field_id) for field_id in field_ids]
+        return values
+
+    def extract_batch(self, records: typing.Iterable[FormstackSubmissionRecord]):
+        """
+        Extracts every column from a batch of records in a single pass.
+        :return: a DataFrame with a `submission_id` and `timestamp` column and one column per mapped field, with one
+            row per record. If the map has repeated columns there is instead one row per record and repetition, with a
+            1-based `repeat` column, and the non-repeated columns are repeated on every row of their record.
+        """
+        import numpy as np
+        import pandas as pd
+
+        records = list(records)
+        columns = {'submission_id': np.fromiter((r.submission_id for r in records), dtype=np.int64,
+                                                count=len(records)),
+                   'timestamp': [r.timestamp for r in records]}
+        for name, field_id in zip(self._names, self._ids):
+            columns[name] = [r.get(field_id) for r in records]
+        frame = pd.DataFrame(columns)
+
+        if not self._repeated_names:
+            return frame
+
+        repeat_count = self.field_map.repeat_count
+        frame = frame.loc[frame.index.repeat(repeat_count)].reset_index(drop=True)
+        frame['repeat'] = np.tile(np.arange(1, repeat_count + 1), len(records))
+        for name, field_ids in zip(self._repeated_names, self._repeated_ids):
+            frame[name] = [r.get(field_id) for r in records for field_id in field_ids]
+        return frame
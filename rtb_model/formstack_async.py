@@ -0,0 +1,284 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import asyncio
+import datetime as dt
+import json
+import logging
+import time
+import typing
+
+import aiohttp
+from decouple import config
+
+from . import formstack_scheduler
+from .formstack_replay import RecordingTransport, ReplayTransport
+from .formstack_transport import IDEMPOTENT_METHODS, RETRY_STATUS_CODES, error_for_status, get_transport, \
+    notify_request_listeners
+from .formstack_utilities import FormstackForm, FormstackSubmissionHelper, form_cache
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncFormstackUtility:
+    """
+    Asyncio counterpart to `FormstackUtility`. At most `concurrency` requests are in flight at once, over a pool of
+    keep-alive connections of the same size. Use as an async context manager:
+
+        async with AsyncFormstackUtility(concurrency=16) as utility:
+            form = await utility.get('form/1234')
+
+    If `base_url` or `access_token` is not given, settings not given are taken from the shared `FormstackTransport`, so
+    both clients talk to the same API with the same credentials, timeouts and retry policy, and share its rate limit
+    scheduler. Otherwise the shared transport is not used: settings not given are read from the same FORMSTACK_*
+    environment variables (with the same defaults), and there is no scheduler unless `scheduler` is given. Requests
+    have the priority of the thread that built the utility unless `priority` is given.
+
+    If the shared transport is recording or replaying a cassette (see `formstack_replay`) and `base_url` is not
+    given, requests are sent through that transport, on the event loop's default executor, rather than with aiohttp.
+    """
+
+    def __init__(self, concurrency: int = 16, base_url: str = None, access_token: str = None,
+                 connect_timeout: float = None, read_timeout: float = None, max_retries: int = None,
+                 backoff_factor: float = None, max_backoff: float = None,
+                 scheduler: formstack_scheduler.RateLimitScheduler = None,
+                 priority: formstack_scheduler.Priority = None):
+        # The shared transport is only built if the API or the credentials to use are not given
+        transport = get_transport() if base_url is None or access_token is None else None
+        if transport is not None:
+            defaults = dict(base_url=transport.base_url, access_token=transport.access_token,
+                            connect_timeout=transport.timeout[0], read_timeout=transport.timeout[1],
+                            max_retries=transport.max_retries, backoff_factor=transport.backoff_factor,
+                            max_backoff=transport.max_backoff, scheduler=getattr(transport, 'scheduler', None))
+        else:
+            defaults = dict(connect_timeout=config('FORMSTACK_CONNECT_TIMEOUT', default=5.0, cast=float),
+                            read_timeout=config('FORMSTACK_READ_TIMEOUT', default=30.0, cast=float),
+                            max_retries=config('FORMSTACK_MAX_RETRIES', default=3, cast=int),
+                            backoff_factor=config('FORMSTACK_BACKOFF_FACTOR', default=0.5, cast=float),
+                            max_backoff=60.0, scheduler=None)
+
+        self.concurrency = concurrency
+        self.base_url = base_url if base_url is not None else defaults['base_url']
+        self.access_token = access_token if access_token is not None else defaults['access_token']
+        self.connect_timeout = connect_timeout if connect_timeout is not None else defaults['connect_timeout']
+        self.read_timeout = read_timeout if read_timeout is not None else defaults['read_timeout']
+        self.max_retries = max_retries if max_retries is not None else defaults['max_retries']
+        self.backoff_factor = backoff_factor if backoff_factor is not None else defaults['backoff_factor']
+        self.max_backoff = max_backoff if max_backoff is not None else defaults['max_backoff']
+        self.scheduler = scheduler if scheduler is not None else defaults['scheduler']
+        self.priority = priority if priority is not None else formstack_scheduler.current_priority()
+        self.cassette = transport if base_url is None and isinstance(transport, (RecordingTransport, ReplayTransport)) \
+            else None
+        self._session: typing.Optional[aiohttp.ClientSession] = None
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self) -> 'AsyncFormstackUtility':
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        if self._session is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+                headers={'Content-Type': 'application/json',
+                         'Accept': 'application/json',
+                         'Authorization': f'Bearer {self.access_token}'})
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _backoff(self, attempt: int, retry_after: str = None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return min(self.backoff_factor * (2 ** attempt), self.max_backoff)
+
+    async def _send(self, method: str, url: str, body: typing.Optional[str],
+                    params: typing.Optional[dict]) -> typing.Tuple[bytes, int, typing.Optional[str]]:
+        if self.scheduler is not None:
+            await self.scheduler.acquire_async(self.priority)
+        status, headers, content = None, dict(), b''
+        start = time.perf_counter()
+        try:
+            logger.debug(f'Sending {method} request to Formstack. Endpoint: {url}, params: {params}')
+            async with self._session.request(method, url, data=body, params=params) as response:
+                content = await response.read()
+                status, headers = response.status, response.headers
+                return content, status, headers.get('Retry-After')
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.release(status, headers)
+            notify_request_listeners(method, url[len(self.base_url):], status, time.perf_counter() - start,
+                                     len(content))
+
+    async def request(self, method: str, endpoint: str, data: dict = None, params: dict = None) -> dict:
+        """
+        Sends a request to the Formstack API, retrying as `FormstackTransport.request` does.
+        :return: the decoded JSON content of the successful response.
+        :raises FormstackHTTPError: if Formstack responds with an error status once retries are exhausted.
+        :raises aiohttp.ClientError: if the request could not be sent once retries are exhausted.
+        """
+        await self.open()
+        method = method.upper()
+        if self.cassette is not None:
+            return await self._cassette_request(method, endpoint, data, params)
+        url = self.base_url + endpoint
+        body = json.dumps(data) if data is not None else None
+        idempotent = method in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    content, status, retry_after = await self._send(method, url, body, params)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f'Formstack {method} {endpoint} failed ({e!r}), retrying in {delay:.1f}s')
+            else:
+                if status < 400:
+                    return json.loads(content.decode('utf-8'))
+                retryable = status == 429 or (idempotent and status in RETRY_STATUS_CODES)
+                if not retryable or attempt >= self.max_retries:
+                    try:
+                        error = json.loads(content.decode('utf-8')).get('error')
+                    except (ValueError, AttributeError):
+                        error = None
+                    raise error_for_status(status, method, endpoint, error=error)
+                # The scheduler holds back every request for as long as a 429 asks
+                delay = 0.0 if status == 429 and self.scheduler is not None else self._backoff(attempt, retry_after)
+                logger.warning(f'Formstack {method} {endpoint} returned HTTP {status}, retrying in {delay:.1f}s')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _cassette_request(self, method: str, endpoint: str, data: typing.Optional[dict],
+                                params: typing.Optional[dict]) -> dict:
+        # The cassette transports are synchronous, and retry (or not) themselves
+        def send():
+            with formstack_scheduler.priority(self.priority):
+                return self.cassette.request(method, endpoint, data=data, params=params)
+
+        async with self._semaphore:
+            response = await asyncio.get_running_loop().run_in_executor(None, send)
+        return response.json()
+
+    async def get(self, endpoint: str, params: dict = None) -> dict:
+        return await self.request('GET', endpoint, params=params)
+
+    async def post(self, endpoint: str, data: dict) -> dict:
+        return await self.request('POST', endpoint, data=data)
+
+    async def delete(self, endpoint: str) -> dict:
+        return await self.request('DELETE', endpoint)
+
+    async def put(self, endpoint: str, data: dict) -> dict:
+        return await self.request('PUT', endpoint, data=data)
+
+
+class AsyncFormstackForm:
+    """
+    Asyncio counterpart to `FormstackForm`. `refresh()` fetches the form definition into a regular `FormstackForm`,
+    and submissions are returned as regular `FormstackSubmissionHelper` objects sharing that form, so they can be
+    passed straight to the `from_formstack` constructors without any further requests.
+    """
+
+    def __init__(self, form_id: int, utility: AsyncFormstackUtility):
+        self.form_id = form_id
+        self.utility = utility
+        self.form: typing.Optional[FormstackForm] = None
+
+    async def refresh(self) -> FormstackForm:
+        logger.info(f'Refreshing form {self.form_id}')
+        self.form = FormstackForm(self.form_id, json_data=await self.utility.get(f'form/{self.form_id}'))
+        form_cache.put(self.form)
+        return self.form
+
+    async def iter_submissions(self, data: bool = False, min_time: typing.Union[dt.datetime, str] = None,
+                               max_time: typing.Union[dt.datetime, str] = None,
+                               per_page: int = 100) -> typing.AsyncIterator[dict]:
+        """
+        Asynchronously yields every submission to this form, one page at a time. See
+        `FormstackForm.iter_submissions`.
+        """
+        params = FormstackForm.submission_list_params(data=data, min_time=min_time, max_time=max_time,
+                                                      per_page=per_page)
+
+        page = 1
+        while True:
+            response = await self.utility.get(f'form/{self.form_id}/submission', params=dict(params, page=page))
+            submissions = response['submissions']
+            for submission in submissions:
+                yield submission
+
+            if not submissions or page >= int(response.get('pages', page)):
+                return
+            page += 1
+
+    async def get_all_submission_ids(self, min_time: typing.Union[dt.datetime, str] = None,
+                                     max_time: typing.Union[dt.datetime, str] = None) -> typing.List[int]:
+        return [int(submission['id']) async for submission in self.iter_submissions(min_time=min_time,
+                                                                                     max_time=max_time)]
+
+    async def get_submissions(self, submission_ids: typing.Iterable[int]) -> typing.List[FormstackSubmissionHelper]:
+        """
+        Fetches the given submissions concurrently, within the utility's concurrency limit.
+        :return: a helper for each submission, in the order of `submission_ids`.
+        """
+        if self.form is None:
+            self.form = form_cache.peek(self.form_id)
+        if self.form is None:
+            form_json, *submissions_json = await asyncio.gather(
+                self.utility.get(f'form/{self.form_id}'),
+                *(self.utility.get(f'submission/{int(i)}') for i in submission_ids))
+            self.form = FormstackForm(self.form_id, json_data=form_json)
+            form_cache.put(self.form)
+        else:
+            submissions_json = await asyncio.gather(*(self.utility.get(f'submission/{int(i)}')
+                                                      for i in submission_ids))
+
+        return [FormstackSubmissionHelper(submission['id'], json_data=submission, form=self.form)
+                for submission in submissions_json]
+
+
+class AsyncFormstackSubmissionHelper:
+    """
+    Asyncio counterpart to `FormstackSubmissionHelper`, for submissions whose form is not known in advance.
+    """
+
+    @staticmethod
+    async def fetch(submission_id: int, utility: AsyncFormstackUtility,
+                    form: FormstackForm = None) -> FormstackSubmissionHelper:
+        logger.info(f'Refreshing submission {submission_id}')
+        json_data = await utility.get(f'submission/{int(submission_id)}')
+        if form is None or str(form.form_id) != str(json_data['form']):
+            form = form_cache.peek(json_data['form'])
+            if form is None:
+                form = await AsyncFormstackForm(json_data['form'], utility).refresh()
+        return FormstackSubmissionHelper(submission_id, json_data=json_data, form=form)
+
+
+async def fetch_submissions(form_id: int, submission_ids: typing.Iterable[int], concurrency: int = 16,
+                            **utility_kwargs) -> typing.List[FormstackSubmissionHelper]:
+    """
+    Fetches many submissions of one form concurrently, e.g.
+
+        helpers = await fetch_submissions(form_id, ids, concurrency=16)
+
+    :param form_id: the form the submissions belong to. Its definition is fetched once and shared by every helper.
+    :param submission_ids: the submissions to fetch.
+    :param concurrency: maximum number of requests in flight at once.
+    :param utility_kwargs: further arguments for `AsyncFormstackUtility`, e.g. `base_url`.
+    :return: a helper for each submission, in the order of `submission_ids`.
+    """
+    async with AsyncFormstackUtility(concurrency=concurrency, **utility_kwargs) as utility:
+        return await AsyncFormstackForm(form_id, utility).get_submissions(submission_ids)
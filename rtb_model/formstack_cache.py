@@ -0,0 +1,178 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+
+class FormCache:
+    """
+    A process-wide cache of Formstack form definitions, keyed by form id.
+
+    Entries expire `ttl` seconds after they were fetched, and the least recently used entry is evicted once more
+    than `max_size` forms are cached. If `persist_dir` is set, fetched definitions are also written there and
+    reused (subject to the same TTL) by later processes.
+
+    Forms are built with `factory(form_id)`, which fetches the definition, or `factory(form_id, json_data=...)`,
+    which builds it from a persisted definition. Both are satisfied by `FormstackForm`.
+    """
+
+    def __init__(self, factory: typing.Callable, max_size: int = 128, ttl: float = 3600,
+                 persist_dir: str = None):
+        self.factory = factory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist_dir = persist_dir
+        self._entries: 'collections.OrderedDict[int, typing.Tuple[typing.Any, float]]' = collections.OrderedDict()
+        self._lock = threading.RLock()
+        # The lock held while loading each form, and the number of threads holding or waiting for it
+        self._load_locks: typing.Dict[int, typing.Tuple[threading.Lock, int]] = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, max_size: int = None, ttl: float = None, persist_dir: str = None) -> None:
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            if ttl is not None:
+                self.ttl = ttl
+            if persist_dir is not None:
+                self.persist_dir = persist_dir
+            self._evict()
+
+    def _expired(self, fetched_at: float) -> bool:
+        return self.ttl is not None and time.time() - fetched_at > self.ttl
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_size:
+            form_id, _ = self._entries.popitem(last=False)
+            logger.debug(f'Evicted form {form_id} from the form cache')
+
+    def peek(self, form_id) -> typing.Any:
+        """
+        Returns the cached form, or None if it is not cached (or has expired). Never fetches.
+        """
+        form_id = int(form_id)
+        with self._lock:
+            entry = self._entries.get(form_id)
+            if entry is None or self._expired(entry[1]):
+                return None
+            self._entries.move_to_end(form_id)
+            return entry[0]
+
+    def get(self, form_id) -> typing.Any:
+        """
+        Returns the cached form, fetching it (or loading it from `persist_dir`) if it is not cached or has expired.
+        Concurrent callers asking for the same uncached form share a single fetch.
+        """
+        form_id = int(form_id)
+        form = self.peek(form_id)
+        if form is not None:
+            with self._lock:
+                self.hits += 1
+            return form
+
+        # Each load lock is kept only while threads are loading (or waiting to load) its form
+        with self._lock:
+            load_lock, waiting = self._load_locks.get(form_id, (None, 0))
+            load_lock = load_lock or threading.Lock()
+            self._load_locks[form_id] = (load_lock, waiting + 1)
+        try:
+            with load_lock:
+                # Another thread may have loaded the form while this one waited for the lock
+                form = self.peek(form_id)
+                if form is not None:
+                    with self._lock:
+                        self.hits += 1
+                    return form
+
+                with self._lock:
+                    self.misses += 1
+                form, fetched_at = self._load_persisted(form_id)
+                if form is None:
+                    form, fetched_at = self.factory(form_id), time.time()
+                    self._persist(form_id, form, fetched_at)
+                self._store(form_id, form, fetched_at)
+                return form
+        finally:
+            with self._lock:
+                _, waiting = self._load_locks[form_id]
+                if waiting > 1:
+                    self._load_locks[form_id] = (load_lock, waiting - 1)
+                else:
+                    del self._load_locks[form_id]
+
+    def put(self, form, fetched_at: float = None) -> None:
+        """
+        Adds an already fetched form to the cache, replacing any cached copy.
+        """
+        fetched_at = fetched_at if fetched_at is not None else time.time()
+        self._store(int(form.form_id), form, fetched_at)
+        self._persist(int(form.form_id), form, fetched_at)
+
+    def _store(self, form_id: int, form, fetched_at: float) -> None:
+        with self._lock:
+            self._entries[form_id] = (form, fetched_at)
+            self._entries.move_to_end(form_id)
+            self._evict()
+
+    def invalidate(self, form_id) -> None:
+        """
+        Removes a form from the cache (and from `persist_dir`), so that it is fetched again on next use.
+        """
+        form_id = int(form_id)
+        with self._lock:
+            self._entries.pop(form_id, None)
+        path = self._path(form_id)
+        if path is not None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Not persisted, or already removed by another thread or process
+                pass
+
+    def clear(self) -> None:
+        with self._lock:
+            for form_id in list(self._entries):
+                self.invalidate(form_id)
+            self._entries.clear()
+
+    def _path(self, form_id: int) -> typing.Optional[str]:
+        if not self.persist_dir:
+            return None
+        return os.path.join(self.persist_dir, f'form_{form_id}.json')
+
+    def _load_persisted(self, form_id: int) -> typing.Tuple[typing.Any, typing.Optional[float]]:
+        path = self._path(form_id)
+        if path is None or not os.path.exists(path):
+            return None, None
+        try:
+            with open(path, encoding='utf-8') as f:
+                persisted = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Could not read cached form {form_id} from {path}: {e}')
+            return None, None
+        if self._expired(persisted['fetched_at']):
+            return None, None
+        logger.debug(f'Loaded form {form_id} from {path}')
+        return self.factory(form_id, json_data=persisted['json_data']), persisted['fetched_at']
+
+    def _persist(self, form_id: int, form, fetched_at: float) -> None:
+        path = self._path(form_id)
+        if path is None:
+            return
+        try:
+            os.makedirs(self.persist_dir, exist_ok=True)
+            # Written to a temporary file first so that other processes never read a partially written form
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'fetched_at': fetched_at, 'json_data': form.json_data}, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f'Could not persist form {form_id} to {path}: {e}')
@@ -0,0 +1,66 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import typing
+
+
+class FormstackSubmissionRecord:
+    """
+    A lightweight, read-only view of a submission's field values, keyed by integer field id.
+
+    This is the fast path for extracting fields: a lookup is a single dict access, where the equivalent
+    `get_data().loc[field_id].value` lookup builds and joins DataFrames first. Fields without a submitted value are
+    simply absent, so `get()` returns None for them (`get_data()` would give NaN).
+    """
+    __slots__ = ('submission_id', 'form_id', 'timestamp', '_values')
+
+    def __init__(self, submission_id: int, form_id: int, values: typing.Dict[int, typing.Any],
+                 timestamp: str = None):
+        self.submission_id = submission_id
+        self.form_id = form_id
+        # Formstack's own (Eastern time) timestamp string; see `FormstackSubmissionHelper.timestamp`
+        self.timestamp = timestamp
+        self._values = values
+
+    @classmethod
+    def from_json(cls, json_data: dict) -> 'FormstackSubmissionRecord':
+        data = json_data['data']
+        # Single submissions list their values, submission listings key them by field id
+        if isinstance(data, dict):
+            data = data.values()
+        return cls(int(json_data['id']), int(json_data['form']),
+                   {int(item['field']): item['value'] for item in data},
+                   timestamp=json_data.get('timestamp'))
+
+    def __getitem__(self, field_id: int) -> typing.Any:
+        return self._values[field_id]
+
+    def get(self, field_id: int, default: typing.Any = None) -> typing.Any:
+        return self._values.get(field_id, default)
+
+    def __contains__(self, field_id: int) -> bool:
+        return field_id in self._values
+
+    def __iter__(self) -> typing.Iterator[int]:
+        return iter(self._values)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def items(self) -> typing.ItemsView[int, typing.Any]:
+        return self._values.items()
+
+    def __repr__(self):
+        return f'Formstack submission #{self.submission_id} to form #{self.form_id} ({len(self)} values)'
+
+    def to_dataframe(self, fields=None):
+        """
+        Returns the values as a DataFrame indexed by field id, joined onto the form's `fields` table if given. This is
+        the same shape as `FormstackSubmissionHelper.get_data()`.
+        """
+        import pandas as pd
+
+        data = pd.DataFrame({'value': list(self._values.values())},
+                            index=pd.Index(list(self._values.keys()), name='field', dtype=int))
+        if fields is None:
+            return data
+        return fields.join(data)
@@ -0,0 +1,196 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Records Formstack API traffic to disk and replays it, so that the ingest path can be run, tested and benchmarked
+offline.
+
+A cassette is a directory holding one JSON file per distinct request (method, endpoint, query parameters and body),
+with the response Formstack gave it. `recording()` captures every `FormstackUtility` request made within it, and
+`replaying()` serves them back without touching the network, optionally with simulated latency. Setting
+FORMSTACK_CASSETTE_MODE to 'record' or 'replay' and FORMSTACK_CASSETTE_DIR to a directory does the same for the whole
+process.
+
+`AsyncFormstackUtility` sends its requests through the recording or replaying transport too, so they are in the same
+cassette. The access token is never written to a cassette.
+"""
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import typing
+
+import requests
+from decouple import config
+from requests.structures import CaseInsensitiveDict
+
+from .formstack_transport import FormstackError, FormstackHTTPError, FormstackTransport, error_for_response, \
+    get_transport, notify_request_listeners, set_transport
+
+logger = logging.getLogger(__name__)
+
+# Response headers worth keeping; the rest (cookies, request ids, ...) only make cassettes noisy
+_RECORDED_HEADERS = ('Content-Type', 'Retry-After')
+
+
+class FormstackReplayMissError(FormstackError):
+    """
+    Raised when replaying a request that is not in the cassette.
+    """
+    pass
+
+
+def request_key(method: str, endpoint: str, data: dict = None, params: dict = None) -> str:
+    """
+    :return: the name of the cassette file for a request. Requests that differ only in the order of their parameters
+        share a file.
+    """
+    canonical = json.dumps([method.upper(), endpoint.lstrip('/'), params or dict(), data], sort_keys=True,
+                           default=str)
+    digest = hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:16]
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', endpoint).strip('_')
+    return f'{method.lower()}_{slug}_{digest}.json'
+
+
+def _build_response(interaction: dict, url: str) -> requests.Response:
+    response = requests.Response()
+    response.status_code = interaction['status_code']
+    response.headers = CaseInsensitiveDict(interaction.get('headers', dict()))
+    response._content = interaction['body'].encode('utf-8')
+    response.encoding = 'utf-8'
+    response.url = url
+    return response
+
+
+class RecordingTransport:
+    """
+    Sends requests through another transport and writes each response (including error responses) to the cassette.
+    A request made more than once is recorded with its latest response.
+    """
+
+    def __init__(self, cassette_dir: str, transport: FormstackTransport = None):
+        self.cassette_dir = cassette_dir
+        self.transport = transport if transport is not None else get_transport()
+        os.makedirs(cassette_dir, exist_ok=True)
+
+    def __getattr__(self, name):
+        # Everything but `request` (base_url, timeouts, ...) is the wrapped transport's
+        return getattr(self.transport, name)
+
+    def _record(self, method: str, endpoint: str, data: typing.Optional[dict], params: typing.Optional[dict],
+                response: requests.Response) -> None:
+        interaction = {
+            'method': method.upper(),
+            'endpoint': endpoint,
+            'params': params,
+            'data': data,
+            'status_code': response.status_code,
+            'headers': {name: response.headers[name] for name in _RECORDED_HEADERS if name in response.headers},
+            'body': response.content.decode('utf-8'),
+        }
+        path = os.path.join(self.cassette_dir, request_key(method, endpoint, data, params))
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump(interaction, file, indent=1, sort_keys=True, default=str)
+        os.replace(temporary_path, path)
+
+    def request(self, method: str, endpoint: str, data: dict = None, params: dict = None) -> requests.Response:
+        try:
+            response = self.transport.request(method, endpoint, data=data, params=params)
+        except FormstackHTTPError as e:
+            if e.response is not None:
+                self._record(method, endpoint, data, params, e.response)
+            raise
+        self._record(method, endpoint, data, params, response)
+        return response
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class ReplayTransport:
+    """
+    Serves responses from a cassette instead of the network. Error responses are raised as the same
+    `FormstackHTTPError` subclasses as live ones, without retries.
+    :param latency: seconds to wait before each response, to simulate the network.
+    :param jitter: a random extra wait of up to this many seconds per response.
+    """
+
+    def __init__(self, cassette_dir: str, latency: float = 0.0, jitter: float = 0.0, base_url: str = None):
+        if not os.path.isdir(cassette_dir):
+            raise FileNotFoundError(f'No Formstack cassette at {cassette_dir}')
+        self.cassette_dir = cassette_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.base_url = base_url if base_url is not None else config('FORMSTACK_API_BASE_URL', default='')
+        self.access_token = None
+        # The settings other clients (e.g. `AsyncFormstackUtility`) read from a `FormstackTransport`. Replayed
+        # responses are never retried.
+        self.timeout = (5.0, 30.0)
+        self.max_retries = 0
+        self.backoff_factor = 0.0
+        self.max_backoff = 0.0
+        self.scheduler = None
+        self.requests = 0
+        self._interactions: typing.Dict[str, dict] = dict()
+        self._lock = threading.Lock()
+
+    def _interaction(self, key: str) -> typing.Optional[dict]:
+        with self._lock:
+            if key not in self._interactions:
+                path = os.path.join(self.cassette_dir, key)
+                if not os.path.exists(path):
+                    return None
+                with open(path, encoding='utf-8') as file:
+                    self._interactions[key] = json.load(file)
+            self.requests += 1
+            return self._interactions[key]
+
+    def request(self, method: str, endpoint: str, data: dict = None, params: dict = None) -> requests.Response:
+        key = request_key(method, endpoint, data, params)
+        interaction = self._interaction(key)
+        if interaction is None:
+            raise FormstackReplayMissError(f'Formstack {method.upper()} {endpoint} with params {params} is not in '
+                                           f'the cassette at {self.cassette_dir} ({key})')
+
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+        response = _build_response(interaction, self.base_url + endpoint)
+        notify_request_listeners(method.upper(), endpoint, response.status_code, delay, len(response.content))
+        if not response.ok:
+            raise error_for_response(response, method.upper(), endpoint)
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+@contextlib.contextmanager
+def _using(transport) -> typing.Iterator:
+    previous = set_transport(transport)
+    try:
+        yield transport
+    finally:
+        set_transport(previous)
+
+
+def recording(cassette_dir: str, transport: FormstackTransport = None) -> typing.ContextManager[RecordingTransport]:
+    """
+    Records every `FormstackUtility` request made within the block to `cassette_dir`.
+    :param transport: the transport to send requests with. Defaults to the shared transport.
+    """
+    return _using(RecordingTransport(cassette_dir, transport))
+
+
+def replaying(cassette_dir: str, latency: float = 0.0, jitter: float = 0.0) -> typing.ContextManager[ReplayTransport]:
+    """
+    Serves every `FormstackUtility` request made within the block from `cassette_dir`. See `ReplayTransport`.
+    """
+    return _using(ReplayTransport(cassette_dir, latency=latency, jitter=jitter))
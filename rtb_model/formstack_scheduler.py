@@ -0,0 +1,230 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Schedules Formstack API requests within the access token's rate limit.
+
+Every request takes a token from a bucket, so a long backfill runs at the quota instead of exhausting it and failing
+with 429s. The bucket holds at most `burst` tokens and refills at `rate_limit - burst` tokens per `period`, so that no
+`period` ever sees more than `rate_limit` requests, even one starting with a full bucket. The bucket never holds more
+tokens than the X-RateLimit-Remaining header of the latest response says are left, and a 429 empties it and pauses
+every request for the response's Retry-After.
+
+Requests that cannot go yet queue rather than fail. Interactive requests are served before background ones, and
+background requests leave `interactive_reserve` of the bucket untouched, so an interactive call is never stuck behind
+a sync. The number of requests in flight adapts to the API: it grows by one for every `concurrency` successful
+requests and halves whenever Formstack throttles or fails (429, 5xx or a connection error), within
+`min_concurrency` and `max_concurrency`.
+
+Requests are interactive unless made within `background()`, as `FormstackSync` runs are.
+"""
+
+import asyncio
+import contextlib
+import enum
+import heapq
+import itertools
+import logging
+import threading
+import time
+import typing
+
+from .formstack_transport import FormstackError
+
+logger = logging.getLogger(__name__)
+
+# How long a queued request waits before checking again when it is waiting for others rather than for the bucket
+_QUEUE_WAIT = 0.05
+
+
+class FormstackQueueTimeoutError(FormstackError):
+    """
+    Raised when a request waits longer than its timeout to be sent.
+    """
+    pass
+
+
+class Priority(enum.IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+_local = threading.local()
+
+
+def current_priority() -> Priority:
+    return getattr(_local, 'priority', Priority.INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(value: Priority) -> typing.Iterator[None]:
+    """
+    Gives the Formstack requests made by this thread within the block the given priority.
+    """
+    previous = current_priority()
+    _local.priority = Priority(value)
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def background() -> typing.ContextManager[None]:
+    """
+    Makes the Formstack requests made by this thread within the block background requests.
+    """
+    return priority(Priority.BACKGROUND)
+
+
+def _header_number(headers: typing.Mapping[str, str], name: str, number_type: typing.Callable[[str], typing.Any]):
+    try:
+        return number_type(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class RateLimitScheduler:
+    """
+    A token bucket and adaptive concurrency limit shared by the threads (and event loops) calling Formstack. See the
+    module documentation.
+    :param rate_limit: requests allowed per `period`. Replaced by the X-RateLimit-Limit header once one is seen.
+    :param period: seconds the rate limit applies to.
+    :param burst: most tokens the bucket holds, i.e. the most requests sent at once after a quiet spell.
+    :param interactive_reserve: fraction of the bucket that only interactive requests may take.
+    """
+
+    def __init__(self, rate_limit: int = 14400, period: float = 3600.0, burst: int = 60, max_concurrency: int = 10,
+                 min_concurrency: int = 1, initial_concurrency: int = None, interactive_reserve: float = 0.2):
+        self.rate_limit = rate_limit
+        self.period = period
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(initial_concurrency if initial_concurrency is not None else max_concurrency)
+        self.interactive_reserve = interactive_reserve
+        self.tokens = float(burst)
+        self.in_flight = 0
+        self.remaining: typing.Optional[int] = None
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+        self._waiting: typing.List[typing.Tuple[int, int]] = list()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def __repr__(self):
+        return f'Formstack scheduler: {self.tokens:.1f}/{self.burst} tokens, {self.in_flight} of ' \
+               f'{int(self.concurrency)} requests in flight, {len(self._waiting)} queued'
+
+    @property
+    def rate(self) -> float:
+        """Tokens added per second."""
+        return max(self.rate_limit - self.burst, 1) / self.period
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.tokens + (now - self._updated) * self.rate, float(self.burst))
+        self._updated = now
+
+    def _try_take(self, ticket: typing.Tuple[int, int]) -> typing.Optional[float]:
+        """
+        Takes a token and a slot for the request holding `ticket` if it is first in the queue and both are free.
+        :return: None if the request may go, otherwise how long to wait before trying again.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if self._waiting[0] != ticket or self.in_flight >= int(self.concurrency):
+            return _QUEUE_WAIT
+        if now < self.paused_until:
+            return self.paused_until - now
+        needed = 1.0 + (self.interactive_reserve * self.burst if ticket[0] > Priority.INTERACTIVE else 0.0)
+        if self.tokens < needed:
+            return (needed - self.tokens) / self.rate
+        self.tokens -= 1.0
+        self.in_flight += 1
+        heapq.heappop(self._waiting)
+        self._condition.notify_all()
+        return None
+
+    def _enqueue(self, request_priority: typing.Optional[Priority]) -> typing.Tuple[int, int]:
+        ticket = (int(current_priority() if request_priority is None else request_priority), next(self._sequence))
+        heapq.heappush(self._waiting, ticket)
+        return ticket
+
+    def _dequeue(self, ticket: typing.Tuple[int, int]) -> None:
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+            self._condition.notify_all()
+
+    def acquire(self, request_priority: Priority = None, timeout: float = None) -> None:
+        """
+        Waits until a request may be sent, and counts it as in flight. Every `acquire` must be followed by a
+        `release`.
+        :param request_priority: defaults to the thread's `current_priority()`.
+        :param timeout: most seconds to wait. Waits for as long as it takes by default.
+        :raises FormstackQueueTimeoutError: if the request could not be sent within `timeout`.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            ticket = self._enqueue(request_priority)
+            try:
+                while True:
+                    wait = self._try_take(ticket)
+                    if wait is None:
+                        return
+                    if deadline is not None and time.monotonic() + wait > deadline:
+                        raise FormstackQueueTimeoutError(f'Formstack request could not be sent within {timeout}s')
+                    self._condition.wait(wait)
+            finally:
+                self._dequeue(ticket)
+
+    async def acquire_async(self, request_priority: Priority = None) -> None:
+        """
+        `acquire` for coroutines, waiting without blocking the event loop.
+        """
+        with self._condition:
+            ticket = self._enqueue(request_priority)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._try_take(ticket)
+                if wait is None:
+                    return
+                await asyncio.sleep(min(wait, _QUEUE_WAIT))
+        finally:
+            with self._condition:
+                self._dequeue(ticket)
+
+    def release(self, status_code: int = None, headers: typing.Mapping[str, str] = None) -> None:
+        """
+        Records the outcome of a request sent after `acquire`.
+        :param status_code: the response's status, or None if no response was received.
+        :param headers: the response's headers, for its X-RateLimit-Limit, X-RateLimit-Remaining and Retry-After.
+        """
+        headers = headers if headers is not None else dict()
+        rate_limit = _header_number(headers, 'X-RateLimit-Limit', int)
+        remaining = _header_number(headers, 'X-RateLimit-Remaining', int)
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            self._refill(now)
+            if rate_limit:
+                self.rate_limit = rate_limit
+            if remaining is not None:
+                # Requests still in flight have taken tokens the header does not yet count
+                self.remaining = remaining
+                self.tokens = min(self.tokens, float(remaining - self.in_flight))
+
+            if status_code == 429:
+                self.tokens = min(self.tokens, 0.0)
+                pause = _header_number(headers, 'Retry-After', float)
+                pause = pause if pause is not None else 1.0 / self.rate
+                self.paused_until = max(self.paused_until, now + pause)
+                self._decrease()
+                logger.warning(f'Formstack rate limit reached; pausing requests for {pause:.1f}s')
+            elif status_code is None or status_code >= 500:
+                self._decrease()
+            else:
+                self.concurrency = min(self.concurrency + 1.0 / self.concurrency, float(self.max_concurrency))
+            self._condition.notify_all()
+
+    def _decrease(self) -> None:
+        self.concurrency = max(self.concurrency / 2.0, float(self.min_concurrency))
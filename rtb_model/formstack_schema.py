@@ -0,0 +1,269 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Brings the fields of a Formstack form in line with a desired set, in as few requests as possible.
+
+A desired field is a dict of `FormstackForm.add_field` arguments (`field_type`, `label`, `options`, `required`, ...),
+optionally with the `id` of the existing field it describes. Fields without an id are matched to existing fields by
+label, ignoring case and surrounding whitespace. `plan_schema` compares each desired field with its match in the form
+definition, on the arguments it gives only, and plans
+
+- an add for each desired field without a match,
+- an update of only the differing arguments for each field that differs, and
+- a delete for each existing field (other than sections) that is not desired, if `delete` is set.
+
+`sync_schema` sends the planned updates and deletes concurrently, through the shared transport, so they stay within
+the rate limit (see `formstack_scheduler`), and refreshes the form definition once at the end rather than after every
+change. Formstack appends each added field to the end of the form, so adds are sent one at a time, in the order they
+are desired, alongside the rest. `SchemaPlan.describe()` lists the changes for a dry run. From the command line, with
+the desired fields in a JSON list:
+
+    python -m rtb_model.formstack_schema FORM_ID fields.json [--dry-run] [--delete-others] [--concurrency 8]
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import sys
+import typing
+
+from .formstack_utilities import FormstackForm, form_cache
+
+logger = logging.getLogger(__name__)
+
+# The key of each `add_field` argument in the field JSON Formstack returns, where it differs
+_FIELD_KEYS = {'field_type': 'type', 'default_value': 'default', 'read_only': 'readonly', 'unique': 'uniq',
+               'column_span': 'colspan'}
+_FLAGS = frozenset(('hide_label', 'description_callout', 'required', 'read_only', 'hidden', 'unique'))
+_NUMBERS = frozenset(('column_span', 'sort'))
+_ARGUMENTS = frozenset(('field_type', 'label', 'hide_label', 'description', 'description_callout', 'default_value',
+                        'options', 'options_values', 'required', 'read_only', 'hidden', 'unique', 'column_span',
+                        'sort', 'attributes', 'logic', 'calculation'))
+
+
+def _label_key(label) -> str:
+    return str(label if label is not None else '').strip().lower()
+
+
+def _options(field: dict, key: str) -> typing.List[str]:
+    # Formstack gives options as a list of {'label', 'value'} dicts, or as lines of text
+    options = field.get('options') or list()
+    if isinstance(options, str):
+        return options.splitlines()
+    return [str(option.get(key, '')) if isinstance(option, dict) else str(option) for option in options]
+
+
+def _normalise(argument: str, value) -> typing.Any:
+    if argument in _FLAGS:
+        return str(value).strip().lower() in ('1', 'true', 'yes')
+    if argument in _NUMBERS:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    if argument in ('options', 'options_values'):
+        return [str(option) for option in value or list()]
+    if argument in ('attributes', 'logic'):
+        return value or None
+    return str(value) if value is not None else ''
+
+
+def current_value(field: dict, argument: str) -> typing.Any:
+    """
+    :return: the value of an `add_field` argument in the JSON of an existing field, normalised for comparison.
+    """
+    if argument == 'options':
+        return _options(field, 'label')
+    if argument == 'options_values':
+        return _options(field, 'value')
+    return _normalise(argument, field.get(_FIELD_KEYS.get(argument, argument)))
+
+
+class FieldChange:
+    ADD = 'add'
+    UPDATE = 'update'
+    DELETE = 'delete'
+
+    def __init__(self, action: str, label: str, field_id: int = None, arguments: dict = None,
+                 differences: typing.Dict[str, typing.Tuple[typing.Any, typing.Any]] = None):
+        self.action = action
+        self.label = label
+        self.field_id = field_id
+        # The `add_field`/`update_field` arguments to send
+        self.arguments = arguments or dict()
+        # For updates, the current and desired value of each argument that differs
+        self.differences = differences or dict()
+        self.response: typing.Optional[dict] = None
+        self.error: typing.Optional[Exception] = None
+
+    def __repr__(self):
+        if self.action == self.ADD:
+            return f'+ add {self.label!r} ({self.arguments.get("field_type")})'
+        if self.action == self.DELETE:
+            return f'- delete #{self.field_id} {self.label!r}'
+        changes = ', '.join(f'{argument}: {before!r} -> {after!r}' for argument, (before, after)
+                            in self.differences.items())
+        return f'~ update #{self.field_id} {self.label!r}: {changes}'
+
+
+class SchemaPlan:
+    def __init__(self, form_id: int, changes: typing.List[FieldChange], unchanged: int):
+        self.form_id = form_id
+        self.changes = changes
+        self.unchanged = unchanged
+
+    def __repr__(self):
+        counts = {action: sum(1 for change in self.changes if change.action == action)
+                  for action in (FieldChange.ADD, FieldChange.UPDATE, FieldChange.DELETE)}
+        return f'Schema of form #{self.form_id}: {counts[FieldChange.ADD]} to add, ' \
+               f'{counts[FieldChange.UPDATE]} to update, {counts[FieldChange.DELETE]} to delete, ' \
+               f'{self.unchanged} unchanged'
+
+    def __bool__(self):
+        return bool(self.changes)
+
+    @property
+    def failed(self) -> typing.List[FieldChange]:
+        return [change for change in self.changes if change.error is not None]
+
+    def describe(self) -> str:
+        """
+        :return: the plan and each of its changes, one per line.
+        """
+        return '\n'.join([repr(self)] + [repr(change) for change in self.changes])
+
+
+def plan_schema(form: FormstackForm, desired_fields: typing.Iterable[dict], delete: bool = False) -> SchemaPlan:
+    """
+    Compares the fields of a form with the desired fields. Makes no requests other than fetching the form definition
+    if it has not been fetched yet. See the module documentation.
+    :raises ValueError: if a desired field has an unknown argument, no id or label, or the id or label of another
+        desired field, or the id of a field the form does not have.
+    """
+    fields = form.get_fields()
+    existing = {int(field['id']): field for field in (form.json_data or dict()).get('fields', list())
+                if fields is not None and int(field['id']) in fields.index}
+    by_label = dict()
+    for field_id, field in existing.items():
+        by_label.setdefault(_label_key(field.get('label')), list()).append(field_id)
+
+    desired_fields = list(desired_fields)
+    # Fields named by id are not matched to other desired fields by label
+    named = {int(desired['id']) for desired in desired_fields if desired.get('id') is not None}
+    changes, matched, unchanged = list(), set(), 0
+    for desired in desired_fields:
+        desired = dict(desired)
+        field_id = desired.pop('id', None)
+        unknown = set(desired) - _ARGUMENTS
+        if unknown:
+            raise ValueError(f'Unknown field arguments {sorted(unknown)} for field {desired.get("label")!r}')
+
+        if field_id is not None:
+            field_id = int(field_id)
+            if field_id not in existing:
+                raise ValueError(f'Form {form.form_id} has no field #{field_id}')
+        else:
+            if desired.get('label') is None:
+                raise ValueError('Desired fields need an id or a label')
+            # Existing fields sharing a label are matched in order
+            candidates = [candidate for candidate in by_label.get(_label_key(desired['label']), list())
+                          if candidate not in matched and candidate not in named]
+            field_id = candidates[0] if candidates else None
+        if field_id in matched:
+            raise ValueError(f'Field #{field_id} ({desired.get("label")!r}) is desired more than once')
+
+        if field_id is None:
+            changes.append(FieldChange(FieldChange.ADD, desired.get('label'), arguments=desired))
+            continue
+        matched.add(field_id)
+        field = existing[field_id]
+        differences = dict()
+        for argument, value in desired.items():
+            before, after = current_value(field, argument), _normalise(argument, value)
+            if before != after:
+                differences[argument] = (before, after)
+        if differences:
+            changes.append(FieldChange(FieldChange.UPDATE, field.get('label'), field_id=field_id,
+                                       arguments={argument: desired[argument] for argument in differences},
+                                       differences=differences))
+        else:
+            unchanged += 1
+
+    if delete:
+        changes.extend(FieldChange(FieldChange.DELETE, field.get('label'), field_id=field_id)
+                       for field_id, field in existing.items() if field_id not in matched)
+    return SchemaPlan(int(form.form_id), changes, unchanged)
+
+
+def _apply(form: FormstackForm, change: FieldChange) -> None:
+    try:
+        # The form is refreshed and cached once every change is made, rather than dropped from the cache after each
+        if change.action == FieldChange.ADD:
+            change.response = form.add_field(**change.arguments, invalidate=False)
+        elif change.action == FieldChange.UPDATE:
+            change.response = form.update_field(change.field_id, **change.arguments, invalidate=False)
+        else:
+            change.response = form.delete_field(change.field_id, invalidate=False)
+    except Exception as e:
+        change.error = e
+        logger.error(f'Could not {change.action} field {change.label!r} of form {form.form_id}: {e}')
+
+
+def _apply_in_order(form: FormstackForm, changes: typing.List[FieldChange]) -> None:
+    for change in changes:
+        _apply(form, change)
+
+
+def sync_schema(form: FormstackForm, desired_fields: typing.Iterable[dict], delete: bool = False,
+                dry_run: bool = False, concurrency: int = 8) -> SchemaPlan:
+    """
+    Plans the changes with `plan_schema` and, unless `dry_run` is set, sends them `concurrency` at a time, with the
+    adds one after another in their desired order. A change that fails does not stop the others; its `error` is set,
+    and it is listed in the plan's `failed`.
+    :return: the plan, with the response to each change.
+    """
+    plan = plan_schema(form, desired_fields, delete=delete)
+    logger.info(plan.describe())
+    if dry_run or not plan:
+        return plan
+
+    adds = [change for change in plan.changes if change.action == FieldChange.ADD]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        futures = [executor.submit(_apply_in_order, form, adds)]
+        futures.extend(executor.submit(_apply, form, change) for change in plan.changes
+                       if change.action != FieldChange.ADD)
+        concurrent.futures.wait(futures)
+
+    try:
+        form.refresh()
+    except Exception:
+        # The cached definition is out of date, and is fetched again on next use
+        form_cache.invalidate(form.form_id)
+        raise
+    form_cache.put(form)
+    logger.info(f'Synced the schema of form {form.form_id}: {len(plan.changes) - len(plan.failed)} changes made, '
+                f'{len(plan.failed)} failed')
+    return plan
+
+
+def main(argv: typing.List[str] = None) -> int:
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(prog='python -m rtb_model.formstack_schema',
+                                     description=__doc__.split('\n\n')[0])
+    parser.add_argument('form_id', type=int)
+    parser.add_argument('fields', help='JSON file with a list of desired fields')
+    parser.add_argument('--dry-run', action='store_true', help='only print the planned changes')
+    parser.add_argument('--delete-others', action='store_true', help='delete the fields that are not listed')
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    with open(args.fields) as file:
+        desired_fields = json.load(file)
+    plan = sync_schema(FormstackForm(args.form_id), desired_fields, delete=args.delete_others,
+                       dry_run=args.dry_run, concurrency=args.concurrency)
+    return 1 if plan.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,264 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import datetime as dt
+import hashlib
+import itertools
+import json
+import logging
+import typing
+
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from . import base, formstack_scheduler, rollup
+from .answer import Answer
+from .bulk import bulk_insert_answers
+from .company import Company
+from .formstack_utilities import FormstackSubmissionHelper, form_cache, parse_formstack_time
+from .formstacksubmission import FormstackSubmission
+from .formstacksyncstate import FormstackSyncState
+from .onelineuser import OnlineUser
+from .upsert import upsert_companies, upsert_online_users
+
+logger = logging.getLogger(__name__)
+
+# Builds `Answer` rows for a submission, as `(response, measure, online_user, formstack_submission_id)` tuples. See
+# `bulk.AnswerWriter`.
+AnswerExtractor = typing.Callable[[FormstackSubmissionHelper], typing.Iterable[tuple]]
+
+
+def submission_hash(json_data: dict) -> str:
+    """
+    :return: a hash of the values of a submission, whether listed (keyed by field id) or fetched (as a list).
+        Formstack keeps a submission's timestamp when it is edited, so edits are detected by comparing hashes.
+    """
+    data = json_data.get('data') or list()
+    if isinstance(data, dict):
+        data = data.values()
+    values = sorted([str(item.get('field')), item.get('value')] for item in data)
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def is_unchanged(submission: typing.Optional[FormstackSubmission], json_data: dict) -> bool:
+    """
+    :return: whether a submission has been ingested, and has not been edited since.
+    """
+    return submission is not None and submission.data_hash == submission_hash(json_data)
+
+
+def record_submission(session: SQLAlchemySession, submission: typing.Optional[FormstackSubmission],
+                      helper: FormstackSubmissionHelper, timestamp: dt.datetime) -> None:
+    """
+    Records the ingested version of a submission in `FormstackSubmission`, given its existing row if any.
+    `date_last_update` is the submission's Formstack timestamp, whether the row is new or updated.
+    """
+    data_hash = submission_hash(helper.json_data)
+    if submission is None:
+        session.add(FormstackSubmission(id=helper.submission_id, date_submit=timestamp, date_last_update=timestamp,
+                                        data_hash=data_hash))
+    else:
+        submission.date_last_update = timestamp
+        submission.data_hash = data_hash
+
+
+def ingest_submission(session: SQLAlchemySession, formstack_submission: FormstackSubmissionHelper) -> None:
+    """
+    Writes the company and online users of an assessment submission, updating the rows of an earlier version of the
+    same submission if there are any. Users are matched to existing users of the company by email.
+    """
+    write_submission(session, Company.from_formstack(formstack_submission),
+                     OnlineUser.from_formstack(formstack_submission))
+
+
+def write_submission(session: SQLAlchemySession, company: Company, users: typing.Iterable[OnlineUser]) -> None:
+    """
+    Writes a company and its online users as built from a submission by their `from_formstack` constructors. See
+    `ingest_submission`.
+    """
+    company_id = upsert_companies(session, [company], commit=False)[company.submission_id]
+    upsert_online_users(session, [dict(_user_columns(user), company_id=company_id) for user in users], commit=False)
+
+
+def _user_columns(user: OnlineUser) -> dict:
+    return {column: getattr(user, column) for column in ('prefix', 'first_name', 'last_name', 'email', 'job_title')}
+
+
+def _records(frame) -> typing.List[dict]:
+    # Missing values become None rather than NaN, and NumPy scalars Python ones
+    return frame.astype(object).where(frame.notna(), None).to_dict('records')
+
+
+def write_submission_batch(session: SQLAlchemySession,
+                           helpers: typing.List[typing.Tuple[FormstackSubmissionHelper, dt.datetime]],
+                           ingested: typing.Dict[int, FormstackSubmission], answers: AnswerExtractor = None) -> None:
+    """
+    Writes the companies and online users of a batch of submissions to one form with one upsert statement each, and
+    records each submission in `FormstackSubmission` (see `record_submission`).
+    :param helpers: the submissions, each with its Formstack timestamp.
+    :param ingested: the `FormstackSubmission` rows already in the database for any of the submissions.
+    :param answers: builds the `Answer` rows of a submission. If given, the submissions' existing answers are
+        replaced with these.
+
+    The answer counts of the companies written are rebuilt (see `rollup`), as part of the same transaction.
+    """
+    submissions = [helper for helper, _ in helpers]
+    company_ids = upsert_companies(session, _records(Company.rows_from_formstack(submissions)), commit=False)
+    users = _records(OnlineUser.rows_from_formstack(submissions))
+    for user in users:
+        user['company_id'] = company_ids[user.pop('submission_id')]
+    upsert_online_users(session, users, commit=False)
+
+    for helper, timestamp in helpers:
+        record_submission(session, ingested.get(helper.submission_id), helper, timestamp)
+    session.flush()
+
+    if answers is not None:
+        session.query(Answer).filter(Answer.formstack_submission_id.in_(
+            [helper.submission_id for helper in submissions])).delete(synchronize_session=False)
+        bulk_insert_answers(session, itertools.chain.from_iterable(answers(helper) for helper in submissions),
+                            commit=False)
+    rollup.refresh_answer_counts(session, company_ids.values())
+
+
+def ingest_submission_batch(session: SQLAlchemySession,
+                            helpers: typing.List[typing.Tuple[FormstackSubmissionHelper, dt.datetime]],
+                            ingested: typing.Dict[int, FormstackSubmission],
+                            answers: AnswerExtractor = None) -> typing.List[int]:
+    """
+    `write_submission_batch` in a savepoint. If the batch fails, its submissions are written one at a time, so that
+    one bad submission does not hold back the rest. Nothing is committed.
+    :return: the ids of the submissions that could not be written.
+    """
+    if not helpers:
+        return list()
+    try:
+        with session.begin_nested():
+            write_submission_batch(session, helpers, ingested, answers=answers)
+        return list()
+    except Exception as e:
+        if len(helpers) == 1:
+            logger.exception(f'Could not ingest submission {helpers[0][0].submission_id}: {e}')
+            return [helpers[0][0].submission_id]
+        logger.warning(f'Could not ingest a batch of {len(helpers)} submissions ({e}); retrying them one by one')
+    return list(itertools.chain.from_iterable(ingest_submission_batch(session, [helper], ingested, answers=answers)
+                                              for helper in helpers))
+
+
+class SyncResult:
+    def __init__(self, form_id: int):
+        self.form_id = form_id
+        self.new = 0
+        self.updated = 0
+        self.skipped = 0
+        self.failed: typing.List[int] = list()
+        self.watermark: typing.Optional[dt.datetime] = None
+
+    def __repr__(self):
+        return f'Sync of form #{self.form_id}: {self.new} new, {self.updated} updated, {self.skipped} skipped, ' \
+               f'{len(self.failed)} failed. Ingested up to {self.watermark}'
+
+
+class FormstackSync:
+    """
+    Incrementally ingests the submissions to a form.
+
+    Each run lists only the submissions made since the form's watermark (less `overlap`, to allow for clock skew
+    between Formstack and the database), oldest first. Submissions already ingested whose data has not changed (see
+    `submission_hash`) are skipped; the rest are passed to `ingest` and recorded in `FormstackSubmission`.
+
+    Formstack lists submissions by the time they were made, and keeps that time when a submission is edited, so an
+    incremental run only sees edits to submissions made within `overlap` of the watermark. Edits to older
+    submissions are ingested by a `full` run, a `backfill.Backfill` or the webhook receiver.
+
+    Every batch of submissions is committed together with the watermark it reaches, and with the rebuilt answer
+    counts of the companies it wrote (see `rollup`), so a run that is interrupted resumes from the last committed
+    batch. The watermark never moves past a submission that failed to ingest, so failures are retried on the next run.
+    """
+
+    def __init__(self, form_id: int,
+                 ingest: typing.Callable[[SQLAlchemySession, FormstackSubmissionHelper], None] = ingest_submission,
+                 session_factory: typing.Callable[[], SQLAlchemySession] = None,
+                 overlap: dt.timedelta = dt.timedelta(hours=1), batch_size: int = 100):
+        self.form_id = int(form_id)
+        self.ingest = ingest
+        self.session_factory = session_factory or base.Session
+        self.overlap = overlap
+        self.batch_size = batch_size
+
+    def run(self, full: bool = False) -> SyncResult:
+        """
+        Ingests every new or changed submission.
+        :param full: list every submission to the form rather than those since the watermark, to pick up edits to
+            older submissions. Unchanged submissions are still skipped.
+        :return: the counts of new, updated, skipped and failed submissions.
+        """
+        result = SyncResult(self.form_id)
+        session = self.session_factory()
+        # Syncs give way to interactive Formstack requests
+        with formstack_scheduler.background():
+            try:
+                state = session.query(FormstackSyncState).get(self.form_id)
+                if state is None:
+                    state = FormstackSyncState(form_id=self.form_id)
+                    session.add(state)
+                result.watermark = state.watermark
+
+                min_time = state.watermark - self.overlap if state.watermark is not None and not full else None
+                logger.info(f'Syncing form {self.form_id} from {min_time or "the beginning"}')
+
+                form = form_cache.get(self.form_id)
+                batch = list()
+                for payload in form.iter_submissions(data=True, min_time=min_time, per_page=self.batch_size):
+                    batch.append(payload)
+                    if len(batch) >= self.batch_size:
+                        self._process_batch(session, form, state, batch, result)
+                        batch = list()
+                self._process_batch(session, form, state, batch, result)
+
+                state.date_last_run = dt.datetime.utcnow()
+                session.commit()
+            finally:
+                session.close()
+
+        logger.info(result)
+        return result
+
+    def _process_batch(self, session: SQLAlchemySession, form, state: FormstackSyncState,
+                       batch: typing.List[dict], result: SyncResult) -> None:
+        ids = [int(payload['id']) for payload in batch]
+        written = list()
+        ingested = {submission.id: submission for submission in
+                    session.query(FormstackSubmission).filter(FormstackSubmission.id.in_(ids))} if ids else dict()
+
+        for payload in batch:
+            submission_id = int(payload['id'])
+            timestamp = parse_formstack_time(payload['timestamp']).replace(tzinfo=None)
+            submission = ingested.get(submission_id)
+
+            if is_unchanged(submission, payload):
+                result.skipped += 1
+            else:
+                helper = FormstackSubmissionHelper(submission_id, json_data=dict(payload, form=self.form_id),
+                                                   form=form)
+                try:
+                    with session.begin_nested():
+                        self.ingest(session, helper)
+                        record_submission(session, submission, helper, timestamp)
+                except Exception as e:
+                    logger.exception(f'Could not ingest submission {submission_id}: {e}')
+                    result.failed.append(submission_id)
+                    continue
+
+                written.append(submission_id)
+                if submission is None:
+                    result.new += 1
+                else:
+                    result.updated += 1
+
+            if not result.failed and (state.watermark is None or timestamp > state.watermark):
+                state.watermark = timestamp
+
+        result.watermark = state.watermark
+        if written:
+            rollup.refresh_answer_counts(session, [company_id for company_id, in session.query(Company.id)
+                                                   .filter(Company.submission_id.in_(written))])
+        session.commit()
@@ -0,0 +1,309 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from decouple import config
+
+logger = logging.getLogger(__name__)
+
+# Called with the method, endpoint, status code (None if no response was received), seconds taken and response size
+# in bytes of every attempt at a Formstack request. See `add_request_listener`.
+RequestListener = typing.Callable[[str, str, typing.Optional[int], float, int], None]
+_request_listeners: typing.List[RequestListener] = list()
+
+IDEMPOTENT_METHODS = frozenset(('GET', 'PUT', 'DELETE', 'HEAD', 'OPTIONS'))
+RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+
+
+class FormstackError(Exception):
+    pass
+
+
+class FormstackHTTPError(FormstackError):
+    def __init__(self, status_code: int, method: str, endpoint: str, error: str = None, response=None):
+        self.status_code = status_code
+        self.method = method
+        self.endpoint = endpoint
+        self.error = error
+        self.response = response
+        super().__init__(f'Formstack {method} {endpoint} failed with HTTP {status_code}'
+                         + (f': {error}' if error else ''))
+
+
+class FormstackAuthError(FormstackHTTPError):
+    pass
+
+
+class FormstackNotFoundError(FormstackHTTPError):
+    pass
+
+
+class FormstackRateLimitError(FormstackHTTPError):
+    pass
+
+
+class FormstackServerError(FormstackHTTPError):
+    pass
+
+
+def error_for_status(status_code: int, method: str, endpoint: str, error: str = None,
+                     response=None) -> FormstackHTTPError:
+    if status_code in (401, 403):
+        error_class = FormstackAuthError
+    elif status_code == 404:
+        error_class = FormstackNotFoundError
+    elif status_code == 429:
+        error_class = FormstackRateLimitError
+    elif status_code >= 500:
+        error_class = FormstackServerError
+    else:
+        error_class = FormstackHTTPError
+    return error_class(status_code, method, endpoint, error=error, response=response)
+
+
+def error_for_response(response: requests.Response, method: str, endpoint: str) -> FormstackHTTPError:
+    try:
+        error = response.json().get('error')
+    except (ValueError, AttributeError):
+        error = None
+    return error_for_status(response.status_code, method, endpoint, error=error, response=response)
+
+
+def add_request_listener(listener: RequestListener) -> None:
+    """
+    Calls `listener` after every attempt at a Formstack request, synchronous or asynchronous, e.g. to record metrics.
+    """
+    if listener not in _request_listeners:
+        _request_listeners.append(listener)
+
+
+def remove_request_listener(listener: RequestListener) -> None:
+    if listener in _request_listeners:
+        _request_listeners.remove(listener)
+
+
+def notify_request_listeners(method: str, endpoint: str, status_code: typing.Optional[int], seconds: float,
+                             size: int) -> None:
+    for listener in list(_request_listeners):
+        try:
+            listener(method, endpoint, status_code, seconds, size)
+        except Exception:
+            logger.exception(f'Formstack request listener {listener!r} failed')
+
+
+class FormstackTransport:
+    """
+    Sends requests to the Formstack API over pooled keep-alive connections.
+
+    A single connection pool is shared by every thread; each thread gets its own `requests.Session` mounted on that
+    pool, as sessions themselves are not thread-safe. Failed requests are retried with exponential backoff when the
+    response is a 429 or 5xx (5xx and connection errors only for idempotent methods), and raise a
+    `FormstackHTTPError` subclass once retries are exhausted. With a `scheduler`, every attempt first waits for the
+    scheduler to let it go, so requests stay within the API's rate limit (see `formstack_scheduler`).
+    """
+
+    def __init__(self, base_url: str, access_token: str, connect_timeout: float = 5.0, read_timeout: float = 30.0,
+                 max_retries: int = 3, backoff_factor: float = 0.5, max_backoff: float = 60.0,
+                 pool_maxsize: int = 10, scheduler=None):
+        self.base_url = base_url
+        self.access_token = access_token
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.pool_maxsize = pool_maxsize
+        # A `formstack_scheduler.RateLimitScheduler` that every attempt waits for, if any
+        self.scheduler = scheduler
+        self._local = threading.local()
+        self._adapter = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def adapter(self) -> HTTPAdapter:
+        # Rebuilt after a fork so that child processes never share sockets with their parent
+        with self._lock:
+            if self._adapter is None or self._pid != os.getpid():
+                self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0)
+                self._pid = os.getpid()
+            return self._adapter
+
+    @property
+    def session(self) -> requests.Session:
+        adapter = self.adapter
+        session = getattr(self._local, 'session', None)
+        if session is None or session.get_adapter(self.base_url) is not adapter:
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'Content-Type': 'application/json',
+                                    'Accept': 'application/json',
+                                    'Authorization': f'Bearer {self.access_token}'})
+            self._local.session = session
+        return session
+
+    def _backoff(self, attempt: int, response: typing.Optional[requests.Response] = None) -> float:
+        if response is not None and response.headers.get('Retry-After'):
+            try:
+                return min(float(response.headers['Retry-After']), self.max_backoff)
+            except ValueError:
+                pass
+        return min(self.backoff_factor * (2 ** attempt), self.max_backoff)
+
+    def _send(self, method: str, endpoint: str, body: typing.Optional[str],
+              params: typing.Optional[dict]) -> requests.Response:
+        if self.scheduler is not None:
+            self.scheduler.acquire()
+        response = None
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + endpoint, data=body, params=params,
+                                            timeout=self.timeout)
+            return response
+        finally:
+            if self.scheduler is not None:
+                if response is None:
+                    self.scheduler.release()
+                else:
+                    self.scheduler.release(response.status_code, response.headers)
+            notify_request_listeners(method, endpoint, response.status_code if response is not None else None,
+                                     time.perf_counter() - start, len(response.content) if response is not None else 0)
+
+    def request(self, method: str, endpoint: str, data: dict = None, params: dict = None) -> requests.Response:
+        """
+        Sends a request to the Formstack API.
+        :param method: HTTP method, e.g. 'GET'.
+        :param endpoint: endpoint relative to the API base URL, e.g. 'form/1234'.
+        :param data: JSON-serialisable request body.
+        :param params: query string parameters.
+        :return: the successful response.
+        :raises FormstackHTTPError: if Formstack responds with an error status once retries are exhausted.
+        :raises requests.RequestException: if the request could not be sent once retries are exhausted.
+        """
+        method = method.upper()
+        url = self.base_url + endpoint
+        body = json.dumps(data) if data is not None else None
+        idempotent = method in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            logger.debug(f'Sending {method} request to Formstack. Endpoint: {url}, params: {params}, data: {body}')
+            try:
+                response = self._send(method, endpoint, body, params)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f'Formstack {method} {endpoint} failed ({e}), retrying in {delay:.1f}s')
+            else:
+                logger.debug(f'Received response from Formstack: {response} w/ content: {response.content}')
+                if response.ok:
+                    return response
+                retryable = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUS_CODES)
+                if not retryable or attempt >= self.max_retries:
+                    raise error_for_response(response, method, endpoint)
+                # The scheduler holds back every request for as long as a 429 asks
+                delay = 0.0 if response.status_code == 429 and self.scheduler is not None \
+                    else self._backoff(attempt, response)
+                logger.warning(f'Formstack {method} {endpoint} returned HTTP {response.status_code}, '
+                               f'retrying in {delay:.1f}s')
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self) -> None:
+        with self._lock:
+            if self._adapter is not None and self._pid == os.getpid():
+                self._adapter.close()
+            self._adapter = None
+
+
+_transport: typing.Optional[FormstackTransport] = None
+_transport_lock = threading.Lock()
+
+
+def configure(**kwargs) -> None:
+    """
+    Replaces the shared transport with one built from the given `FormstackTransport` arguments. Arguments not given
+    fall back to the FORMSTACK_* environment variables.
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is not None:
+            _transport.close()
+        _transport = _build_transport(**kwargs)
+
+
+def _build_transport(**kwargs) -> FormstackTransport:
+    cassette_mode = config('FORMSTACK_CASSETTE_MODE', default='')
+    if cassette_mode:
+        # Imported here as the replay module is built on this one
+        from . import formstack_replay
+        cassette_dir = config('FORMSTACK_CASSETTE_DIR')
+        if cassette_mode == 'replay':
+            return formstack_replay.ReplayTransport(
+                cassette_dir, latency=config('FORMSTACK_REPLAY_LATENCY', default=0.0, cast=float))
+        if cassette_mode != 'record':
+            raise ValueError(f"FORMSTACK_CASSETTE_MODE must be 'record' or 'replay', not {cassette_mode!r}")
+        return formstack_replay.RecordingTransport(cassette_dir, _build_live_transport(**kwargs))
+    return _build_live_transport(**kwargs)
+
+
+def _build_live_transport(**kwargs) -> FormstackTransport:
+    options = dict(connect_timeout=config('FORMSTACK_CONNECT_TIMEOUT', default=5.0, cast=float),
+                   read_timeout=config('FORMSTACK_READ_TIMEOUT', default=30.0, cast=float),
+                   max_retries=config('FORMSTACK_MAX_RETRIES', default=3, cast=int),
+                   backoff_factor=config('FORMSTACK_BACKOFF_FACTOR', default=0.5, cast=float),
+                   pool_maxsize=config('FORMSTACK_POOL_MAXSIZE', default=10, cast=int))
+    options.update(kwargs)
+    if 'scheduler' not in options:
+        options['scheduler'] = _build_scheduler(options['pool_maxsize'])
+    if 'base_url' not in options:
+        options['base_url'] = config('FORMSTACK_API_BASE_URL')
+    if 'access_token' not in options:
+        # noinspection SpellCheckingInspection
+        options['access_token'] = config('FORMSTACK_API_ACCESS_TOKEN')
+    return FormstackTransport(**options)
+
+
+def _build_scheduler(max_concurrency: int):
+    rate_limit = config('FORMSTACK_RATE_LIMIT', default=14400, cast=int)
+    if rate_limit <= 0:
+        return None
+    # Imported here as the scheduler module is built on this one
+    from .formstack_scheduler import RateLimitScheduler
+    return RateLimitScheduler(rate_limit=rate_limit,
+                              period=config('FORMSTACK_RATE_PERIOD', default=3600.0, cast=float),
+                              burst=config('FORMSTACK_RATE_BURST', default=60, cast=int),
+                              max_concurrency=max_concurrency,
+                              interactive_reserve=config('FORMSTACK_INTERACTIVE_RESERVE', default=0.2, cast=float))
+
+
+def set_transport(transport: typing.Optional[FormstackTransport]) -> typing.Optional[FormstackTransport]:
+    """
+    Replaces the shared transport with `transport`, e.g. a `formstack_replay.ReplayTransport`, without closing the
+    current one.
+    :return: the transport that was replaced, so that it can be restored.
+    """
+    global _transport
+    with _transport_lock:
+        previous, _transport = _transport, transport
+        return previous
+
+
+def get_transport() -> FormstackTransport:
+    """
+    Returns the transport shared by every `FormstackUtility` call, building it from the environment on first use.
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = _build_transport()
+        return _transport
@@ -1,6 +1,5 @@
 #  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
 
-import requests
 import json
 import typing
 import logging
@@ -8,36 +7,61 @@ import datetime as dt
 import enum
 
 import pytz
-import pandas as pd
 
 
 from decouple import config
 
+from .formstack_cache import FormCache
+from .formstack_record import FormstackSubmissionRecord
+
+if typing.TYPE_CHECKING:
+    import pandas as pd
+
 logger = logging.getLogger(__name__)
 
-# noinspection SpellCheckingInspection
-API_ACCESS_TOKEN = config('FORMSTACK_API_ACCESS_TOKEN')
-API_BASE_URL = config('FORMSTACK_API_BASE_URL')
+
+FORMSTACK_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+FORMSTACK_TIMEZONE = pytz.timezone('US/Eastern')
+
+
+def parse_formstack_time(value: str) -> dt.datetime:
+    """
+    Parses a Formstack date/time string, which is in Eastern time, into a UTC datetime.
+    """
+    # Extract the datetime object from the `value` string
+    ts = dt.datetime.strptime(value, FORMSTACK_TIME_FORMAT)
+    # Localise to Eastern time (Formstack returns Eastern times)
+    ts = FORMSTACK_TIMEZONE.localize(ts)
+    # Convert to UTC time
+    return ts.astimezone(pytz.timezone('UTC'))
+
+
+def format_formstack_time(value: typing.Union[dt.datetime, str]) -> str:
+    """
+    Formats a datetime as a Formstack date/time string in Eastern time. Naive datetimes are taken to be UTC, as
+    elsewhere in this package. Strings are passed through unchanged.
+    """
+    if isinstance(value, str):
+        return value
+    if value.tzinfo is None:
+        value = pytz.timezone('UTC').localize(value)
+    return value.astimezone(FORMSTACK_TIMEZONE).strftime(FORMSTACK_TIME_FORMAT)
 
 
 class FormstackUtility:
     class CallMethod(enum.Enum):
-        POST = requests.post
-        PUT = requests.put
-        DELETE = requests.delete
-        GET = requests.get
+        POST = 'POST'
+        PUT = 'PUT'
+        DELETE = 'DELETE'
+        GET = 'GET'
 
     @staticmethod
-    def _send_request(call_method: CallMethod, endpoint: str, return_json_content: bool, data: dict = None):
-        headers = {'Content-Type': 'application/json',
-                   'Authorization': 'Bearer {0}'.format(API_ACCESS_TOKEN)}
-        if data is not None:
-            data = json.dumps(data)
-        logging.debug(f'Sending request to Formstack via method {call_method}. Endpoint: {API_BASE_URL + endpoint}, \n\theaders: {headers}, \n\tdata: {data}')
-        response = call_method(API_BASE_URL + endpoint, headers=headers, data=data)
-        logging.debug(f'Received response from Formstack: {response} w/ content: {response.content}')
-
-        # TODO: HTTP status code check and error handling on response
+    def _send_request(call_method: CallMethod, endpoint: str, return_json_content: bool, data: dict = None,
+                      params: dict = None):
+        # Imported here so that requests is only loaded once Formstack is called
+        from .formstack_transport import get_transport
+        response = get_transport().request(call_method.value, endpoint, data=data, params=params)
+
         if return_json_content:
             return json.loads(response.content.decode('utf-8'))
         else:
@@ -48,10 +72,11 @@ class FormstackUtility:
         return FormstackUtility.get(endpoint=endpoint, return_json_content=return_json_content)
 
     @staticmethod
-    def get(endpoint: str, return_json_content=True):
+    def get(endpoint: str, return_json_content=True, params: dict = None):
         return FormstackUtility._send_request(call_method=FormstackUtility.CallMethod.GET,
                                               endpoint=endpoint,
-                                              return_json_content=return_json_content)
+                                              return_json_content=return_json_content,
+                                              params=params)
 
     @staticmethod
     def post(endpoint: str, data: dict, return_json_content=True):
@@ -88,28 +113,95 @@ class FormstackForm:
         self._form_id = value
         self.refresh()
 
-    def __init__(self, form_id):
-        self.form_id = form_id
-
-    def get_fields(self) -> typing.Optional[pd.DataFrame]:
-        df = pd.DataFrame(self._json_data['fields'])
-        if len(df) > 0:
-            df['id'] = df['id'].astype(int)
-            return df[df['type'] != 'section'][['id', 'label', 'description']].set_index('id')
+    def __init__(self, form_id, json_data: dict = None):
+        if json_data is None:
+            self.form_id = form_id
         else:
-            return None
+            # Built from an already fetched form definition, so there is no need to refresh
+            self._form_id = form_id
+            self._json_data = json_data
+
+    @property
+    def json_data(self) -> dict:
+        return self._json_data
+
+    def get_fields(self) -> typing.Optional['pd.DataFrame']:
+        """
+        Returns the form's fields (other than sections), indexed by field id. The table is built once per refresh and
+        shared by every caller, so it must not be modified.
+        :return: a DataFrame of field labels and descriptions, or None if the form has no fields.
+        """
+        if self._fields is None:
+            import pandas as pd
+            df = pd.DataFrame(self._json_data['fields'])
+            if len(df) > 0:
+                df['id'] = df['id'].astype(int)
+                self._fields = df[df['type'] != 'section'][['id', 'label', 'description']].set_index('id')
+            else:
+                return None
+        return self._fields
 
     def refresh(self) -> None:
         logger.info(f'Refreshing form {self.form_id}')
         self._json_data = FormstackUtility.get(f'form/{self.form_id}', return_json_content=True)
+        self._fields = None
 
-    def get_all_submission_ids(self) -> typing.List[int]:
-        return [int(i['id']) for i in
-                FormstackUtility.get(f'form/{self.form_id}/submission'
-                                               , return_json_content=True)['submissions']]
-
-    def delete_field(self, field_id: int):
-        return FormstackUtility.delete(f'field/{field_id}', return_json_content=True)
+    @staticmethod
+    def submission_list_params(data: bool, min_time: typing.Union[dt.datetime, str, None],
+                               max_time: typing.Union[dt.datetime, str, None], per_page: int) -> dict:
+        params = {'per_page': per_page, 'sort': 'ASC', 'data': 'true' if data else 'false'}
+        if min_time is not None:
+            params['min_time'] = format_formstack_time(min_time)
+        if max_time is not None:
+            params['max_time'] = format_formstack_time(max_time)
+        return params
+
+    def iter_submissions(self, data: bool = False, min_time: typing.Union[dt.datetime, str] = None,
+                         max_time: typing.Union[dt.datetime, str] = None,
+                         per_page: int = 100) -> typing.Iterator[dict]:
+        """
+        Yields every submission to this form, oldest first, fetching one page at a time so that memory use does not
+        grow with the size of the form.
+        :param data: include the submitted field values in each submission.
+        :param min_time: only submissions made at or after this time. Naive datetimes are taken to be UTC.
+        :param max_time: only submissions made at or before this time. Naive datetimes are taken to be UTC.
+        :param per_page: submissions to request per page (Formstack allows at most 100).
+        :return: an iterator of submission JSON objects, as returned by Formstack.
+        """
+        params = self.submission_list_params(data=data, min_time=min_time, max_time=max_time, per_page=per_page)
+
+        page = 1
+        while True:
+            logger.debug(f'Fetching page {page} of submissions to form {self.form_id}')
+            response = FormstackUtility.get(f'form/{self.form_id}/submission', return_json_content=True,
+                                            params=dict(params, page=page))
+            submissions = response['submissions']
+            yield from submissions
+
+            if not submissions or page >= int(response.get('pages', page)):
+                return
+            page += 1
+
+    def iter_submission_ids(self, min_time: typing.Union[dt.datetime, str] = None,
+                            max_time: typing.Union[dt.datetime, str] = None,
+                            per_page: int = 100) -> typing.Iterator[int]:
+        for submission in self.iter_submissions(data=False, min_time=min_time, max_time=max_time,
+                                                per_page=per_page):
+            yield int(submission['id'])
+
+    def get_all_submission_ids(self, min_time: typing.Union[dt.datetime, str] = None,
+                               max_time: typing.Union[dt.datetime, str] = None) -> typing.List[int]:
+        return list(self.iter_submission_ids(min_time=min_time, max_time=max_time))
+
+    def delete_field(self, field_id: int, invalidate: bool = True):
+        """
+        :param invalidate: drop the form from `form_cache`. A caller making several changes may instead refresh the
+            form and put it in the cache once at the end, as `sync_schema` does.
+        """
+        response = FormstackUtility.delete(f'field/{field_id}', return_json_content=True)
+        if invalidate:
+            form_cache.invalidate(self.form_id)
+        return response
 
     def get_field(self, field_id: int):
         return FormstackUtility.get(f'field/{field_id}', return_json_content=True)
@@ -118,7 +210,7 @@ class FormstackForm:
                   description_callout: bool = None, default_value: str = None, options: typing.List[str] = None,
                   options_values: typing.List[str] = None, required: bool = None, read_only: bool = None,
                   hidden: bool = None, unique: bool = None, column_span: int = None, sort: int = None,
-                  attributes: dict = None, logic: dict = None, calculation: str = None):
+                  attributes: dict = None, logic: dict = None, calculation: str = None, invalidate: bool = True):
         data = {'field_type': field_type,
                 'label': label,
                 'hide_label': "1" if hide_label else "0",
@@ -138,14 +230,17 @@ class FormstackForm:
                 'calculation': calculation,
                 }
 
-        return FormstackUtility.post(f'form/{self.form_id}/field', data=data)
+        response = FormstackUtility.post(f'form/{self.form_id}/field', data=data)
+        if invalidate:
+            form_cache.invalidate(self.form_id)
+        return response
 
     def update_field(self, field_id: int, field_type: str = None, label: str = None,
                      hide_label: bool = None, description: str = None,
                   description_callout: bool = None, default_value: str = None, options: typing.List[str] = None,
                   options_values: typing.List[str] = None, required: bool = None, read_only: bool = None,
                   hidden: bool = None, unique: bool = None, column_span: int = None, sort: int = None,
-                  attributes: dict = None, logic: dict = None, calculation: str = None):
+                  attributes: dict = None, logic: dict = None, calculation: str = None, invalidate: bool = True):
         data = dict()
         if field_type is not None:
             data['field_type'] = field_type
@@ -182,13 +277,46 @@ class FormstackForm:
         if calculation is not None:
             data['calculation'] = calculation
 
-        return FormstackUtility.put(f'field/{field_id}', data=data)
+        response = FormstackUtility.put(f'field/{field_id}', data=data)
+        if invalidate:
+            form_cache.invalidate(self.form_id)
+        return response
+
+    def plan_schema(self, desired_fields: typing.Iterable[dict], delete: bool = False):
+        """
+        Returns the `formstack_schema.SchemaPlan` of the changes that would bring this form's fields in line with
+        `desired_fields`, without making them.
+        """
+        from .formstack_schema import plan_schema
+        return plan_schema(self, desired_fields, delete=delete)
+
+    def sync_schema(self, desired_fields: typing.Iterable[dict], delete: bool = False, dry_run: bool = False,
+                    concurrency: int = 8):
+        """
+        Adds, updates and deletes only the fields that differ from `desired_fields`, concurrently. See
+        `formstack_schema`.
+        :param desired_fields: `add_field` arguments for each field, optionally with the `id` of an existing field.
+        :param delete: also delete the fields that are not desired.
+        :param dry_run: only plan the changes.
+        :return: the `formstack_schema.SchemaPlan`.
+        """
+        from .formstack_schema import sync_schema
+        return sync_schema(self, desired_fields, delete=delete, dry_run=dry_run, concurrency=concurrency)
+
+
+# Shared by every submission helper in this process, so that each form definition is fetched once rather than once
+# per submission
+form_cache = FormCache(FormstackForm,
+                       max_size=config('FORMSTACK_FORM_CACHE_SIZE', default=128, cast=int),
+                       ttl=config('FORMSTACK_FORM_CACHE_TTL', default=3600, cast=float),
+                       persist_dir=config('FORMSTACK_FORM_CACHE_DIR', default=None))
 
 
 class FormstackSubmissionHelper:
     form = None
     _submission_id = None
     json_data = None
+    _record = None
 
     @property
     def portal_participant_email(self):
@@ -203,17 +331,41 @@ class FormstackSubmissionHelper:
         self._submission_id = int(value)
         self.refresh()
 
-    def __init__(self, submission_id: int):
-        self.submission_id = submission_id
+    def __init__(self, submission_id: int, json_data: dict = None, form: FormstackForm = None):
+        self.form = form
+        if json_data is None:
+            self.submission_id = submission_id
+        else:
+            # Built from an already fetched submission, so there is no need to refresh
+            self._submission_id = int(submission_id)
+            self._set_json_data(json_data)
 
     def refresh(self) -> None:
         logger.info(f'Refreshing submission {self.submission_id}')
-        self.json_data = FormstackUtility.get_formstack(f'submission/{self.submission_id}', return_json_content=True)
+        self._set_json_data(FormstackUtility.get_formstack(f'submission/{self.submission_id}',
+                                                           return_json_content=True))
 
-        if self.form is None or self.form.form_id != self.json_data['form']:
-            self.form = FormstackForm(self.json_data['form'])
+    def _set_json_data(self, json_data: dict) -> None:
+        if isinstance(json_data.get('data'), dict):
+            # Submission listings key values by field id; single submissions list them
+            json_data = dict(json_data, data=list(json_data['data'].values()))
+        self.json_data = json_data
+        self._record = None
 
-    def get_data(self, with_labels=True) -> pd.DataFrame:
+        if self.form is None or str(self.form.form_id) != str(self.json_data['form']):
+            self.form = form_cache.get(self.json_data['form'])
+
+    def get_record(self) -> FormstackSubmissionRecord:
+        """
+        Returns the submitted values keyed by field id. This is much cheaper than `get_data()` and is what the
+        `from_formstack` constructors use.
+        """
+        if self._record is None:
+            self._record = FormstackSubmissionRecord.from_json(self.json_data)
+        return self._record
+
+    def get_data(self, with_labels=True) -> 'pd.DataFrame':
+        import pandas as pd
         if with_labels:
             field_labels = self.form.get_fields()
             data = pd.DataFrame(self.json_data['data'])
@@ -238,10 +390,14 @@ class FormstackSubmissionHelper:
         Returns the timestamp of this submission in UTC.
         :return: timestamp of this submission in UTC.
         """
-        ts = self.json_data['timestamp']
-        # Extract the datetime object from the `ts` string
-        ts = dt.datetime.strptime(ts, '%Y-%m-%d %H:%M:%S')
-        # Localise to Eastern time (Formstack returns Eastern times)
-        ts = pytz.timezone('US/Eastern').localize(ts)
-        # Convert to UTC time
-        return ts.astimezone(pytz.timezone('UTC'))
+        return parse_formstack_time(self.json_data['timestamp'])
+
+
+def __getattr__(name: str):
+    # The API settings used to be read at import time, which failed without them; they are now read when first used.
+    if name == 'API_ACCESS_TOKEN':
+        # noinspection SpellCheckingInspection
+        return config('FORMSTACK_API_ACCESS_TOKEN')
+    if name == 'API_BASE_URL':
+        return config('FORMSTACK_API_BASE_URL')
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
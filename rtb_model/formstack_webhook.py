@@ -0,0 +1,411 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Ingests submissions pushed by Formstack webhooks, without fetching them again.
+
+A Formstack webhook POSTs the whole submission, as JSON or form data, keyed by field id (with 'Include field IDs')
+or by field label. `submission_from_webhook` turns such a payload into the JSON the API returns for a submission, so
+a `FormstackSubmissionHelper` can be built from it directly, with the form definition from `form_cache`. No request is
+made to Formstack for a submission, and only one for each form until its cache entry expires.
+
+`WebhookIngestor` queues payloads and writes them in micro-batches: a batch is written once it has `batch_size`
+payloads or its oldest payload has waited `max_delay` seconds. Each batch upserts its companies and users with one
+statement each, inserts the answers given by `answers` (if any), and is committed with its `FormstackSubmission`
+rows, so submissions already ingested by a `FormstackSync` (or an earlier webhook) with the same data are skipped,
+and vice versa. If a batch fails, its submissions are retried one at a time, so that one bad payload does not
+hold back the rest.
+
+`WebhookServer` receives webhooks over HTTP and hands them to an ingestor:
+
+    python -m rtb_model.formstack_webhook --port 8080
+
+Payloads must carry the form's handshake key if FORMSTACK_WEBHOOK_HANDSHAKE_KEY is set. The server listens on
+127.0.0.1 by default, and refuses to listen on any other address without a handshake key.
+"""
+
+import argparse
+import collections
+import datetime as dt
+import hmac
+import http.server
+import ipaddress
+import itertools
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+
+from decouple import config
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from . import base
+from .formstack_sync import AnswerExtractor, ingest_submission_batch, is_unchanged
+from .formstack_utilities import FormstackSubmissionHelper, form_cache, format_formstack_time, parse_formstack_time
+from .formstacksubmission import FormstackSubmission
+
+logger = logging.getLogger(__name__)
+
+# Keys of a webhook payload that are not field values
+_META_KEYS = frozenset(('FormID', 'UniqueID', 'HandshakeKey', 'timestamp'))
+
+
+class WebhookPayloadError(ValueError):
+    pass
+
+
+def _field_value(value) -> typing.Any:
+    # Sub-fields (e.g. of a name) are sent as a dict; the API gives them as 'key = value' lines
+    if isinstance(value, dict):
+        return '\n'.join(f'{key} = {sub_value}' for key, sub_value in value.items())
+    if isinstance(value, list):
+        return '\n'.join(str(item) for item in value)
+    return value
+
+
+def parse_webhook_body(body: bytes, content_type: str) -> dict:
+    """
+    Decodes the body of a webhook request, sent as JSON or as form data. Form data sub-fields, e.g. 'name[first]',
+    are gathered into a dict as they are in JSON payloads.
+    """
+    if content_type.split(';')[0].strip() == 'application/json':
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError as e:
+            raise WebhookPayloadError(f'Webhook body is not valid JSON: {e}')
+        if not isinstance(payload, dict):
+            raise WebhookPayloadError('Webhook body is not a JSON object')
+        return payload
+
+    payload = dict()
+    for key, value in urllib.parse.parse_qsl(body.decode('utf-8'), keep_blank_values=True):
+        if key.endswith(']') and '[' in key:
+            key, sub_key = key[:-1].split('[', 1)
+            payload.setdefault(key, dict())[sub_key] = value
+        else:
+            payload[key] = value
+    return payload
+
+
+def submission_from_webhook(payload: dict, form=None) -> dict:
+    """
+    Converts a webhook payload to the JSON the API returns for a submission.
+    :param form: the submission's `FormstackForm`, to look up fields keyed by label. Defaults to the cached form.
+    :raises WebhookPayloadError: if the payload has no form or submission id, or a key that is not a field.
+    """
+    if isinstance(payload.get('data'), (list, dict)) and 'id' in payload and 'form' in payload:
+        # Already in the API's format
+        return payload
+    try:
+        form_id, submission_id = int(payload['FormID']), int(payload['UniqueID'])
+    except (KeyError, TypeError, ValueError):
+        raise WebhookPayloadError('Webhook payload has no FormID or UniqueID')
+
+    field_ids = dict()
+    if any(not str(key).isdigit() for key in payload if key not in _META_KEYS):
+        form = form if form is not None else form_cache.get(form_id)
+        fields = form.get_fields()
+        if fields is not None:
+            field_ids = {str(label).strip().lower(): field_id for field_id, label in fields['label'].items()}
+
+    data = list()
+    for key, value in payload.items():
+        if key in _META_KEYS:
+            continue
+        key = str(key)
+        field_id = int(key) if key.isdigit() else field_ids.get(key.strip().lower())
+        if field_id is None:
+            raise WebhookPayloadError(f'Form {form_id} has no field {key!r}')
+        data.append({'field': str(field_id), 'value': _field_value(value)})
+
+    # Webhooks are sent as the submission is made, so without a timestamp the time of receipt is close enough
+    timestamp = payload.get('timestamp') or format_formstack_time(dt.datetime.utcnow())
+    return {'id': str(submission_id), 'form': str(form_id), 'timestamp': timestamp, 'data': data}
+
+
+class WebhookResult:
+    def __init__(self):
+        self.received = 0
+        self.ingested = 0
+        self.skipped = 0
+        self.failed: typing.List[typing.Any] = list()
+        self.batches = 0
+
+    def __repr__(self):
+        return f'Webhooks: {self.received} received, {self.ingested} ingested in {self.batches} batches, ' \
+               f'{self.skipped} skipped, {len(self.failed)} failed'
+
+
+class WebhookIngestor:
+    """
+    Queues webhook payloads and writes them in micro-batches on a worker thread. See the module documentation.
+    :param answers: builds the `Answer` rows of a submission. Answers are only written if this is given; the answers
+        of a submission ingested before are replaced.
+    :param max_queue: most payloads queued at once; `submit` refuses any more.
+    """
+
+    def __init__(self, session_factory: typing.Callable[[], SQLAlchemySession] = None, batch_size: int = 100,
+                 max_delay: float = 1.0, answers: AnswerExtractor = None, max_queue: int = 10000):
+        self.session_factory = session_factory or base.Session
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.answers = answers
+        self.result = WebhookResult()
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._worker: typing.Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        # Guards `result`, which is updated by the threads calling `submit` and by the worker
+        self._lock = threading.Lock()
+
+    def submit(self, payload: dict) -> bool:
+        """
+        Queues a payload for ingestion.
+        :return: False if the queue is full, in which case the payload should be sent again later.
+        """
+        try:
+            self._queue.put_nowait(payload)
+        except queue.Full:
+            return False
+        with self._lock:
+            self.result.received += 1
+        return True
+
+    def start(self) -> 'WebhookIngestor':
+        if self._worker is None or not self._worker.is_alive():
+            self._stopping.clear()
+            self._worker = threading.Thread(target=self._run, name='formstack-webhook-ingestor', daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self, timeout: float = None) -> None:
+        """
+        Writes every queued payload, then stops the worker.
+        """
+        self._stopping.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+            self._worker = None
+
+    def flush(self) -> None:
+        """
+        Waits until every payload queued so far has been written (or has failed).
+        """
+        self._queue.join()
+
+    def _next_batch(self) -> typing.List[dict]:
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return list()
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self.ingest_batch(batch)
+            except Exception as e:
+                logger.exception(f'Could not ingest a batch of {len(batch)} webhooks: {e}')
+                with self._lock:
+                    self.result.failed.extend(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def ingest_batch(self, payloads: typing.Iterable[dict]) -> None:
+        """
+        Writes a batch of payloads straight away, in one transaction. `result` is updated once the batch is committed.
+        """
+        submissions, unreadable = collections.OrderedDict(), list()
+        for payload in payloads:
+            try:
+                submission = submission_from_webhook(payload)
+            except Exception as e:
+                logger.error(f'Could not read webhook payload: {e}')
+                unreadable.append(payload)
+                continue
+            # Only the latest version of a submission sent twice in a batch is kept
+            submission_id = int(submission['id'])
+            timestamp = parse_formstack_time(submission['timestamp']).replace(tzinfo=None)
+            if submission_id not in submissions or timestamp >= submissions[submission_id][1]:
+                submissions[submission_id] = (submission, timestamp)
+        if unreadable:
+            with self._lock:
+                self.result.failed.extend(unreadable)
+        if not submissions:
+            return
+
+        session = self.session_factory()
+        try:
+            ingested = {submission.id: submission for submission in session.query(FormstackSubmission)
+                        .filter(FormstackSubmission.id.in_(list(submissions)))}
+            helpers, skipped, written, failed = list(), 0, 0, list()
+            for submission_id, (submission, timestamp) in submissions.items():
+                existing = ingested.get(submission_id)
+                if is_unchanged(existing, submission):
+                    skipped += 1
+                    continue
+                helpers.append((FormstackSubmissionHelper(submission_id, json_data=submission,
+                                                          form=form_cache.get(submission['form'])), timestamp))
+
+            for _, form_helpers in itertools.groupby(sorted(helpers, key=lambda item: int(item[0].form.form_id)),
+                                                     key=lambda item: int(item[0].form.form_id)):
+                form_helpers = list(form_helpers)
+                form_failed = ingest_submission_batch(session, form_helpers, ingested, answers=self.answers)
+                written += len(form_helpers) - len(form_failed)
+                failed.extend(form_failed)
+            session.commit()
+            with self._lock:
+                self.result.skipped += skipped
+                self.result.ingested += written
+                self.result.failed.extend(failed)
+                self.result.batches += 1
+        finally:
+            session.close()
+        logger.debug(self.result)
+
+
+def _is_loopback(host: str) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class WebhookServer:
+    """
+    Receives Formstack webhooks at `path` and queues them on an ingestor, answering 202 straight away (or 503 if the
+    queue is full, so that Formstack sends the webhook again later).
+    :param port: 0 picks a free port; see `url`.
+    :param handshake_key: rejects (with 403) payloads without this handshake key. Defaults to
+        FORMSTACK_WEBHOOK_HANDSHAKE_KEY, if set. Required unless `host` is a loopback address.
+    :raises ValueError: if `host` is not a loopback address and there is no handshake key.
+    """
+
+    def __init__(self, ingestor: WebhookIngestor, host: str = '127.0.0.1', port: int = 0,
+                 path: str = '/formstack/webhook', handshake_key: str = None):
+        self.ingestor = ingestor
+        self.path = path
+        self.handshake_key = handshake_key if handshake_key is not None else \
+            config('FORMSTACK_WEBHOOK_HANDSHAKE_KEY', default=None)
+        if self.handshake_key is None and not _is_loopback(host):
+            raise ValueError(f'Refusing to receive webhooks on {host} without a handshake key; set '
+                             'FORMSTACK_WEBHOOK_HANDSHAKE_KEY')
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}{self.path}'
+
+    def check_handshake_key(self, key) -> bool:
+        # Compared in constant time, so that the key cannot be guessed from how long a rejection takes
+        return isinstance(key, str) and hmac.compare_digest(key.encode('utf-8'), self.handshake_key.encode('utf-8'))
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, message_format, *args):
+                logger.debug(message_format % args)
+
+            def _respond(self, status: int, message: str) -> None:
+                body = json.dumps({'status': message}).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                if urllib.parse.urlparse(self.path).path != server.path:
+                    return self._respond(404, 'not found')
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                try:
+                    payload = parse_webhook_body(body, self.headers.get('Content-Type', ''))
+                except WebhookPayloadError as e:
+                    return self._respond(400, str(e))
+                if server.handshake_key is not None and not server.check_handshake_key(payload.get('HandshakeKey')):
+                    return self._respond(403, 'bad handshake key')
+                if not server.ingestor.submit(payload):
+                    return self._respond(503, 'queue full')
+                return self._respond(202, 'queued')
+
+        return Handler
+
+    def start(self) -> 'WebhookServer':
+        """
+        Serves on a background thread, starting the ingestor too.
+        """
+        self.ingestor.start()
+        self._thread = threading.Thread(target=self._server.serve_forever, name='formstack-webhook-server',
+                                        daemon=True)
+        self._thread.start()
+        logger.info(f'Receiving Formstack webhooks at {self.url}')
+        return self
+
+    def serve_forever(self) -> None:
+        self.ingestor.start()
+        logger.info(f'Receiving Formstack webhooks at {self.url}')
+        try:
+            self._server.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        """
+        Stops receiving webhooks, then writes those already queued.
+        """
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        self.ingestor.stop()
+
+
+def main(argv: typing.List[str] = None) -> int:
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(prog='python -m rtb_model.formstack_webhook',
+                                     description='Receives Formstack webhooks and ingests them.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='addresses other than loopback need FORMSTACK_WEBHOOK_HANDSHAKE_KEY')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--path', default='/formstack/webhook')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--max-delay', type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    ingestor = WebhookIngestor(batch_size=args.batch_size, max_delay=args.max_delay)
+    try:
+        server = WebhookServer(ingestor, host=args.host, port=args.port, path=args.path)
+    except ValueError as e:
+        logger.error(e)
+        return 2
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logger.info(ingestor.result)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,6 @@
 #  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
 
-from sqlalchemy import Column, Integer, DateTime
+from sqlalchemy import Column, Integer, DateTime, String
 
 from . import base
 
@@ -10,3 +10,5 @@ class FormstackSubmission(base.Base):
     id = Column(Integer, primary_key=True)
     date_submit = Column(DateTime)
     date_last_update = Column(DateTime)
+    # SHA-256 of the ingested version's data. See `formstack_sync.submission_hash`.
+    data_hash = Column(String(64))
@@ -0,0 +1,16 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+from sqlalchemy import Column, Integer, DateTime
+
+from . import base
+
+
+class FormstackSyncState(base.Base):
+    __tablename__: str = "formstacksyncstate"
+    form_id = Column(Integer, primary_key=True)
+    # Timestamp (UTC) of the newest submission up to which every submission to the form has been ingested
+    watermark = Column(DateTime)
+    date_last_run = Column(DateTime)
+
+    def __repr__(self):
+        return f'Sync state of form #{self.form_id}: ingested up to {self.watermark}, last run {self.date_last_run}'
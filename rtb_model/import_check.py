@@ -0,0 +1,101 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Checks that importing the package stays fast and free of side effects.
+
+Each import is timed in a fresh interpreter, without any FORMSTACK_* or database settings in its environment, so an
+import that reads configuration fails outright. `import rtb_model` must take no more than the budget (the best of
+`repeat` runs, so that a busy machine does not fail the check), and neither it nor importing a model may load the
+heavy dependencies that are only needed once the database, Formstack or a DataFrame is used.
+
+Run `python -m rtb_model.import_check [--budget 50] [--repeat 5]`; it exits with status 1 if any import is over
+budget, fails or loads a module it should not.
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import typing
+
+logger = logging.getLogger(__name__)
+
+# Each check is a statement, the modules it must not load, and whether it is held to the budget
+CHECKS = [
+    ('import rtb_model', ('sqlalchemy', 'pandas', 'numpy', 'requests', 'pytz'), True),
+    ('from rtb_model import Company, OnlineUser', ('pandas', 'numpy', 'requests'), False),
+    ('from rtb_model import FormstackForm', ('sqlalchemy', 'pandas', 'numpy'), False),
+]
+
+# Settings removed from the environment of the timed interpreters
+_SETTING_PREFIXES = ('FORMSTACK_', 'DATABASE_', 'PRODUCTION_', 'DEVELOPMENT_', 'TEST_', 'RTB_')
+
+_PROBE = '''import json, sys, time
+start = time.perf_counter()
+{statement}
+print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))
+'''
+
+
+def _environment() -> typing.Dict[str, str]:
+    environment = {name: value for name, value in os.environ.items() if not name.startswith(_SETTING_PREFIXES)}
+    # The package must import from anywhere, not only its own directory (which would also pick up a .env file)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [root, environment.get('PYTHONPATH')]))
+    return environment
+
+
+def time_import(statement: str) -> typing.Tuple[float, typing.Set[str]]:
+    """
+    Runs `statement` in a fresh interpreter.
+    :return: the seconds it took, and the names of every module loaded by then.
+    :raises subprocess.CalledProcessError: if the statement fails.
+    """
+    process = subprocess.run([sys.executable, '-c', _PROBE.format(statement=statement)],
+                             capture_output=True, text=True, env=_environment(), cwd=os.sep, check=False)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, statement, process.stdout, process.stderr)
+    seconds, modules = json.loads(process.stdout.splitlines()[-1])
+    return seconds, set(modules)
+
+
+def check_imports(budget: float = 0.05, repeat: int = 5) -> typing.List[str]:
+    """
+    Runs each of `CHECKS`.
+    :param budget: most seconds `import rtb_model` may take.
+    :return: a description of each problem found.
+    """
+    problems = list()
+    for statement, forbidden, budgeted in CHECKS:
+        try:
+            runs = [time_import(statement) for _ in range(max(repeat, 1) if budgeted else 1)]
+        except subprocess.CalledProcessError as e:
+            problems.append(f'{statement!r} failed: {e.stderr.strip().splitlines()[-1]}')
+            continue
+        seconds, modules = min(seconds for seconds, _ in runs), runs[0][1]
+        loaded = sorted(module for module in forbidden if module in modules)
+        logger.info(f'{statement}: {seconds * 1000:.1f} ms' + (f', loads {", ".join(loaded)}' if loaded else ''))
+        if loaded:
+            problems.append(f'{statement!r} loads {", ".join(loaded)}')
+        if budgeted and seconds > budget:
+            problems.append(f'{statement!r} took {seconds * 1000:.1f} ms, over the budget of {budget * 1000:.0f} ms')
+    return problems
+
+
+def main(argv: typing.List[str] = None) -> int:
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(prog='python -m rtb_model.import_check', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--budget', type=float, default=50.0, help='milliseconds `import rtb_model` may take')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    problems = check_imports(budget=args.budget / 1000, repeat=args.repeat)
+    for problem in problems:
+        logger.error(problem)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Checks with EXPLAIN that the common lookups are served by the indexes declared on the models.
+
+Sequential scans are disabled while planning, as the planner prefers them on small tables (such as a test database)
+whatever indexes exist. A lookup that still plans a sequential scan has no usable index. On SQLite, the plan is read
+from EXPLAIN QUERY PLAN instead, and the indexes SQLite builds for unique constraints go by the constraints' names.
+
+Run `python -m rtb_model.index_check` against the configured database; it exits with status 1 if any lookup does not
+use its index.
+"""
+
+import json
+import logging
+import re
+import sys
+import typing
+from uuid import uuid4
+
+from sqlalchemy import UniqueConstraint, bindparam, text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session as SQLAlchemySession
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from . import base
+from .answer import Answer
+from .company import Company
+from .criterion import Criterion
+from .measure import Measure
+from .onelineuser import OnlineUser
+from .quickstartanswer import QuickstartAnswer
+from .quickstartuser import QuickstartUser
+
+logger = logging.getLogger(__name__)
+
+
+class _Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(_Explain, 'postgresql')
+def _compile_explain(element, compiler, **kw):
+    return f'EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kw)}'
+
+
+# Each lookup is a name, a function building the query from a session, and the index it should use
+LOOKUPS = [
+    ('answers of a user', lambda s: s.query(Answer).filter(Answer.online_user_id == uuid4()),
+     'ix_answer_online_user_id_measure_id'),
+    ('answer of a user to a measure',
+     lambda s: s.query(Answer).filter(Answer.online_user_id == uuid4(), Answer.measure_id == uuid4()),
+     'ix_answer_online_user_id_measure_id'),
+    ('answers to a measure', lambda s: s.query(Answer).filter(Answer.measure_id == uuid4()), 'ix_answer_measure_id'),
+    ('answers of a submission', lambda s: s.query(Answer).filter(Answer.formstack_submission_id == 1),
+     'ix_answer_formstack_submission_id'),
+    ('users of a company', lambda s: s.query(OnlineUser).filter(OnlineUser.company_id == uuid4()),
+     'ix_onlineuser_company_id'),
+    ('users by email', lambda s: s.query(OnlineUser).filter(OnlineUser.email == 'user@example.com'),
+     'uq_onlineuser_email_company_id'),
+    ('company of a submission', lambda s: s.query(Company).filter(Company.submission_id == 1),
+     'uq_company_submission_id'),
+    ('companies by ABN', lambda s: s.query(Company).filter(Company.abn == 1), 'ix_company_abn'),
+    ('criteria of a component', lambda s: s.query(Criterion).filter(Criterion.component_id == uuid4()),
+     'ix_criterion_component_id'),
+    ('measures of a criterion', lambda s: s.query(Measure).filter(Measure.criterion_id == uuid4()),
+     'ix_measure_criterion_id'),
+    ('quickstart answers of a user',
+     lambda s: s.query(QuickstartAnswer).filter(QuickstartAnswer.quickstart_user_id == uuid4()),
+     'ix_quickstartanswer_quickstart_user_id'),
+    ('quickstart users by email', lambda s: s.query(QuickstartUser).filter(QuickstartUser.email == 'user@example.com'),
+     'ix_quickstartuser_email'),
+]
+
+
+def _plan_nodes(plan: dict) -> typing.Iterator[dict]:
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _plan_nodes(child)
+
+
+# e.g. 'SEARCH answer USING INDEX ix_answer_measure_id (measure_id=?)'
+_SQLITE_INDEX = re.compile(r'^(?:SEARCH|SCAN) (\S+).* USING (?:COVERING )?INDEX (\S+)')
+
+
+def _sqlite_constraint_names(session: SQLAlchemySession, table_name: str) -> typing.Dict[str, str]:
+    # The constraint name of each index SQLite built for a unique constraint, matched on their columns
+    columns = {tuple(column.name for column in constraint.columns): constraint.name
+               for constraint in base.Base.metadata.tables[table_name].constraints
+               if isinstance(constraint, UniqueConstraint) and constraint.name}
+    names = dict()
+    for row in session.execute(text(f'PRAGMA index_list("{table_name}")')).mappings():
+        if row['origin'] == 'u':
+            index_columns = tuple(info['name'] for info in
+                                  session.execute(text(f'PRAGMA index_info("{row["name"]}")')).mappings())
+            if index_columns in columns:
+                names[row['name']] = columns[index_columns]
+    return names
+
+
+def _explain_sqlite(session: SQLAlchemySession, query) -> dict:
+    # Textual, so that the plan's rows are not read as the rows of the query (whose columns share names with them)
+    compiled = query.statement.compile(dialect=sqlite.dialect(paramstyle='named'))
+    statement = text(f'EXPLAIN QUERY PLAN {compiled}').bindparams(
+        *(bindparam(key, value, type_=compiled.binds[key].type) for key, value in compiled.params.items()))
+    nodes = list()
+    for _, _, _, detail in session.execute(statement):
+        node = {'Detail': detail}
+        match = _SQLITE_INDEX.match(detail)
+        if match:
+            table_name, index = match.groups()
+            node['Index Name'] = _sqlite_constraint_names(session, table_name).get(index, index)
+        nodes.append(node)
+    return {'Node Type': 'Query Plan', 'Plans': nodes}
+
+
+def explain(session: SQLAlchemySession, query) -> dict:
+    """
+    :return: the plan of a query, as the top-level node of `EXPLAIN (FORMAT JSON)`. On SQLite, a node holding the
+        steps of `EXPLAIN QUERY PLAN`, each with its 'Detail' and, if it uses an index, the 'Index Name'.
+    """
+    if session.get_bind().dialect.name == 'sqlite':
+        return _explain_sqlite(session, query)
+    result = session.execute(_Explain(query.statement)).scalar()
+    # psycopg2 parses json columns itself; other drivers may return the text
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]['Plan']
+
+
+def indexes_used(plan: dict) -> typing.Set[str]:
+    return {node['Index Name'] for node in _plan_nodes(plan) if 'Index Name' in node}
+
+
+def check_indexes(session: SQLAlchemySession) -> typing.Dict[str, typing.Tuple[bool, typing.Set[str]]]:
+    """
+    Plans each of `LOOKUPS` with sequential scans disabled, within a savepoint that is then rolled back.
+    :return: for each lookup, whether it used its index and the set of indexes it used.
+    """
+    results = dict()
+    # Rolling back to the savepoint also undoes the SET LOCAL
+    savepoint = session.begin_nested()
+    try:
+        if session.get_bind().dialect.name == 'postgresql':
+            session.execute(text('SET LOCAL enable_seqscan = off'))
+        for name, build_query, index in LOOKUPS:
+            used = indexes_used(explain(session, build_query(session)))
+            results[name] = (index in used, used)
+            if index in used:
+                logger.info(f'{name}: uses {index}')
+            else:
+                logger.warning(f'{name}: expected {index}, but uses {", ".join(sorted(used)) or "no index"}')
+    finally:
+        savepoint.rollback()
+    return results
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    session = base.Session()
+    try:
+        results = check_indexes(session)
+    finally:
+        session.close()
+    return 0 if all(ok for ok, _ in results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
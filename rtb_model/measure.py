@@ -1,29 +1,44 @@
 #  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
 
+import functools
 from uuid import uuid4
 
-from sqlalchemy import Column, Integer, String, ForeignKey
-from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, Integer, String, ForeignKey, inspect
+from sqlalchemy.orm import relationship, backref, object_session
 
 from . import base
+from .column_types import GUID
 
 
 class Measure(base.Base):
     __tablename__: str = "measure"
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    id = Column(GUID(), primary_key=True, default=uuid4)
     number = Column(Integer)
     text = Column(String, unique=True)
-    criterion_id = Column(UUID(as_uuid=True), ForeignKey('criterion.id'))
+    criterion_id = Column(GUID(), ForeignKey('criterion.id'), index=True)
     criterion = relationship("Criterion", backref=backref("criterion"))
     description = Column(String)
 
     def __repr__(self):
-        return f'{self.identifier}: {self.text}'
+        attribute = functools.partial(base.repr_attribute, self)
+        return f'C{attribute("criterion.component.number")}.R{attribute("criterion.number")}.M{attribute("number")}: ' \
+               f'{attribute("text")}'
 
     def __str__(self):
         return self.__repr__()
 
     @property
     def identifier(self):
-        return f'C{self.criterion.component.number}.R{self.criterion.number}.M{self.number}'
\ No newline at end of file
+        """
+        The measure's identifier, e.g. 'C3.R2.M4'. If `criterion` is not loaded, this is read from the reference catalog
+        (see `get_catalog`) rather than loading the criterion and its component.
+        """
+        state = inspect(self)
+        if state.has_identity and 'criterion' in state.unloaded:
+            from .catalog import get_catalog
+            try:
+                return get_catalog(object_session(self)).identifier(state.identity[0])
+            except KeyError:
+                # Added since the catalog was loaded
+                pass
+        return f'{self.criterion.identifier}.M{self.number}'
@@ -0,0 +1,45 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine
+
+import rtb_model
+from rtb_model import base
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = rtb_model.Base.metadata
+
+
+def _database_url() -> str:
+    return context.get_x_argument(as_dictionary=True).get('url') \
+           or config.get_main_option('sqlalchemy.url') \
+           or base.get_database_url()
+
+
+def run_migrations_offline() -> None:
+    context.configure(url=_database_url(), target_metadata=target_metadata, literal_binds=True,
+                      dialect_opts={'paramstyle': 'named'})
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online() -> None:
+    engine = create_engine(_database_url())
+    try:
+        with engine.connect() as connection:
+            context.configure(connection=connection, target_metadata=target_metadata)
+            with context.begin_transaction():
+                context.run_migrations()
+    finally:
+        engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
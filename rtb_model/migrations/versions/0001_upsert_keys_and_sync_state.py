@@ -0,0 +1,45 @@
+"""Upsert keys and Formstack sync state
+
+Brings a database created with `Base.metadata.create_all()` by rtb_model 1.6.5 or earlier up to date with the unique
+keys used by `upsert` and the `formstacksyncstate` table used by `FormstackSync`. A new database can instead be created
+with `create_all()` and marked as current with `alembic stamp head`.
+
+Adding the unique keys fails if the tables already hold duplicates, which must be merged first.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Earlier versions of `FormstackSync` created this table themselves, so it may already exist
+    if not sa.inspect(op.get_bind()).has_table('formstacksyncstate'):
+        op.create_table('formstacksyncstate',
+                        sa.Column('form_id', sa.Integer, primary_key=True, autoincrement=False),
+                        sa.Column('watermark', sa.DateTime),
+                        sa.Column('date_last_run', sa.DateTime))
+
+    op.create_unique_constraint('uq_company_submission_id', 'company', ['submission_id'])
+    op.create_index('uq_company_abn_without_submission', 'company', ['abn'], unique=True,
+                    postgresql_where=sa.text('submission_id IS NULL'), sqlite_where=sa.text('submission_id IS NULL'))
+    op.create_unique_constraint('uq_onlineuser_email_company_id', 'onlineuser', ['email', 'company_id'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_onlineuser_email_company_id', 'onlineuser', type_='unique')
+    op.drop_index('uq_company_abn_without_submission', table_name='company')
+    op.drop_constraint('uq_company_submission_id', 'company', type_='unique')
+    op.drop_table('formstacksyncstate')
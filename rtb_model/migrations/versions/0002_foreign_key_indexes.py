@@ -0,0 +1,47 @@
+"""Indexes for foreign keys and common lookups
+
+The indexes are built with CREATE INDEX CONCURRENTLY, outside of the migration's transaction, so that writes to the
+tables are not blocked while they build. `rtb_model.index_check` shows which index each common lookup uses.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = [
+    ('ix_answer_online_user_id_measure_id', 'answer', ['online_user_id', 'measure_id']),
+    ('ix_answer_measure_id', 'answer', ['measure_id']),
+    ('ix_answer_formstack_submission_id', 'answer', ['formstack_submission_id']),
+    ('ix_onlineuser_company_id', 'onlineuser', ['company_id']),
+    ('ix_company_abn', 'company', ['abn']),
+    ('ix_criterion_component_id', 'criterion', ['component_id']),
+    ('ix_measure_criterion_id', 'measure', ['criterion_id']),
+    ('ix_quickstartanswer_quickstart_user_id', 'quickstartanswer', ['quickstart_user_id']),
+    ('ix_quickstartanswer_question_id', 'quickstartanswer', ['question_id']),
+    ('ix_quickstartquestion_component_id', 'quickstartquestion', ['component_id']),
+    ('ix_quickstartuser_onlineuser_id', 'quickstartuser', ['onlineuser_id']),
+    ('ix_quickstartuser_email', 'quickstartuser', ['email']),
+]
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,43 @@
+"""Answer count rollup tables
+
+Creates the tables maintained by `rtb_model.rollup`. They start empty, so every company is stale until its counts are
+first read or `python -m rtb_model.rollup rebuild` is run.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The answer table's enum type already exists
+    response = postgresql.ENUM('Yes', 'No', 'Unsure', 'Not applicable', name='answer_response', create_type=False)
+    op.create_table('answercount',
+                    sa.Column('company_id', postgresql.UUID(as_uuid=True),
+                              sa.ForeignKey('company.id', ondelete='CASCADE'), primary_key=True),
+                    sa.Column('criterion_id', postgresql.UUID(as_uuid=True),
+                              sa.ForeignKey('criterion.id', ondelete='CASCADE'), primary_key=True),
+                    sa.Column('response', response, primary_key=True),
+                    sa.Column('count', sa.Integer, nullable=False))
+    op.create_table('answercountstate',
+                    sa.Column('company_id', postgresql.UUID(as_uuid=True),
+                              sa.ForeignKey('company.id', ondelete='CASCADE'), primary_key=True),
+                    sa.Column('date_rebuilt', sa.DateTime, nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_table('answercountstate')
+    op.drop_table('answercount')
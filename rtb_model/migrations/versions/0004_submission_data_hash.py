@@ -0,0 +1,30 @@
+"""Formstack submission data hash
+
+Adds `formstacksubmission.data_hash`, which the sync, backfill and webhook ingestion compare to detect edited
+submissions (Formstack keeps a submission's timestamp when it is edited). Existing rows have no hash, so each of their
+submissions is ingested once more the next time it is listed.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('formstacksubmission', sa.Column('data_hash', sa.String(64)))
+
+
+def downgrade() -> None:
+    op.drop_column('formstacksubmission', 'data_hash')
@@ -1,31 +1,41 @@
 #  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
 
+import functools
 import typing
 from uuid import uuid4
 
-from sqlalchemy import Column, String, ForeignKey
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column, String, ForeignKey, UniqueConstraint
 from sqlalchemy.orm import relationship, backref
 
+from .field_map import FieldMap
 from .formstack_utilities import FormstackSubmissionHelper
 from . import base
+from .column_types import GUID
 
 import logging
 
 
 class OnlineUser(base.Base):
     __tablename__: str = 'onlineuser'
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    id = Column(GUID(), primary_key=True, default=uuid4)
     prefix = Column(String(10))
     first_name = Column(String)
     last_name = Column(String)
     email = Column(String)
     job_title = Column(String)
-    company_id = Column(UUID(as_uuid=True), ForeignKey('company.id'))
+    company_id = Column(GUID(), ForeignKey('company.id'), index=True)
     company = relationship("Company", backref=backref("company"))
 
+    __table_args__ = (
+        # Used to match re-ingested users to their existing user, see `upsert.upsert_online_users`. Also serves lookups
+        # by email alone, so that column has no index of its own
+        UniqueConstraint('email', 'company_id', name='uq_onlineuser_email_company_id'),
+    )
+
     def __repr__(self):
-        return f'Online User: {self.prefix} {self.first_name} {self.last_name}: {self.job_title} @ {self.email}'
+        attribute = functools.partial(base.repr_attribute, self)
+        return f'Online User: {attribute("prefix")} {attribute("first_name")} {attribute("last_name")}: ' \
+               f'{attribute("job_title")} @ {attribute("email")}'
 
     @staticmethod
     def extract_name_parts(from_str):
@@ -42,40 +52,58 @@ class OnlineUser(base.Base):
 
         return prefix, first_name, last_name
 
+    formstack_field_map = FieldMap(fields={'num_users': 87125326},
+                                   repeated={'name': [87125327, 87125336, 87125340, 87125344, 87125351],
+                                             'email': [87125332, 87125337, 87125341, 87125345, 87125352],
+                                             'job_title': [87125333, 87125338, 87125342, 87125346, 87125353]})
+
     @classmethod
     def from_formstack(cls, formstack_submission: FormstackSubmissionHelper) -> typing.List:
-        field_map = {
-            1: {'name': 87125327,
-                'email': 87125332,
-                'job_title': 87125333},
-            2: {'name': 87125336,
-                'email': 87125337,
-                'job_title': 87125338},
-            3: {'name': 87125340,
-                'email': 87125341,
-                'job_title': 87125342},
-            4: {'name': 87125344,
-                'email': 87125345,
-                'job_title': 87125346},
-            5: {'name': 87125351,
-                'email': 87125352,
-                'job_title': 87125353},
-        }
-
-        data = formstack_submission.get_data()
-        num_users = int(data.loc[87125326].value)
+        data = cls.formstack_field_map.compile(formstack_submission.form).extract(formstack_submission.get_record())
+        num_users = int(data['num_users'])
         users = list()
 
-        for i in range(1, num_users + 1):
+        for i in range(num_users):
             try:
-                if isinstance(data.loc[field_map[i]['name']].value, str):
-                    prefix, first_name, last_name = OnlineUser.extract_name_parts(data.loc[field_map[i]['name']].value)
-                    email = data.loc[field_map[i]['email']].value
-                    job_title = data.loc[field_map[i]['job_title']].value
+                if isinstance(data['name'][i], str):
+                    prefix, first_name, last_name = OnlineUser.extract_name_parts(data['name'][i])
+                    email = data['email'][i]
+                    job_title = data['job_title'][i]
                     # noinspection PyArgumentList
                     users.append(cls(prefix=prefix, first_name=first_name, last_name=last_name,
                                      email=email, job_title=job_title))
-            except (AttributeError, ValueError, TypeError) as e:
+            except (AttributeError, ValueError, TypeError, IndexError) as e:
                 logging.warn(f'Could not create online user due to an exception: {e}')
 
         return users
+
+    @classmethod
+    def rows_from_formstack(cls, formstack_submissions: typing.Iterable[FormstackSubmissionHelper]):
+        """
+        Builds the users of each submission as rows of column values, in one vectorised pass over the batch. All
+        submissions must be to the same form.
+        :return: a DataFrame with one row per user, with the `submission_id` each user came from and one column per
+            `from_formstack` parameter.
+        """
+        import pandas as pd
+
+        formstack_submissions = list(formstack_submissions)
+        if not formstack_submissions:
+            return pd.DataFrame()
+        extractor = cls.formstack_field_map.compile(formstack_submissions[0].form)
+        data = extractor.extract_batch(submission.get_record() for submission in formstack_submissions)
+
+        num_users = pd.to_numeric(data['num_users'], errors='coerce')
+        data = data[(data['repeat'] <= num_users) & data['name'].map(lambda x: isinstance(x, str))]
+
+        def name_part(part: str):
+            return data['name'].str.extract(f'(?m)^.*{part} =(.*)$', expand=False).str.strip().fillna('')
+
+        return pd.DataFrame({
+            'submission_id': data['submission_id'],
+            'prefix': name_part('prefix'),
+            'first_name': name_part('first'),
+            'last_name': name_part('last'),
+            'email': data['email'],
+            'job_title': data['job_title'],
+        }).reset_index(drop=True)
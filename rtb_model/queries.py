@@ -0,0 +1,68 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Queries that load answers together with everything their reprs and identifiers use, in a fixed number of round-trips
+however many answers there are.
+
+Many-to-one relationships to the few hundred measures (and their criteria and components) are loaded with
+`selectinload`, which fetches each distinct measure once, where a join would repeat it on every answer row. A user's
+company is joined, as there is only one per user.
+"""
+
+import typing
+from uuid import UUID
+
+from sqlalchemy.orm import Session as SQLAlchemySession, configure_mappers, contains_eager, joinedload, selectinload
+
+from .answer import Answer
+from .criterion import Criterion
+from .measure import Measure
+from .onelineuser import OnlineUser
+
+
+def measure_options(answer_path=selectinload(Answer.measure)):
+    """
+    :param answer_path: the loader option that reaches `Answer.measure`.
+    :return: the option that loads a measure's criterion and component along with it.
+    """
+    return answer_path.joinedload(Measure.criterion).joinedload(Criterion.component)
+
+
+def answers_for_company(session: SQLAlchemySession, company_id: UUID) -> typing.List[Answer]:
+    """
+    Every answer by the users of a company, with `measure` (down to its component), `online_user` and the user's
+    `company` loaded. Takes two queries.
+    """
+    return session.query(Answer) \
+        .join(Answer.online_user) \
+        .filter(OnlineUser.company_id == company_id) \
+        .options(contains_eager(Answer.online_user).joinedload(OnlineUser.company),
+                 measure_options()) \
+        .all()
+
+
+def answers_for_users(session: SQLAlchemySession, online_user_ids: typing.Iterable[UUID]) -> typing.List[Answer]:
+    """
+    Every answer by the given users, loaded as in `answers_for_company`. Takes two queries.
+    """
+    return session.query(Answer) \
+        .join(Answer.online_user) \
+        .filter(Answer.online_user_id.in_(list(online_user_ids))) \
+        .options(contains_eager(Answer.online_user).joinedload(OnlineUser.company),
+                 measure_options()) \
+        .all()
+
+
+def assessment_for_user(session: SQLAlchemySession, online_user_id: UUID) -> typing.Optional[OnlineUser]:
+    """
+    An online user with their `company` and all of their answers (the `onlineuser` backref of `Answer.online_user`)
+    loaded, each answer with its measure down to its component. Takes three queries.
+    :return: the user, or None if there is no such user.
+    """
+    # The backref only exists on the class once the mappers are configured
+    configure_mappers()
+    return session.query(OnlineUser) \
+        .filter(OnlineUser.id == online_user_id) \
+        .options(joinedload(OnlineUser.company),
+                 measure_options(selectinload(OnlineUser.onlineuser).selectinload(Answer.measure))) \
+        .one_or_none()
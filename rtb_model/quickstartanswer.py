@@ -2,14 +2,15 @@
 
 from __future__ import annotations
 import enum
+import functools
 from uuid import uuid4
 
 
 from sqlalchemy import Column, ForeignKey, Enum
-from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship, backref
 
 from . import base
+from .column_types import GUID
 
 class QuickstartLikertAnswer(enum.Enum):
     strongly_disagree = 1
@@ -20,14 +21,15 @@ class QuickstartLikertAnswer(enum.Enum):
 
 class QuickstartAnswer(base.Base):
     __tablename__: str = 'quickstartanswer'
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
-    quickstart_user_id = Column(UUID(as_uuid=True), ForeignKey('quickstartuser.id'))
+    id = Column(GUID(), primary_key=True, default=uuid4)
+    quickstart_user_id = Column(GUID(), ForeignKey('quickstartuser.id'), index=True)
     quickstart_user = relationship("QuickstartUser", backref=backref("quickstartuser_quickstartanswer"))
 
-    question_id = Column(UUID(as_uuid=True), ForeignKey('quickstartquestion.id'))
+    question_id = Column(GUID(), ForeignKey('quickstartquestion.id'), index=True)
     question = relationship('QuickstartQuestion', backref=backref("quickstartquestion_quickstartanswer"))
 
     answer = Column(Enum(QuickstartLikertAnswer))
 
     def __repr__(self):
-        return f'Quickstart result: {self.quickstart_user} A: {self.answer}'
+        attribute = functools.partial(base.repr_attribute, self)
+        return f'Quickstart result: {attribute("quickstart_user")} A: {attribute("answer")}'
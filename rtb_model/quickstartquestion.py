@@ -1,24 +1,27 @@
 #  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
 
 from __future__ import annotations
+import functools
 from uuid import uuid4
 
 from sqlalchemy import Column, String, ForeignKey, Integer
-from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship, backref
 
 from . import base
+from .column_types import GUID
 from .component import Component
 
 
 class QuickstartQuestion(base.Base):
     __tablename__: str = 'quickstartquestion'
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    id = Column(GUID(), primary_key=True, default=uuid4)
     question_text = Column(String, nullable=False)
     formstack_form_id = Column(Integer, nullable=False)
 
-    component_id = Column(UUID(as_uuid=True), ForeignKey('component.id'))
+    component_id = Column(GUID(), ForeignKey('component.id'), index=True)
     component: Component = relationship("Component", backref=backref("component_quickstartquestion"))
 
     def __repr__(self):
-        return f'Quickstart question: {self.question_text} related to component #{self.component.number}'
+        attribute = functools.partial(base.repr_attribute, self)
+        return f'Quickstart question: {attribute("question_text")} ' \
+               f'related to component #{attribute("component.number")}'
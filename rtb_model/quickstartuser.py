@@ -1,43 +1,60 @@
 #  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
 
 from __future__ import annotations
+import functools
+import typing
 from uuid import uuid4
 
 from sqlalchemy import Column, String, ForeignKey
-from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship, backref
 
+from .field_map import FieldMap
 from .formstack_utilities import FormstackSubmissionHelper
 from . import base
+from .column_types import GUID
 
 
 class QuickstartUser(base.Base):
     __tablename__: str = 'quickstartuser'
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    id = Column(GUID(), primary_key=True, default=uuid4)
     first_name = Column(String)
     last_name = Column(String)
-    email = Column(String)
+    email = Column(String, index=True)
     job_title = Column(String)
-    onlineuser_id = Column(UUID(as_uuid=True), ForeignKey('onlineuser.id'))
+    onlineuser_id = Column(GUID(), ForeignKey('onlineuser.id'), index=True)
     onlineuser = relationship("OnlineUser", backref=backref("onlineuser_quickstartuser"))
 
     def __repr__(self):
-        return f'Quickstart User: {self.first_name} {self.last_name}: {self.job_title} @ {self.email}'
+        attribute = functools.partial(base.repr_attribute, self)
+        return f'Quickstart User: {attribute("first_name")} {attribute("last_name")}: ' \
+               f'{attribute("job_title")} @ {attribute("email")}'
+
+    formstack_field_map = FieldMap(fields={'first_name': 96828995,
+                                           'last_name': 96829050,
+                                           'email': 96828832,
+                                           'job_title': 96828834})
 
     @classmethod
     def from_formstack(cls, formstack_submission: FormstackSubmissionHelper) -> QuickstartUser:
-        data = formstack_submission.get_data()
-
-        field_map = {'first_name': 96828995,
-                     'last_name': 96829050,
-                     'email': 96828832,
-                     'job_title': 96828834}
-
-        first_name = data.loc[field_map['email']].value
-        last_name = data.loc[field_map['last_name']].value
-        email = data.loc[field_map['email']].value
-        job_title = data.loc[field_map['job_title']].value
+        data = cls.formstack_field_map.compile(formstack_submission.form).extract(formstack_submission.get_record())
 
         # noinspection PyArgumentList
-        return cls(first_name=first_name, last_name=last_name, email=email, job_title=job_title)
+        return cls(first_name=data['first_name'], last_name=data['last_name'], email=data['email'],
+                   job_title=data['job_title'])
 
+    @classmethod
+    def rows_from_formstack(cls, formstack_submissions: typing.Iterable[FormstackSubmissionHelper]):
+        """
+        Builds the user of each submission as a row of column values, in one pass over the batch. All submissions
+        must be to the same form.
+        :return: a DataFrame with one row per submission, with its `submission_id` and one column per
+            `from_formstack` parameter.
+        """
+        import pandas as pd
+
+        formstack_submissions = list(formstack_submissions)
+        if not formstack_submissions:
+            return pd.DataFrame()
+        extractor = cls.formstack_field_map.compile(formstack_submissions[0].form)
+        data = extractor.extract_batch(submission.get_record() for submission in formstack_submissions)
+        return data[['submission_id', 'first_name', 'last_name', 'email', 'job_title']]
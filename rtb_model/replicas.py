@@ -0,0 +1,152 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Read replicas of the primary database, for `base.RoutingSession` to send reads to.
+
+Replicas are used in turn. Each is health checked before it is first used and then at most every `check_interval`
+seconds: it must answer `SELECT 1` and, if `max_lag` is set, be no more than that many seconds behind the primary. A
+replica that fails a check, or whose connection drops while in use, is skipped until its next check. Only one reader
+checks a replica at a time; readers arriving meanwhile go by its last check. If no replica is healthy, reads go to the
+primary.
+"""
+
+import logging
+import threading
+import time
+import typing
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_LAG_QUERY = text('SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())')
+
+
+class Replica:
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.healthy = False
+        # When the replica was last checked, from `time.monotonic()`. None if it has never been checked.
+        self.checked_at: typing.Optional[float] = None
+        self.lag: typing.Optional[float] = None
+        # Whether a reader is checking the replica, so that readers arriving meanwhile do not check it too
+        self.checking = False
+        # Guards the above against readers, explicit checks and the disconnect listener
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<Replica {self.engine.url!r}: {"healthy" if self.healthy else "unhealthy"}, lag {self.lag}>'
+
+    def check(self, max_lag: float = None) -> bool:
+        """
+        Checks that the replica answers, and that it is no more than `max_lag` seconds behind the primary.
+        :return: whether the replica is healthy.
+        """
+        lag = self.lag
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+                if self.engine.dialect.name == 'postgresql':
+                    # None on a server that is not replaying from a primary (or has replayed nothing yet)
+                    lag = connection.execute(_LAG_QUERY).scalar()
+            healthy = not max_lag or lag is None or lag <= max_lag
+            if not healthy:
+                logger.warning(f'Replica {self.engine.url!r} is {lag:.1f} s behind, over {max_lag} s')
+        except Exception as e:
+            logger.warning(f'Replica {self.engine.url!r} failed its health check: {e}')
+            healthy = False
+        with self._lock:
+            if healthy and not self.healthy and self.checked_at is not None:
+                logger.info(f'Replica {self.engine.url!r} is healthy again')
+            self.healthy = healthy
+            self.lag = lag
+            self.checked_at = time.monotonic()
+        return healthy
+
+    def start_check(self, interval: float) -> bool:
+        """
+        Claims the replica's next check, if it is due (it has not been checked in the last `interval` seconds) and no
+        one else is checking it. The caller must then call `check` and `finish_check`.
+        :return: whether the caller is to check the replica.
+        """
+        with self._lock:
+            if self.checking or (self.checked_at is not None and time.monotonic() - self.checked_at < interval):
+                return False
+            self.checking = True
+            return True
+
+    def finish_check(self) -> None:
+        with self._lock:
+            self.checking = False
+
+    def mark_unhealthy(self) -> bool:
+        """
+        Skips the replica until its next check.
+        :return: whether it was healthy.
+        """
+        with self._lock:
+            healthy, self.healthy = self.healthy, False
+        return healthy
+
+
+class ReplicaSet:
+    """
+    Chooses the replica for each read. See the module documentation.
+    """
+
+    def __init__(self, engines: typing.Iterable[Engine], check_interval: float = 30.0, max_lag: float = None):
+        self.replicas = [Replica(engine) for engine in engines]
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self._next = 0
+        self._lock = threading.Lock()
+        for replica in self.replicas:
+            event.listen(replica.engine, 'handle_error', self._on_error(replica))
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def __len__(self):
+        return len(self.replicas)
+
+    @staticmethod
+    def _on_error(replica: Replica) -> typing.Callable:
+        def on_error(context) -> None:
+            if context.is_disconnect and replica.mark_unhealthy():
+                logger.warning(f'Lost the connection to replica {replica.engine.url!r}; skipping it until its next '
+                               'health check')
+        return on_error
+
+    def choose(self) -> typing.Optional[Engine]:
+        """
+        :return: the engine of the next healthy replica, or None if there is none.
+        """
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % max(len(self.replicas), 1)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            # Only one reader checks a replica that is due; the others go by its last check (so skip it if it has
+            # never been checked). Checked outside of the lock, so that a slow replica does not hold up other reads.
+            if replica.start_check(self.check_interval):
+                try:
+                    replica.check(self.max_lag)
+                finally:
+                    replica.finish_check()
+            if replica.healthy:
+                return replica.engine
+        return None
+
+    def check(self) -> typing.List[Replica]:
+        """
+        Checks every replica now.
+        :return: the replicas, with their health.
+        """
+        for replica in self.replicas:
+            replica.check(self.max_lag)
+        return list(self.replicas)
+
+    def dispose(self) -> None:
+        for replica in self.replicas:
+            replica.engine.dispose()
@@ -0,0 +1,360 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Maintains `AnswerCount`, the number of answers by each company to each criterion with each response, so that progress
+can be read without scanning the answer table.
+
+Answers written through the library update the counts in the same transaction: `Answer` objects flushed by a `Session`
+(added, changed or deleted) and rows written by `bulk.bulk_insert_answers`. Answers written any other way are not
+counted until the company's counts are rebuilt.
+
+A company's counts are stale if it has never been rebuilt, or if the company has been updated (e.g. re-ingested) since
+its last rebuild. Ingesting submissions (`formstack_sync`, `backfill` and `formstack_webhook`) rebuilds the stale
+companies it wrote before committing. The read functions return the counts as they are, so that they can be run in a
+read-only session; `answer_counts(refresh=True)` rebuilds stale companies first, committing the rebuild in a session
+of its own.
+
+The counts are not maintained on a database without the answercount table (see migration 0003), which is logged once.
+The flush listeners are registered by `answer`, which imports this module on the first flush.
+
+Run `python -m rtb_model.rollup rebuild` to rebuild every company, `refresh` to rebuild only the stale ones, or `check`
+to list the stale ones.
+"""
+
+import collections
+import itertools
+import logging
+import sys
+import typing
+import weakref
+from uuid import UUID
+
+from decouple import config
+from sqlalchemy import func, inspect, or_, select, text, true
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from . import base
+from .answer import Answer
+from .answercount import AnswerCount, AnswerCountState
+from .catalog import get_catalog
+from .company import Company
+from .measure import Measure
+from .onelineuser import OnlineUser
+from .scoring import read_frame
+from .upsert import insert, utc_now
+
+if typing.TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Set RTB_MAINTAIN_ANSWER_COUNTS=False to stop answer writes updating the counts. The counts then go stale until they
+# are rebuilt, e.g. with `python -m rtb_model.rollup refresh`.
+MAINTAIN_ANSWER_COUNTS = config('RTB_MAINTAIN_ANSWER_COUNTS', default=True, cast=bool)
+
+# Whether the database of each engine has the answercount table, checked on first use
+_has_counts_table = weakref.WeakKeyDictionary()
+
+# Adds to many counts on PostgreSQL in one statement, from an array of each column
+_ADD_COUNTS = text('INSERT INTO answercount (company_id, criterion_id, response, count) '
+                   'SELECT * FROM unnest(CAST(:company_ids AS uuid[]), CAST(:criterion_ids AS uuid[]), '
+                   'CAST(:responses AS answer_response[]), CAST(:counts AS integer[])) '
+                   'ON CONFLICT (company_id, criterion_id, response) '
+                   'DO UPDATE SET count = answercount.count + excluded.count')
+
+# (online_user_id, measure_id, response, change in count)
+AnswerChange = typing.Tuple[typing.Any, typing.Any, typing.Optional[str], int]
+
+
+def _as_uuid(value) -> typing.Optional[UUID]:
+    if value is None or isinstance(value, UUID):
+        return value
+    return UUID(str(value))
+
+
+def maintaining(session: SQLAlchemySession) -> bool:
+    """
+    :return: whether answer writes in the session update the counts: `MAINTAIN_ANSWER_COUNTS` is set and the session's
+        database has the answercount table.
+    """
+    if not MAINTAIN_ANSWER_COUNTS:
+        return False
+    connection = session.connection()
+    engine = connection.engine
+    if engine not in _has_counts_table:
+        _has_counts_table[engine] = inspect(connection).has_table(AnswerCount.__tablename__)
+        if not _has_counts_table[engine]:
+            logger.warning(f'{engine.url!r} has no {AnswerCount.__tablename__} table, so answer counts are not '
+                           'maintained; run the migrations to create it')
+    return _has_counts_table[engine]
+
+
+def _criteria_of_measures(session: SQLAlchemySession, measure_ids: typing.Set[UUID]) -> typing.Dict[UUID, UUID]:
+    criteria = dict()
+    catalog = get_catalog(session)
+    for measure_id in measure_ids:
+        try:
+            criteria[measure_id] = catalog.by_id(measure_id).criterion_id
+        except KeyError:
+            pass
+    missing = measure_ids - set(criteria)
+    if missing:
+        # Measures added since the catalog was loaded
+        criteria.update(session.query(Measure.id, Measure.criterion_id).filter(Measure.id.in_(missing)))
+    return criteria
+
+
+def apply_answer_changes(session: SQLAlchemySession, changes: typing.Iterable[AnswerChange]) -> None:
+    """
+    Adds changes in the number of answers to the counts, in the session's transaction. Answers without a response,
+    user or measure, and users without a company, are not counted.
+    :param changes: `(online_user_id, measure_id, response, change)` tuples, e.g. `(user_id, measure_id, 'Yes', 1)`
+        for a new answer.
+    """
+    changes = [(_as_uuid(user_id), _as_uuid(measure_id), response, change)
+               for user_id, measure_id, response, change in changes
+               if response is not None and user_id is not None and measure_id is not None and change]
+    if not changes or not maintaining(session):
+        return
+
+    with session.no_autoflush:
+        user_ids = {change[0] for change in changes}
+        companies = dict(session.query(OnlineUser.id, OnlineUser.company_id).filter(OnlineUser.id.in_(user_ids)))
+        criteria = _criteria_of_measures(session, {change[1] for change in changes})
+
+    totals = collections.Counter()
+    for user_id, measure_id, response, change in changes:
+        company_id = companies.get(user_id)
+        if company_id is not None and measure_id in criteria:
+            totals[(company_id, criteria[measure_id], response)] += change
+    add_answer_counts(session, totals)
+
+
+def add_answer_counts(session: SQLAlchemySession, totals: typing.Mapping[tuple, int]) -> None:
+    """
+    Adds to the counts, in the session's transaction.
+    :param totals: the change in each count, keyed by `(company_id, criterion_id, response)`. Ids may be UUIDs or their
+        string forms.
+    """
+    rows = [(str(company_id), str(criterion_id), response, count)
+            for (company_id, criterion_id, response), count in totals.items() if count]
+    if not rows or not maintaining(session):
+        return
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(_ADD_COUNTS, dict(zip(('company_ids', 'criterion_ids', 'responses', 'counts'),
+                                              map(list, zip(*rows)))))
+        return
+
+    table = AnswerCount.__table__
+    # One statement executed for every row, rather than one with a VALUES clause per row, which is slow to compile
+    rows = [dict(zip(('company_id', 'criterion_id', 'response', 'count'), row)) for row in rows]
+    statement = insert(session, table)
+    statement = statement.on_conflict_do_update(index_elements=['company_id', 'criterion_id', 'response'],
+                                                set_={'count': table.c.count + statement.excluded.count})
+    session.execute(statement, rows)
+
+
+_ANSWER_KEYS = ('online_user_id', 'measure_id', 'response')
+_ANSWERS_BEFORE_FLUSH = 'rtb_model.rollup.answers_before_flush'
+
+
+def _read_answers_before_flush(session: SQLAlchemySession, flush_context, instances) -> None:
+    # The rows of changed or deleted answers are read before the flush, as the old values of attributes that were
+    # expired when they were set are not in the attribute history
+    answer_ids = [obj.id for obj in itertools.chain(session.dirty, session.deleted)
+                  if isinstance(obj, Answer) and inspect(obj).has_identity]
+    if answer_ids and maintaining(session):
+        with session.no_autoflush:
+            session.info[_ANSWERS_BEFORE_FLUSH] = {
+                answer_id: values for answer_id, *values in
+                session.query(Answer.id, *(getattr(Answer, key) for key in _ANSWER_KEYS))
+                .filter(Answer.id.in_(answer_ids))}
+
+
+def _count_flushed_answers(session: SQLAlchemySession, flush_context) -> None:
+    before_flush = session.info.pop(_ANSWERS_BEFORE_FLUSH, dict())
+    changes = list()
+    for obj in session.new:
+        if isinstance(obj, Answer):
+            changes.append(tuple(getattr(obj, key) for key in _ANSWER_KEYS) + (1,))
+    for obj in session.dirty:
+        if isinstance(obj, Answer) and obj.id in before_flush:
+            before, after = tuple(before_flush[obj.id]), tuple(getattr(obj, key) for key in _ANSWER_KEYS)
+            if before != after:
+                changes.append(before + (-1,))
+                changes.append(after + (1,))
+    for obj in session.deleted:
+        if isinstance(obj, Answer) and obj.id in before_flush:
+            changes.append(tuple(before_flush[obj.id]) + (-1,))
+    apply_answer_changes(session, changes)
+
+
+def _company_filter(column, company_ids: typing.Optional[typing.List[UUID]]):
+    return column.in_(company_ids) if company_ids is not None else true()
+
+
+def rebuild_answer_counts(session: SQLAlchemySession, company_ids: typing.Iterable[UUID] = None,
+                          commit: bool = False) -> None:
+    """
+    Recounts the answers of companies from the answer table.
+    :param company_ids: the companies to rebuild. Defaults to every company.
+    :param commit: commit once rebuilt. Otherwise the rebuild is part of the session's transaction.
+    """
+    company_ids = [_as_uuid(company_id) for company_id in company_ids] if company_ids is not None else None
+    if company_ids is not None and not company_ids:
+        return
+    counts, state = AnswerCount.__table__, AnswerCountState.__table__
+
+    session.execute(counts.delete().where(_company_filter(counts.c.company_id, company_ids)))
+    recount = select(OnlineUser.company_id, Measure.criterion_id, Answer.response, func.count()) \
+        .select_from(Answer.__table__
+                     .join(OnlineUser.__table__, Answer.online_user_id == OnlineUser.id)
+                     .join(Measure.__table__, Answer.measure_id == Measure.id)) \
+        .where(Answer.response.isnot(None)) \
+        .where(OnlineUser.company_id.isnot(None)) \
+        .where(_company_filter(OnlineUser.company_id, company_ids)) \
+        .group_by(OnlineUser.company_id, Measure.criterion_id, Answer.response)
+    session.execute(counts.insert().from_select(['company_id', 'criterion_id', 'response', 'count'], recount))
+
+    # The WHERE clause is always there (if only as WHERE true), which SQLite needs to parse ON CONFLICT after a SELECT
+    rebuilt = insert(session, state).from_select(['company_id', 'date_rebuilt'],
+                                                 select(Company.id, utc_now())
+                                                 .where(_company_filter(Company.id, company_ids)))
+    session.execute(rebuilt.on_conflict_do_update(index_elements=['company_id'],
+                                                  set_={'date_rebuilt': rebuilt.excluded.date_rebuilt}))
+    logger.info(f'Rebuilt answer counts of {"every company" if company_ids is None else len(company_ids)}'
+                f'{"" if company_ids is None else " companies"}')
+    if commit:
+        session.commit()
+
+
+def stale_companies(session: SQLAlchemySession, company_ids: typing.Iterable[UUID] = None) -> typing.List[UUID]:
+    """
+    :param company_ids: only check these companies. Defaults to every company.
+    :return: the companies whose answer counts have never been rebuilt, or were rebuilt before the company's last
+        update.
+    """
+    company_ids = [_as_uuid(company_id) for company_id in company_ids] if company_ids is not None else None
+    if company_ids is not None and not company_ids:
+        return list()
+    query = session.query(Company.id) \
+        .outerjoin(AnswerCountState, AnswerCountState.company_id == Company.id) \
+        .filter(or_(AnswerCountState.date_rebuilt.is_(None),
+                    Company.date_last_update > AnswerCountState.date_rebuilt)) \
+        .filter(_company_filter(Company.id, company_ids))
+    return [company_id for company_id, in query]
+
+
+def refresh_answer_counts(session: SQLAlchemySession, company_ids: typing.Iterable[UUID] = None,
+                          commit: bool = False) -> typing.List[UUID]:
+    """
+    Rebuilds the answer counts of the stale companies amongst `company_ids` (default: every company). Does nothing
+    if the counts are not maintained (see `maintaining`).
+    :return: the companies that were rebuilt.
+    """
+    if not maintaining(session):
+        return list()
+    stale = stale_companies(session, company_ids)
+    if stale:
+        rebuild_answer_counts(session, stale, commit=commit)
+    return stale
+
+
+def answer_counts(session: SQLAlchemySession, company_ids: typing.Iterable[UUID] = None,
+                  refresh: bool = False) -> 'pd.DataFrame':
+    """
+    Reads the answer counts without touching the answer table.
+    :param company_ids: only read these companies. Defaults to every company.
+    :param refresh: rebuild the counts of stale companies first. The rebuild is committed in a new session on the
+        primary, so the caller's session (which may be read-only) is left as it is.
+    :return: a DataFrame with a row per company, criterion and response, with columns `company_id`, `component` and
+        `criterion` (identifiers such as 'C3' and 'C3.R2'), `response` and `count`.
+    """
+    import numpy as np
+    import pandas as pd
+
+    company_ids = [_as_uuid(company_id) for company_id in company_ids] if company_ids is not None else None
+    if refresh:
+        writer = base.Session(bind=session.get_bind())
+        try:
+            refresh_answer_counts(writer, company_ids, commit=True)
+        finally:
+            writer.close()
+
+    statement = select(AnswerCount.company_id, AnswerCount.criterion_id, AnswerCount.response, AnswerCount.count) \
+        .where(_company_filter(AnswerCount.company_id, company_ids)) \
+        .where(AnswerCount.count != 0)
+    counts = read_frame(session, statement, ['company_id', 'criterion_id', 'response', 'count'],
+                        dtypes={'company_id': 'category', 'criterion_id': 'category', 'response': 'category',
+                                'count': 'int64'})
+
+    # Only the distinct ids need converting and looking up
+    catalog = get_catalog(session)
+    criteria = [catalog.by_id(_as_uuid(criterion_id)) for criterion_id in counts['criterion_id'].cat.categories]
+    codes = counts['criterion_id'].cat.codes.to_numpy()
+    return pd.DataFrame({
+        'company_id': counts['company_id'].cat.rename_categories(_as_uuid).astype(object),
+        'component': np.array([catalog.identifier(criterion.component) for criterion in criteria], dtype=object)[codes],
+        'criterion': np.array([catalog.identifier(criterion) for criterion in criteria], dtype=object)[codes],
+        'response': counts['response'].astype(object),
+        'count': counts['count'],
+    })
+
+
+def progress(session: SQLAlchemySession, company_ids: typing.Iterable[UUID] = None,
+             refresh: bool = False) -> 'pd.DataFrame':
+    """
+    How far each company's users are through each component of the assessment, from the answer counts.
+    :return: a DataFrame indexed by company id and component identifier, with columns `answered` (answers with any
+        response), `expected` (the component's measures times the company's users) and `fraction` (answered /
+        expected).
+    :param refresh: see `answer_counts`.
+    """
+    import pandas as pd
+
+    company_ids = [_as_uuid(company_id) for company_id in company_ids] if company_ids is not None else None
+    counts = answer_counts(session, company_ids, refresh=refresh)
+    answered = counts.groupby(['company_id', 'component'])['count'].sum()
+
+    catalog = get_catalog(session)
+    measures = collections.Counter(catalog.identifier(measure.criterion.component) for measure in catalog.measures)
+    users = dict(session.query(OnlineUser.company_id, func.count())
+                 .filter(_company_filter(OnlineUser.company_id, company_ids))
+                 .filter(OnlineUser.company_id.isnot(None))
+                 .group_by(OnlineUser.company_id))
+
+    index = pd.MultiIndex.from_tuples([(company_id, component) for company_id in users for component in measures],
+                                      names=['company_id', 'component'])
+    table = pd.DataFrame({'answered': answered.reindex(index, fill_value=0),
+                          'expected': [users[company_id] * measures[component] for company_id, component in index]},
+                         index=index)
+    table['fraction'] = table['answered'] / table['expected']
+    return table
+
+
+def main(argv: typing.List[str] = None) -> int:
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = argv if argv is not None else sys.argv[1:]
+    command = args[0] if args else 'check'
+    session = base.Session()
+    try:
+        if command == 'rebuild':
+            rebuild_answer_counts(session, commit=True)
+        elif command == 'refresh':
+            logger.info(f'Rebuilt {len(refresh_answer_counts(session, commit=True))} stale companies')
+        elif command == 'check':
+            stale = stale_companies(session)
+            for company_id in stale:
+                logger.info(f'Stale: {company_id}')
+            logger.info(f'{len(stale)} companies have stale answer counts')
+            return 1 if stale else 0
+        else:
+            logger.error(f'Unknown command {command!r}; expected rebuild, refresh or check')
+            return 2
+    finally:
+        session.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
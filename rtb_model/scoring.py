@@ -0,0 +1,210 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Scores companies' assessments from their answers.
+
+Answers are read with one query into a columnar frame of small integer codes, so no ORM objects are built, and are
+rolled up with pandas groupby. The scores are rolled up as follows:
+
+- a measure's score is the mean score of the answers to it by the company's users,
+- a criterion's score is the mean of its measures' scores,
+- a component's score is the mean of its criteria's scores, and
+- a company's overall score is the mean of its components' scores.
+
+Answers that have no score ('Not applicable', or no response) are left out of every mean, so a measure that is not
+applicable to a company has no score rather than a score of 0.
+"""
+
+import csv
+import io
+import logging
+import typing
+from uuid import UUID
+
+from sqlalchemy import case, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from .answer import Answer
+from .component import Component
+from .criterion import Criterion
+from .measure import Measure
+from .onelineuser import OnlineUser
+from .quickstartanswer import QuickstartAnswer, QuickstartLikertAnswer
+from .quickstartquestion import QuickstartQuestion
+from .quickstartuser import QuickstartUser
+
+if typing.TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# The score of each `Answer.response`. Responses scored None are left out of the scores.
+RESPONSE_SCORES: typing.Dict[str, typing.Optional[float]] = {
+    'Yes': 1.0,
+    'No': 0.0,
+    'Unsure': 0.0,
+    'Not applicable': None,
+}
+
+
+def _score_expression(column, scores: typing.Mapping[typing.Any, typing.Optional[float]]):
+    return case(*((column == response, score) for response, score in scores.items() if score is not None), else_=None)
+
+
+def read_frame(session: SQLAlchemySession, statement, columns: typing.Sequence[str],
+               dtypes: typing.Mapping[str, str] = None) -> 'pd.DataFrame':
+    """
+    Runs a query into a DataFrame. On PostgreSQL the rows are streamed with COPY ... TO STDOUT and parsed by pandas,
+    which is several times faster than fetching them as Python tuples.
+    :param columns: names of the selected columns, in order.
+    :param dtypes: dtype of each column; UUID columns should be 'category' or 'object'.
+    """
+    import pandas as pd
+
+    # Passing the statement lets a read-only `base.RoutingSession` read it from a replica
+    connection = session.connection(bind_arguments=dict(clause=statement))
+    if connection.dialect.name != 'postgresql':
+        frame = pd.DataFrame.from_records(list(session.execute(statement)), columns=columns)
+        return frame.astype(dtypes) if dtypes else frame
+
+    compiled = statement.compile(dialect=postgresql.psycopg2.dialect(),
+                                 compile_kwargs={'render_postcompile': True})
+    params = {key: str(value) if isinstance(value, UUID) else value for key, value in compiled.params.items()}
+    cursor = connection.connection.cursor()
+    try:
+        sql = cursor.mogrify(str(compiled), params).decode()
+        buffer = io.StringIO()
+        cursor.copy_expert(f'COPY ({sql}) TO STDOUT WITH (FORMAT csv)', buffer)
+    finally:
+        cursor.close()
+    buffer.seek(0)
+    return pd.read_csv(buffer, names=list(columns), header=None, dtype=dtypes, quoting=csv.QUOTE_MINIMAL)
+
+
+def _as_uuid_categories(column: 'pd.Series') -> 'pd.Series':
+    # COPY gives UUIDs as text; only the distinct values need converting
+    return column.cat.rename_categories(lambda value: value if isinstance(value, UUID) else UUID(value))
+
+
+def load_answer_scores(session: SQLAlchemySession, company_ids: typing.Iterable[UUID] = None,
+                       response_scores: typing.Mapping[str, typing.Optional[float]] = None) -> 'pd.DataFrame':
+    """
+    Reads the score of every scored answer in one query.
+    :param company_ids: only read the answers of these companies. Defaults to every company.
+    :param response_scores: the score of each response. Defaults to `RESPONSE_SCORES`.
+    :return: a DataFrame with one row per answer, with columns `company_id` (categorical), `component`, `criterion`
+        and `measure` (the numbers making up the measure's identifier) and `score`.
+    """
+    response_scores = response_scores or RESPONSE_SCORES
+    company_ids = list(company_ids) if company_ids is not None else None
+    statement = select(OnlineUser.company_id, Component.number, Criterion.number, Measure.number,
+                       _score_expression(Answer.response, response_scores)) \
+        .select_from(Answer.__table__
+                     .join(OnlineUser.__table__, Answer.online_user_id == OnlineUser.id)
+                     .join(Measure.__table__, Answer.measure_id == Measure.id)
+                     .join(Criterion.__table__, Measure.criterion_id == Criterion.id)
+                     .join(Component.__table__, Criterion.component_id == Component.id))
+    if company_ids is not None:
+        statement = statement.where(OnlineUser.company_id.in_(company_ids))
+    frame = read_frame(session, statement, ['company_id', 'component', 'criterion', 'measure', 'score'],
+                       dtypes={'company_id': 'category', 'component': 'int16', 'criterion': 'int16',
+                               'measure': 'int16', 'score': 'float32'})
+    frame['company_id'] = _as_uuid_categories(frame['company_id'])
+    return frame.dropna(subset=['score'])
+
+
+class AssessmentScores:
+    """
+    The scores of a set of companies at each level of the assessment. Each table is indexed by company id, with a
+    column for each measure, criterion or component (e.g. 'C3.R2.M4', 'C3.R2', 'C3') scored for any of the companies,
+    in assessment order. A company has no score (NaN) for an item none of its own answers scored.
+    """
+
+    def __init__(self, measures: 'pd.DataFrame', criteria: 'pd.DataFrame', components: 'pd.DataFrame',
+                 overall: 'pd.Series'):
+        self.measures = measures
+        self.criteria = criteria
+        self.components = components
+        self.overall = overall
+
+    def __repr__(self):
+        return f'Assessment scores of {len(self.overall)} companies'
+
+    @classmethod
+    def from_answer_scores(cls, answers: 'pd.DataFrame') -> 'AssessmentScores':
+        """
+        Rolls up answer scores, as read by `load_answer_scores`, to measure, criterion, component and overall scores.
+        """
+        measures = answers.groupby(['company_id', 'component', 'criterion', 'measure'], observed=True)['score'] \
+            .mean().astype('float64')
+        # Each level is the mean of the level below, so an item counts the same however many answers it has
+        criteria = measures.groupby(level=['company_id', 'component', 'criterion']).mean()
+        components = criteria.groupby(level=['company_id', 'component']).mean()
+        overall = components.groupby(level='company_id').mean()
+        companies = _company_index(overall.index)
+
+        return cls(
+            measures=_score_table(measures, companies, 'C{}.R{}.M{}'),
+            criteria=_score_table(criteria, companies, 'C{}.R{}'),
+            components=_score_table(components, companies, 'C{}'),
+            overall=overall.set_axis(companies).rename('score'))
+
+
+def _company_index(index: 'pd.Index') -> 'pd.Index':
+    import pandas as pd
+
+    return pd.Index(list(index), dtype=object, name='company_id')
+
+
+def _score_table(scores: 'pd.Series', companies: 'pd.Index', identifier: str) -> 'pd.DataFrame':
+    """
+    Pivots scores indexed by company and numbers into a table with a row per company and a column per item, in
+    assessment order, named by formatting `identifier` with the item's numbers.
+    """
+    import pandas as pd
+
+    table = scores.unstack(list(range(1, scores.index.nlevels))).sort_index(axis=1)
+    table.index = _company_index(table.index)
+    table.columns = pd.Index([identifier.format(*(numbers if isinstance(numbers, tuple) else (numbers,)))
+                              for numbers in table.columns], name='identifier')
+    return table.reindex(companies)
+
+
+def score_companies(session: SQLAlchemySession, company_ids: typing.Iterable[UUID] = None,
+                    response_scores: typing.Mapping[str, typing.Optional[float]] = None) -> AssessmentScores:
+    """
+    Scores companies' assessments with one query. See the module documentation for how scores are rolled up.
+    :param company_ids: only score these companies. Defaults to every company with answers.
+    :param response_scores: the score of each response. Defaults to `RESPONSE_SCORES`.
+    """
+    answers = load_answer_scores(session, company_ids, response_scores)
+    logger.debug(f'Scoring {len(answers)} answers')
+    return AssessmentScores.from_answer_scores(answers)
+
+
+def quickstart_scores(session: SQLAlchemySession, company_ids: typing.Iterable[UUID] = None) -> 'pd.DataFrame':
+    """
+    Averages companies' quickstart answers by component with one query. Answers count as their `QuickstartLikertAnswer`
+    value, from 1 (strongly disagree) to 5 (strongly agree). Quickstart users without an online user belong to no
+    company, so their answers are left out.
+    :param company_ids: only score these companies. Defaults to every company with quickstart answers.
+    :return: a DataFrame indexed by company id, with the mean answer for each component (e.g. 'C3').
+    """
+    likert_values = {answer.name: float(answer.value) for answer in QuickstartLikertAnswer}
+    statement = select(OnlineUser.company_id, Component.number,
+                       _score_expression(QuickstartAnswer.__table__.c.answer, likert_values)) \
+        .select_from(QuickstartAnswer.__table__
+                     .join(QuickstartUser.__table__, QuickstartAnswer.quickstart_user_id == QuickstartUser.id)
+                     .join(OnlineUser.__table__, QuickstartUser.onlineuser_id == OnlineUser.id)
+                     .join(QuickstartQuestion.__table__, QuickstartAnswer.question_id == QuickstartQuestion.id)
+                     .join(Component.__table__, QuickstartQuestion.component_id == Component.id))
+    if company_ids is not None:
+        statement = statement.where(OnlineUser.company_id.in_(list(company_ids)))
+
+    answers = read_frame(session, statement, ['company_id', 'component', 'score'],
+                         dtypes={'company_id': 'category', 'component': 'int16', 'score': 'float32'})
+    answers['company_id'] = _as_uuid_categories(answers['company_id'])
+    means = answers.dropna(subset=['score']).groupby(['company_id', 'component'], observed=True)['score'] \
+        .mean().astype('float64')
+    return _score_table(means, _company_index(means.index.unique('company_id')), 'C{}')
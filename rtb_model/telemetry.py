@@ -0,0 +1,389 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+"""
+Performance telemetry for the database and the Formstack API.
+
+Once `enable()`d (or with RTB_TELEMETRY=True), this records:
+
+- every statement run on the engine: counts and latency histograms by operation (SELECT, INSERT, ...), and rows
+  returned as reported by the database driver. Only psycopg2's default (client-side) cursors report the rows a
+  SELECT returned; statements on sqlite3 or on server-side cursors (`stream_results`) are counted as returning an
+  unknown number of rows instead,
+- every session transaction: the statements, time and rows it took, and possible N+1 patterns, i.e. one SELECT run
+  RTB_TELEMETRY_N_PLUS_ONE (default 10) or more times with different parameters, which usually means a relationship
+  loaded object by object, and
+- every attempt at a Formstack request: counts by status, latency histograms and response bytes per endpoint, with
+  ids in endpoints replaced by '{id}'.
+
+`stats()` returns a snapshot of everything, `session_stats(session)` the figures for a session's current transaction,
+and `prometheus_text()` renders everything in the Prometheus text exposition format.
+"""
+
+import bisect
+import collections
+import hashlib
+import itertools
+import logging
+import re
+import threading
+import time
+import typing
+
+from decouple import config
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from . import base
+from .formstack_transport import add_request_listener, remove_request_listener
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000, 10000, 100000)
+OPERATIONS = frozenset(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'))
+
+_SESSION_KEY = 'rtb_model.telemetry'
+
+
+class Histogram:
+    """
+    Counts observations into cumulative buckets, as Prometheus histograms do. Not thread-safe on its own; the
+    registry's lock guards every histogram.
+    """
+
+    def __init__(self, buckets: typing.Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> typing.Optional[float]:
+        """
+        :return: the upper bound of the bucket holding the `q` quantile, or None without observations.
+        """
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def to_dict(self) -> dict:
+        cumulative = list(itertools.accumulate(self.counts))
+        return dict(count=self.count, sum=self.sum, p50=self.quantile(0.5), p95=self.quantile(0.95),
+                    buckets=dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], cumulative)))
+
+
+class SessionStats:
+    """
+    What one session transaction ran on the database.
+    """
+
+    def __init__(self, n_plus_one_threshold: int):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.queries = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.statements: typing.Counter[str] = collections.Counter()
+        self.n_plus_one: typing.List[str] = list()
+        self._parameters: typing.Dict[str, set] = collections.defaultdict(set)
+        self._connection_infos: typing.List[dict] = list()
+
+    def __repr__(self):
+        return f'{self.queries} queries in {self.seconds * 1000:.1f} ms returning {self.rows} rows' + \
+               (f', possible N+1 in {len(self.n_plus_one)} statements' if self.n_plus_one else '')
+
+    def record(self, statement: str, parameters, seconds: float, rows: int, executemany: bool) -> bool:
+        """
+        :return: whether `statement` has just been found to be run as an N+1.
+        """
+        self.queries += 1
+        self.seconds += seconds
+        self.rows += rows
+        self.statements[statement] += 1
+        if executemany or statement in self.n_plus_one or _operation(statement) != 'SELECT':
+            return False
+        distinct = self._parameters[statement]
+        distinct.add(hashlib.sha1(repr(parameters).encode('utf-8')).digest())
+        if len(distinct) >= self.n_plus_one_threshold:
+            self.n_plus_one.append(statement)
+            del self._parameters[statement]
+            return True
+        return False
+
+
+def _operation(statement: str) -> str:
+    words = statement.lstrip(' \n\t(').split(None, 1)
+    operation = words[0].upper() if words else ''
+    return operation if operation in OPERATIONS else 'OTHER'
+
+
+def _summary(statement: str, length: int = 160) -> str:
+    return ' '.join(statement.split())[:length]
+
+
+# Numeric path segments, e.g. the ids in 'form/1234/submission'
+_ID_SEGMENT = re.compile(r'(?<=/)\d+(?=/|$)|^\d+(?=/|$)')
+
+
+def endpoint_template(endpoint: str) -> str:
+    return _ID_SEGMENT.sub('{id}', endpoint.split('?', 1)[0].lstrip('/'))
+
+
+class Registry:
+    """
+    Every metric recorded in this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.query_counts: typing.Counter[str] = collections.Counter()
+            self.query_latency: typing.Dict[str, Histogram] = collections.defaultdict(
+                lambda: Histogram(LATENCY_BUCKETS))
+            self.query_rows: typing.Counter[str] = collections.Counter()
+            self.query_rows_unknown: typing.Counter[str] = collections.Counter()
+            self.session_queries = Histogram(COUNT_BUCKETS)
+            self.session_rows = Histogram(COUNT_BUCKETS)
+            self.session_seconds = Histogram(LATENCY_BUCKETS)
+            self.n_plus_one: typing.Counter[str] = collections.Counter()
+            self.http_counts: typing.Counter[typing.Tuple[str, str, str]] = collections.Counter()
+            self.http_latency: typing.Dict[typing.Tuple[str, str], Histogram] = collections.defaultdict(
+                lambda: Histogram(LATENCY_BUCKETS))
+            self.http_bytes: typing.Counter[typing.Tuple[str, str]] = collections.Counter()
+
+    def record_query(self, operation: str, seconds: float, rows: typing.Optional[int]) -> None:
+        """
+        :param rows: the rows the statement returned, or None if the driver did not report them.
+        """
+        with self._lock:
+            self.query_counts[operation] += 1
+            self.query_latency[operation].observe(seconds)
+            if rows is None:
+                self.query_rows_unknown[operation] += 1
+            else:
+                self.query_rows[operation] += rows
+
+    def record_session(self, stats: SessionStats) -> None:
+        with self._lock:
+            self.session_queries.observe(stats.queries)
+            self.session_rows.observe(stats.rows)
+            self.session_seconds.observe(stats.seconds)
+
+    def record_n_plus_one(self, statement: str) -> None:
+        with self._lock:
+            self.n_plus_one[_summary(statement)] += 1
+
+    def record_request(self, method: str, endpoint: str, status_code: typing.Optional[int], seconds: float,
+                       size: int) -> None:
+        key = (method, endpoint_template(endpoint))
+        with self._lock:
+            self.http_counts[key + (str(status_code) if status_code is not None else 'error',)] += 1
+            self.http_latency[key].observe(seconds)
+            self.http_bytes[key] += size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                database=dict(
+                    queries=dict(self.query_counts),
+                    rows=dict(self.query_rows),
+                    rows_unknown=dict(self.query_rows_unknown),
+                    latency={operation: histogram.to_dict() for operation, histogram in self.query_latency.items()},
+                    sessions=dict(queries=self.session_queries.to_dict(), rows=self.session_rows.to_dict(),
+                                  seconds=self.session_seconds.to_dict()),
+                    n_plus_one=dict(self.n_plus_one)),
+                formstack={f'{method} {endpoint}': dict(
+                    requests={status: count for (m, e, status), count in self.http_counts.items()
+                              if (m, e) == (method, endpoint)},
+                    bytes=self.http_bytes[(method, endpoint)],
+                    latency=histogram.to_dict())
+                    for (method, endpoint), histogram in self.http_latency.items()})
+
+    def prometheus_text(self) -> str:
+        lines = list()
+
+        def metric(name: str, metric_type: str, description: str):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+        def histogram_lines(name: str, histogram: Histogram, labels: str):
+            separator = ',' if labels else ''
+            for bound, count in zip([str(bound) for bound in histogram.buckets] + ['+Inf'],
+                                    itertools.accumulate(histogram.counts)):
+                lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {count}')
+            lines.append(f'{name}_sum{{{labels}}} {histogram.sum}' if labels else f'{name}_sum {histogram.sum}')
+            lines.append(f'{name}_count{{{labels}}} {histogram.count}' if labels else
+                         f'{name}_count {histogram.count}')
+
+        with self._lock:
+            metric('rtb_db_queries_total', 'counter', 'Statements run on the database.')
+            for operation, count in sorted(self.query_counts.items()):
+                lines.append(f'rtb_db_queries_total{{operation="{operation}"}} {count}')
+            metric('rtb_db_rows_total', 'counter', 'Rows returned by statements, where the driver reports them '
+                   '(psycopg2 client-side cursors only).')
+            for operation, rows in sorted(self.query_rows.items()):
+                lines.append(f'rtb_db_rows_total{{operation="{operation}"}} {rows}')
+            metric('rtb_db_rows_unknown_total', 'counter',
+                   'Statements returning rows whose driver did not report how many (sqlite3, server-side cursors).')
+            for operation, count in sorted(self.query_rows_unknown.items()):
+                lines.append(f'rtb_db_rows_unknown_total{{operation="{operation}"}} {count}')
+            metric('rtb_db_query_seconds', 'histogram', 'Statement latency.')
+            for operation, histogram in sorted(self.query_latency.items()):
+                histogram_lines('rtb_db_query_seconds', histogram, f'operation="{operation}"')
+            metric('rtb_db_session_queries', 'histogram', 'Statements run per session transaction.')
+            histogram_lines('rtb_db_session_queries', self.session_queries, '')
+            metric('rtb_db_session_rows', 'histogram',
+                   'Rows returned per session transaction, where the driver reports them.')
+            histogram_lines('rtb_db_session_rows', self.session_rows, '')
+            metric('rtb_db_session_seconds', 'histogram', 'Database time per session transaction.')
+            histogram_lines('rtb_db_session_seconds', self.session_seconds, '')
+            metric('rtb_db_n_plus_one_total', 'counter',
+                   'Session transactions running a statement repeatedly with different parameters.')
+            for statement, count in sorted(self.n_plus_one.items()):
+                lines.append(f'rtb_db_n_plus_one_total{{statement="{_label(statement)}"}} {count}')
+            metric('rtb_formstack_requests_total', 'counter', 'Formstack request attempts.')
+            for (method, endpoint, status), count in sorted(self.http_counts.items()):
+                lines.append(f'rtb_formstack_requests_total{{method="{method}",endpoint="{_label(endpoint)}",'
+                             f'status="{status}"}} {count}')
+            metric('rtb_formstack_response_bytes_total', 'counter', 'Bytes received from Formstack.')
+            for (method, endpoint), size in sorted(self.http_bytes.items()):
+                lines.append(f'rtb_formstack_response_bytes_total{{method="{method}",endpoint="{_label(endpoint)}"}} '
+                             f'{size}')
+            metric('rtb_formstack_request_seconds', 'histogram', 'Formstack request latency.')
+            for (method, endpoint), histogram in sorted(self.http_latency.items()):
+                histogram_lines('rtb_formstack_request_seconds', histogram,
+                                f'method="{method}",endpoint="{_label(endpoint)}"')
+        return '\n'.join(lines) + '\n'
+
+
+def _label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+registry = Registry()
+_n_plus_one_threshold = config('RTB_TELEMETRY_N_PLUS_ONE', default=10, cast=int)
+_enabled = False
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    if context is not None:
+        context._rtb_telemetry_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    start = getattr(context, '_rtb_telemetry_start', None)
+    if start is None or not _enabled:
+        return
+    seconds = time.perf_counter() - start
+    # psycopg2's client-side cursors have fetched every row of a SELECT by now and report how many; sqlite3 and
+    # server-side cursors report -1, as the rows are only counted as they are fetched
+    rows = None
+    if cursor.description is None:
+        rows = 0
+    elif cursor.rowcount >= 0:
+        rows = cursor.rowcount
+    registry.record_query(_operation(statement), seconds, rows)
+
+    stats = conn.info.get(_SESSION_KEY)
+    if stats is not None and stats.record(statement, parameters, seconds, rows or 0, executemany):
+        registry.record_n_plus_one(statement)
+        logger.warning(f'Possible N+1: statement run {stats.statements[statement]} times with different parameters '
+                       f'in one session: {_summary(statement)}')
+
+
+def _instrument_engine(engine: Engine) -> None:
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _session_began(session: SQLAlchemySession, transaction, connection) -> None:
+    stats = session.info.get(_SESSION_KEY)
+    if stats is None:
+        stats = session.info[_SESSION_KEY] = SessionStats(_n_plus_one_threshold)
+    # The connection's info belongs to its pooled connection, so it is cleared when the transaction ends
+    connection.info[_SESSION_KEY] = stats
+    stats._connection_infos.append(connection.info)
+
+
+def _session_transaction_ended(session: SQLAlchemySession, transaction) -> None:
+    if transaction.parent is not None:
+        return
+    stats = session.info.pop(_SESSION_KEY, None)
+    if stats is None:
+        return
+    for info in stats._connection_infos:
+        if info.get(_SESSION_KEY) is stats:
+            del info[_SESSION_KEY]
+    if stats.queries:
+        registry.record_session(stats)
+
+
+def session_stats(session: SQLAlchemySession) -> typing.Optional[SessionStats]:
+    """
+    :return: what the session's current transaction has run so far, or None if it has not touched the database (or
+        telemetry is not enabled).
+    """
+    return session.info.get(_SESSION_KEY)
+
+
+def enable() -> None:
+    """
+    Starts recording. Statements are recorded on every engine built by `base.get_engine`, and session transactions on
+    every `base.Session`.
+    """
+    global _enabled
+    if _enabled:
+        return
+    base.on_engine_created(_instrument_engine)
+    event.listen(base.Session, 'after_begin', _session_began)
+    event.listen(base.Session, 'after_transaction_end', _session_transaction_ended)
+    add_request_listener(registry.record_request)
+    _enabled = True
+
+
+def disable() -> None:
+    """
+    Stops recording. Metrics recorded so far are kept.
+    """
+    global _enabled
+    if not _enabled:
+        return
+    event.remove(base.Session, 'after_begin', _session_began)
+    event.remove(base.Session, 'after_transaction_end', _session_transaction_ended)
+    remove_request_listener(registry.record_request)
+    _enabled = False
+
+
+def stats() -> dict:
+    """
+    :return: a snapshot of every metric as nested dicts.
+    """
+    return registry.stats()
+
+
+def reset() -> None:
+    registry.reset()
+
+
+def prometheus_text() -> str:
+    """
+    :return: every metric in the Prometheus text exposition format, e.g. to serve from a /metrics endpoint.
+    """
+    return registry.prometheus_text()
+
+
+if config('RTB_TELEMETRY', default=False, cast=bool):
+    enable()
@@ -0,0 +1,201 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import itertools
+import logging
+import typing
+from uuid import UUID, uuid4
+
+from sqlalchemy import Table
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session as SQLAlchemySession
+
+from .column_types import utc_now
+from .company import Company
+from .onelineuser import OnlineUser
+
+logger = logging.getLogger(__name__)
+
+Row = typing.Union[dict, Company, OnlineUser]
+
+
+def insert(session: SQLAlchemySession, table: Table):
+    """
+    An INSERT into `table` with the ON CONFLICT clauses of the session's database (PostgreSQL or SQLite).
+    """
+    if session.get_bind().dialect.name == 'sqlite':
+        return sqlite.insert(table)
+    return postgresql.insert(table)
+
+
+def returns_rows(session: SQLAlchemySession) -> bool:
+    """
+    Whether INSERT ... RETURNING can be used with the session's database. SQLAlchemy only supports it on SQLite from
+    2.0, where the flag is named `insert_returning`.
+    """
+    dialect = session.get_bind().dialect
+    return bool(getattr(dialect, 'insert_returning', None) or getattr(dialect, 'full_returning', False))
+
+
+def _as_dict(row: Row, columns: typing.Iterable[str]) -> dict:
+    if isinstance(row, dict):
+        return dict(row)
+    return {column: getattr(row, column) for column in columns}
+
+
+def _with_same_columns(rows: typing.List[dict]) -> typing.List[dict]:
+    # A multi-row INSERT needs a value for every column in every row
+    columns = set(itertools.chain.from_iterable(rows))
+    return [{column: row.get(column) for column in columns} for row in rows]
+
+
+def _by_columns(rows: typing.Iterable[dict]) -> typing.Iterator[typing.List[dict]]:
+    # Rows grouped by the columns they give, so that an upsert only overwrites the columns each row gives
+    groups = dict()
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), list()).append(row)
+    return iter(groups.values())
+
+
+def _batches(rows: typing.Iterable, batch_size: int) -> typing.Iterator[list]:
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _user_ids(session: SQLAlchemySession, keys: typing.Iterable[tuple]) -> typing.List[UUID]:
+    # The ids of the users with the given (email, company_id), for databases without RETURNING
+    keys = {(email, company_id if isinstance(company_id, UUID) else UUID(str(company_id)))
+            for email, company_id in keys}
+    query = session.query(OnlineUser.id, OnlineUser.email, OnlineUser.company_id) \
+        .filter(OnlineUser.company_id.in_([company_id for _, company_id in keys])) \
+        .filter(OnlineUser.email.in_([email for email, _ in keys]))
+    return [user_id for user_id, email, company_id in query if (email, company_id) in keys]
+
+
+def upsert_companies(session: SQLAlchemySession, rows: typing.Iterable[Row], batch_size: int = 500,
+                     commit: bool = True) -> typing.Dict[typing.Any, UUID]:
+    """
+    Inserts or updates companies in batches with INSERT ... ON CONFLICT DO UPDATE.
+
+    Companies with a `submission_id` are matched on it. Companies without one (e.g. entered by hand) are matched on
+    `abn` amongst the other companies without a submission. A matched company has every given column overwritten.
+    `date_last_update` is set to the database's current time in the same statement.
+    :param rows: dicts of column values, `Company` objects, or rows of `Company.rows_from_formstack(...)` as dicts.
+    :param batch_size: number of companies sent per statement.
+    :param commit: commit after each batch.
+    :return: the id of each company, keyed by its `submission_id` (or by its `abn` if it has no submission).
+    """
+    columns = [column for column in Company.__table__.columns.keys() if column != 'id']
+    ids = dict()
+
+    for batch in _batches(rows, batch_size):
+        by_submission, by_abn = dict(), dict()
+        for row in batch:
+            row = _as_dict(row, columns)
+            row.pop('id', None)
+            row['date_last_update'] = utc_now()
+            # A statement may only update each row once, so the last of any duplicates wins
+            if row.get('submission_id') is not None:
+                by_submission[row['submission_id']] = row
+            elif row.get('abn') is not None:
+                by_abn[row['abn']] = row
+            else:
+                raise ValueError(f'A company needs a submission_id or an abn to be upserted: {row}')
+
+        for key_column, keyed_rows, index_where in (
+                ('submission_id', by_submission, None),
+                ('abn', by_abn, Company.submission_id.is_(None))):
+            for values in _by_columns(keyed_rows.values()):
+                statement = insert(session, Company.__table__).values(values)
+                update_columns = set(values[0]) - {key_column}
+                statement = statement.on_conflict_do_update(
+                    index_elements=[key_column],
+                    index_where=index_where,
+                    set_={column: statement.excluded[column] for column in update_columns})
+                key = Company.__table__.c[key_column]
+                if returns_rows(session):
+                    returned = session.execute(statement.returning(Company.__table__.c.id, key))
+                else:
+                    session.execute(statement)
+                    query = session.query(Company.id, key).filter(key.in_([row[key_column] for row in values]))
+                    returned = query.filter(index_where) if index_where is not None else query
+                for company_id, key_value in returned:
+                    ids[key_value] = company_id
+
+        if commit:
+            session.commit()
+    return ids
+
+
+def upsert_online_users(session: SQLAlchemySession, rows: typing.Iterable[Row], batch_size: int = 500,
+                        commit: bool = True) -> typing.List[UUID]:
+    """
+    Inserts or updates online users in batches with INSERT ... ON CONFLICT DO UPDATE, matching users on their email
+    and company.
+    :param rows: dicts of column values or `OnlineUser` objects. Instead of a `company_id`, a row may give the
+        `submission_id` of its company, as the rows of `OnlineUser.rows_from_formstack(...)` do.
+    :param batch_size: number of users sent per statement.
+    :param commit: commit after each batch.
+    :return: the id of each user, in no particular order.
+    """
+    columns = [column for column in OnlineUser.__table__.columns.keys() if column != 'id']
+    ids = list()
+
+    for batch in _batches(rows, batch_size):
+        batch = [_as_dict(row, columns) for row in batch]
+
+        submission_ids = {row['submission_id'] for row in batch
+                          if row.get('company_id') is None and row.get('submission_id') is not None}
+        companies = dict(session.query(Company.submission_id, Company.id)
+                         .filter(Company.submission_id.in_(submission_ids))) if submission_ids else dict()
+
+        keyed_rows, unmatched_rows = dict(), list()
+        for row in batch:
+            submission_id = row.pop('submission_id', None)
+            row.pop('id', None)
+            if row.get('company_id') is None and submission_id is not None:
+                if submission_id not in companies:
+                    raise ValueError(f'No company has the submission id {submission_id}')
+                row['company_id'] = companies[submission_id]
+            if row.get('email') is None or row.get('company_id') is None:
+                # NULLs never conflict, so these users can only be inserted
+                logger.warning(f'Online user {row} has no email or company, so it cannot be matched to existing users')
+                unmatched_rows.append(row)
+            else:
+                keyed_rows[(row['email'], row['company_id'])] = row
+
+        for values in _by_columns(keyed_rows.values()):
+            statement = insert(session, OnlineUser.__table__).values(values)
+            update_columns = set(values[0]) - {'email', 'company_id'}
+            if update_columns:
+                statement = statement.on_conflict_do_update(
+                    index_elements=['email', 'company_id'],
+                    set_={column: statement.excluded[column] for column in update_columns})
+            elif returns_rows(session):
+                # DO NOTHING would return no row for existing users, so "update" one of the keys to itself instead
+                statement = statement.on_conflict_do_update(index_elements=['email', 'company_id'],
+                                                            set_={'email': statement.excluded.email})
+            else:
+                statement = statement.on_conflict_do_nothing(index_elements=['email', 'company_id'])
+            if returns_rows(session):
+                ids.extend(row_id for row_id, in session.execute(statement.returning(OnlineUser.__table__.c.id)))
+            else:
+                session.execute(statement)
+                ids.extend(_user_ids(session, [(row['email'], row['company_id']) for row in values]))
+        if unmatched_rows:
+            if not returns_rows(session):
+                for row in unmatched_rows:
+                    row['id'] = uuid4()
+            statement = insert(session, OnlineUser.__table__).values(_with_same_columns(unmatched_rows))
+            if returns_rows(session):
+                ids.extend(row_id for row_id, in session.execute(statement.returning(OnlineUser.__table__.c.id)))
+            else:
+                session.execute(statement)
+                ids.extend(row['id'] for row in unmatched_rows)
+
+        if commit:
+            session.commit()
+    return ids
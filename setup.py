@@ -9,6 +9,10 @@ setup(name='rtb_model',
       author='Curtis West',
       author_email='curtis@curtiswest.net',
       license='None',
-      packages=['rtb_model'],
+      packages=['rtb_model', 'rtb_model.migrations', 'rtb_model.migrations.versions'],
+      package_data={'rtb_model.migrations': ['script.py.mako']},
       zip_safe=False,
-      install_requires=['sqlalchemy', 'python-decouple', 'pandas', 'pytz', 'requests', 'psycopg2'])
+      python_requires='>=3.9',
+      install_requires=['sqlalchemy>=1.4', 'python-decouple', 'pandas', 'pytz', 'requests', 'psycopg2'],
+      extras_require={'async': ['aiohttp'], 'migrations': ['alembic>=1.12'],
+                      'parquet': ['pyarrow']})
@@ -0,0 +1,206 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import http.server
+import json
+import threading
+import typing
+import urllib.parse
+
+import pytest
+
+from rtb_model import base, formstack_transport
+from rtb_model.catalog import invalidate_catalog
+from rtb_model.company import Company
+from rtb_model.component import Component
+from rtb_model.criterion import Criterion
+from rtb_model.formstack_utilities import FormstackForm, form_cache
+from rtb_model.measure import Measure
+from rtb_model.onelineuser import OnlineUser
+from rtb_model.quickstartquestion import QuickstartQuestion
+
+ASSESSMENT_FORM_ID = 1
+# The value of each field of an assessment submission (see `field_map`), by field id
+_ASSESSMENT_VALUES = {
+    87125019: 'Company {i}', 87125021: '{abn}', 87125022: 'B Mining', 87125270: 'Small', 87125311: '1M',
+    87125313: 'Australia\nNew Zealand', 87125025: 'A011 Agriculture', 87125166: 'B062 Mining', 87125326: '2',
+    87125327: 'prefix = Dr\nfirst = Ada\nlast = Lovelace', 87125332: 'ada{i}@example.com', 87125333: 'CEO',
+    87125336: 'first = Alan\nlast = Turing', 87125337: 'alan{i}@example.com', 87125338: 'CTO',
+}
+# Every field the company and online user field maps read
+ASSESSMENT_FORM = {'id': str(ASSESSMENT_FORM_ID), 'name': 'Assessment',
+                   'fields': [{'id': str(field), 'label': name, 'description': '', 'type': 'text'}
+                              for model in (Company, OnlineUser)
+                              for field, name in model.formstack_field_map.field_ids().items()]}
+
+
+def assessment_submission(i: int, timestamp: str = '2020-01-01 09:00:00', **changes) -> dict:
+    """
+    :return: the JSON Formstack returns for submission `i` to the assessment form, with the values of any fields
+        given as `changes` (e.g. `field_87125333='CFO'`) replaced.
+    """
+    values = {field: value.format(i=i, abn=10000000000 + i) for field, value in _ASSESSMENT_VALUES.items()}
+    values.update({int(field[len('field_'):]): value for field, value in changes.items()})
+    return {'id': str(i), 'form': str(ASSESSMENT_FORM_ID), 'timestamp': timestamp,
+            'data': [{'field': str(field), 'value': value} for field, value in values.items()]}
+
+
+def serve_assessments(stub: 'StubFormstack', submissions: typing.Dict[int, dict]) -> None:
+    """
+    Serves the assessment form, and lists `submissions` (which may be changed later) as Formstack does.
+    """
+    def listing(query, body):
+        listed = sorted(submissions.values(), key=lambda submission: submission['timestamp'])
+        if 'min_time' in query:
+            listed = [submission for submission in listed if submission['timestamp'] >= query['min_time']]
+        page, per_page = int(query.get('page', 1)), int(query.get('per_page', 100))
+        pages = max(1, -(-len(listed) // per_page))
+        listed = listed[(page - 1) * per_page:page * per_page]
+        if query.get('data') == 'true':
+            listed = [dict(submission, data={item['field']: item for item in submission['data']})
+                      for submission in listed]
+        return {'submissions': listed, 'total': len(submissions), 'pages': pages}
+
+    stub.routes[('GET', f'/form/{ASSESSMENT_FORM_ID}')] = lambda query, body: ASSESSMENT_FORM
+    stub.routes[('GET', f'/form/{ASSESSMENT_FORM_ID}/submission')] = listing
+
+
+class StubFormstack:
+    """
+    A local HTTP server standing in for the Formstack API. `routes` maps `(method, path)` to a function of the query
+    parameters and request body returning the JSON payload, or a `(status, payload)` or `(status, payload, headers)`
+    tuple. Requests to other paths get a 404.
+    """
+
+    def __init__(self):
+        self.routes: typing.Dict[typing.Tuple[str, str], typing.Callable] = dict()
+        self.requests: typing.List[typing.Tuple[str, str]] = list()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self):
+                url = urllib.parse.urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                with stub._lock:
+                    stub.requests.append((self.command, url.path))
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    route = stub.routes.get((self.command, url.path))
+                    result = route(dict(urllib.parse.parse_qsl(url.query)), body) if route \
+                        else (404, {'error': 'Not found'})
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+                status, payload, headers = 200, result, dict()
+                if isinstance(result, tuple):
+                    status, payload, headers = (result + (dict(),))[:3]
+                content = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+        return Handler
+
+    def count(self, method: str, path: str) -> int:
+        return sum(1 for request in self.requests if request == (method, path))
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def formstack():
+    """
+    A `StubFormstack`, used by every Formstack request made through the shared transport.
+    """
+    stub = StubFormstack()
+    previous = formstack_transport.set_transport(formstack_transport.FormstackTransport(
+        stub.url, 'token', max_retries=3, backoff_factor=0.01, max_backoff=0.1))
+    form_cache.clear()
+    try:
+        yield stub
+    finally:
+        formstack_transport.set_transport(previous)
+        form_cache.clear()
+        stub.close()
+
+
+@pytest.fixture
+def assessment_form(formstack) -> FormstackForm:
+    """
+    The assessment form, in `form_cache`.
+    """
+    form = FormstackForm(ASSESSMENT_FORM_ID, json_data=ASSESSMENT_FORM)
+    form_cache.put(form)
+    return form
+
+
+@pytest.fixture
+def database():
+    """
+    An empty in-memory SQLite database holding every table, used by `base.Session`.
+    """
+    base.configure(url='sqlite://')
+    base.create_all()
+    # The catalog is cached for the whole process
+    invalidate_catalog()
+    try:
+        yield base.get_engine()
+    finally:
+        base.configure()
+        invalidate_catalog()
+
+
+def add_reference_data(session) -> typing.Dict[str, typing.Any]:
+    """
+    Adds two components, each with two criteria of two measures ('C1.R1.M1' to 'C2.R2.M2'), and a quickstart question
+    for each component ('Q1' and 'Q2').
+    :return: the added objects, by identifier.
+    """
+    objects = dict()
+    for c in (1, 2):
+        component = objects[f'C{c}'] = Component(number=c, name=f'Component {c}')
+        objects[f'Q{c}'] = QuickstartQuestion(question_text=f'Question {c}', formstack_form_id=2, component=component)
+        for r in (1, 2):
+            criterion = objects[f'C{c}.R{r}'] = Criterion(number=r, name=f'Criterion {c}.{r}', short_name=f'{c}.{r}',
+                                                          component=component)
+            for m in (1, 2):
+                objects[f'C{c}.R{r}.M{m}'] = Measure(number=m, text=f'Measure {c}.{r}.{m}', criterion=criterion)
+    session.add_all(objects.values())
+    session.flush()
+    return objects
+
+
+@pytest.fixture
+def reference(database) -> typing.Dict[str, typing.Any]:
+    """
+    The reference data of `add_reference_data`, committed. Maps each identifier to the object's id.
+    """
+    session = base.Session()
+    ids = {identifier: obj.id for identifier, obj in add_reference_data(session).items()}
+    session.commit()
+    session.close()
+    return ids
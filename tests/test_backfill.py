@@ -0,0 +1,107 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import os
+
+import pytest
+
+from conftest import ASSESSMENT_FORM_ID, assessment_submission, serve_assessments
+from rtb_model import backfill, base
+from rtb_model.catalog import invalidate_catalog
+from rtb_model.company import Company
+from rtb_model.formstacksubmission import FormstackSubmission
+
+
+@pytest.fixture
+def file_database(tmp_path):
+    """
+    An empty SQLite database in a file, holding every table, so that the backfill's worker processes share it.
+    """
+    base.configure(url=f'sqlite:///{tmp_path / "backfill.db"}')
+    base.create_all()
+    invalidate_catalog()
+    try:
+        yield base.get_engine()
+    finally:
+        base.configure()
+        invalidate_catalog()
+
+
+@pytest.fixture
+def submissions(formstack, file_database):
+    """
+    25 submissions to the assessment form, served by the stub Formstack. Changes to them are served from then on.
+    """
+    submissions = {i: assessment_submission(i, timestamp=f'2020-01-{i:02} 09:00:00') for i in range(1, 26)}
+    serve_assessments(formstack, submissions)
+    return submissions
+
+
+def _fail_submission_7(helper) -> list:
+    # Answers of a submission that cannot be written; module level, so that workers can unpickle it
+    if helper.submission_id == 7:
+        raise ValueError('Bad answers')
+    return list()
+
+
+def _die_once_at_submission_15(helper) -> list:
+    # Kills the worker (and so its pool) the first time it writes submission 15
+    marker = os.environ['BACKFILL_TEST_MARKER']
+    if helper.submission_id == 15 and not os.path.exists(marker):
+        open(marker, 'w').close()
+        os._exit(1)
+    return list()
+
+
+def test_backfill_shards_submissions_across_workers(formstack, submissions):
+    result = backfill.backfill(ASSESSMENT_FORM_ID, workers=2, shard_size=10)
+
+    assert (result.new, result.updated, result.skipped, result.failed, result.shards) == (25, 0, 0, [], 3)
+    assert (result.retries, result.failed_shards) == (0, dict())
+    # The parent pages through the submissions with one request per shard
+    assert formstack.count('GET', f'/form/{ASSESSMENT_FORM_ID}/submission') == 3
+    session = base.Session()
+    assert session.query(FormstackSubmission).count() == session.query(Company).count() == 25
+    session.close()
+
+
+def test_backfill_resumes_with_changed_submissions_only(formstack, submissions):
+    backfill.backfill(ASSESSMENT_FORM_ID, workers=2, shard_size=10)
+
+    # Unchanged submissions are skipped; an edit keeps its timestamp, but its data is written again
+    submissions[3] = assessment_submission(3, timestamp='2020-01-03 09:00:00', field_87125333='CFO')
+    result = backfill.backfill(ASSESSMENT_FORM_ID, workers=2, shard_size=10)
+    assert (result.new, result.updated, result.skipped) == (0, 1, 24)
+
+    submissions[26] = assessment_submission(26, timestamp='2020-01-26 09:00:00')
+    result = backfill.backfill(ASSESSMENT_FORM_ID, workers=2, shard_size=10)
+    assert (result.new, result.updated, result.skipped) == (1, 0, 25)
+
+    result = backfill.backfill(ASSESSMENT_FORM_ID, workers=2, shard_size=10, force=True)
+    assert (result.new, result.updated, result.skipped) == (0, 26, 0)
+
+
+def test_backfill_reports_failed_submissions(submissions):
+    result = backfill.backfill(ASSESSMENT_FORM_ID, workers=2, shard_size=10, answers=_fail_submission_7)
+
+    assert (result.new, result.failed, result.failed_shards) == (24, [7], dict())
+    session = base.Session()
+    assert 7 not in {submission_id for submission_id, in session.query(FormstackSubmission.id)}
+    session.close()
+
+    # A failed submission is not recorded as ingested, so it is written once it can be
+    result = backfill.backfill(ASSESSMENT_FORM_ID, workers=2, shard_size=10)
+    assert (result.new, result.skipped, result.failed) == (1, 24, [])
+
+
+def test_backfill_recovers_from_a_dead_worker(submissions, tmp_path, monkeypatch):
+    monkeypatch.setenv('BACKFILL_TEST_MARKER', str(tmp_path / 'died'))
+    result = backfill.backfill(ASSESSMENT_FORM_ID, workers=2, shard_size=5, answers=_die_once_at_submission_15,
+                               start_method='fork')
+
+    # The dead worker's shard is retried, and the shards the broken pool had not started are resubmitted
+    assert os.path.exists(tmp_path / 'died')
+    assert (result.new, result.failed, result.failed_shards, result.shards) == (25, [], dict(), 5)
+    assert 1 <= result.retries <= 2
+    session = base.Session()
+    assert session.query(FormstackSubmission).count() == 25
+    session.close()
@@ -0,0 +1,170 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import json
+import os
+import signal
+import threading
+
+import pytest
+from sqlalchemy import event, text
+
+from rtb_model import base
+from rtb_model.catalog import invalidate_catalog
+from rtb_model.company import Company
+from rtb_model.criterion import Criterion
+from rtb_model.measure import Measure
+
+fork_only = pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason='needs os.fork')
+
+
+@pytest.fixture
+def file_database(tmp_path, monkeypatch):
+    """
+    An SQLite database in a file, holding every table, so that a forked process can use it too.
+    """
+    monkeypatch.setattr(base, '_inherited_engines', list())
+    base.configure(url=f'sqlite:///{tmp_path / "base.db"}')
+    base.create_all()
+    invalidate_catalog()
+    try:
+        yield base.get_engine()
+    finally:
+        base.configure()
+        invalidate_catalog()
+
+
+def _in_child(check) -> dict:
+    """
+    Runs `check` in a forked child process, which is killed if it takes over 10 seconds.
+    :return: the JSON-serialisable result of `check`.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read)
+            signal.alarm(10)
+            with os.fdopen(write, 'w') as file:
+                json.dump(check(), file)
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write)
+    with os.fdopen(read) as file:
+        output = file.read()
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0, f'Child failed with status {status}'
+    return json.loads(output)
+
+
+@fork_only
+def test_forked_process_builds_its_own_engine(file_database):
+    parent_engine = file_database
+    # A connection checked out of the parent's pool, which the child must leave alone
+    connection = parent_engine.connect()
+    # The child is forked while another thread holds the engine lock
+    locked, release = threading.Event(), threading.Event()
+
+    def hold_lock():
+        with base._engine_lock:
+            locked.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    locked.wait()
+
+    def check() -> dict:
+        engine = base.get_engine()
+        session = base.Session()
+        session.add(Company(company_name='Child'))
+        session.commit()
+        session.close()
+        return dict(new_engine=engine is not parent_engine, inherited=parent_engine in base._inherited_engines,
+                    bound=base.Session().get_bind() is engine)
+
+    try:
+        assert _in_child(check) == dict(new_engine=True, inherited=True, bound=True)
+    finally:
+        release.set()
+        holder.join()
+
+    # The parent's engine and pooled connection still work
+    assert base.get_engine() is parent_engine
+    assert connection.execute(text('SELECT company_name FROM company')).scalar() == 'Child'
+    connection.close()
+
+
+def test_engine_is_rebuilt_in_a_new_process(file_database, monkeypatch):
+    # As if forked without `os.register_at_fork` (or by other means): the engine's process id no longer matches
+    built = list()
+    base.on_engine_created(built.append)
+    assert built == [file_database]
+    monkeypatch.setattr(base, '_engine_pid', -1)
+
+    engine = base.get_engine()
+    assert engine is not file_database and built == [file_database, engine]
+    # The old engine is set aside, not disposed of, as its connections belong to the other process
+    assert base._inherited_engines[0] is file_database
+    base._engine_listeners.remove(built.append)
+
+
+def test_reset_after_fork(file_database):
+    lock = base._engine_lock
+    base._reset_after_fork()
+    assert base._engine_lock is not lock
+    assert (base._engine, base._engine_pid, base._replicas) == (None, None, None)
+    assert base.get_engine() is not file_database
+
+
+@pytest.fixture
+def measure_id(reference):
+    return reference['C1.R2.M1']
+
+
+def _count_queries(engine) -> list:
+    queries = list()
+    event.listen(engine, 'before_cursor_execute', lambda *args: queries.append(args[2]))
+    return queries
+
+
+def test_safe_repr_does_not_load_attributes(database, measure_id):
+    queries = _count_queries(database)
+    session = base.Session()
+    measure = session.get(Measure, measure_id)
+    queries.clear()
+
+    with base.safe_repr():
+        assert repr(measure) == f'C{base.UNLOADED}.R{base.UNLOADED}.M1: Measure 1.2.1'
+        assert queries == []
+        # Lazy loads are allowed again within `safe_repr(False)`
+        with base.safe_repr(False):
+            assert repr(measure) == 'C1.R2.M1: Measure 1.2.1'
+        assert queries
+
+    # Detached objects do not fail, and show what was loaded
+    session.close()
+    with base.safe_repr():
+        assert repr(measure) == 'C1.R2.M1: Measure 1.2.1'
+    # Expired attributes of a detached object cannot be loaded at all
+    session = base.Session()
+    measure = session.get(Measure, measure_id)
+    session.expire(measure)
+    session.expunge(measure)
+    with base.safe_repr():
+        assert repr(measure) == f'C{base.UNLOADED}.R{base.UNLOADED}.M{base.UNLOADED}: {base.UNLOADED}'
+    session.close()
+
+
+def test_safe_repr_by_default(database, measure_id, monkeypatch):
+    monkeypatch.setattr(base, '_repr_lazy_loads_default', False)
+    session = base.Session()
+    measure = session.get(Measure, measure_id)
+    assert repr(measure) == f'C{base.UNLOADED}.R{base.UNLOADED}.M1: Measure 1.2.1'
+    with base.safe_repr(False):
+        assert repr(measure) == 'C1.R2.M1: Measure 1.2.1'
+    session.close()
+
+    # New objects have nothing to load
+    assert repr(Measure(number=3, text='New', criterion=Criterion(number=4))) == 'CNone.R4.M3: New'
@@ -0,0 +1,149 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import csv
+import datetime as dt
+import re
+
+import pytest
+
+from rtb_model import base, bulk, rollup
+from rtb_model.answer import Answer
+from rtb_model.company import Company
+from rtb_model.formstacksubmission import FormstackSubmission
+from rtb_model.onelineuser import OnlineUser
+from rtb_model.quickstartanswer import QuickstartAnswer, QuickstartLikertAnswer
+from rtb_model.quickstartuser import QuickstartUser
+
+
+@pytest.fixture
+def users(reference):
+    """
+    Online users 'ada@example.com' and 'alan@example.com', quickstart user 'grace@example.com' and Formstack
+    submissions 1 and 2. Maps each email to the user's id.
+    """
+    session = base.Session()
+    company = Company(company_name='Company')
+    users = [OnlineUser(email='ada@example.com', company=company),
+             OnlineUser(email='alan@example.com', company=company), QuickstartUser(email='grace@example.com')]
+    timestamp = dt.datetime(2020, 1, 1)
+    session.add_all(users + [FormstackSubmission(id=i, date_submit=timestamp, date_last_update=timestamp)
+                             for i in (1, 2)])
+    session.commit()
+    ids = {user.email: user.id for user in users}
+    session.close()
+    return ids
+
+
+def _answers(session) -> list:
+    return sorted((answer.response, answer.measure.identifier, answer.online_user.email, answer.formstack_submission_id)
+                  for answer in session.query(Answer).filter(Answer.online_user_id.isnot(None)))
+
+
+@pytest.mark.parametrize('method', [bulk.BulkMethod.EXECUTEMANY, bulk.BulkMethod.COPY])
+def test_bulk_insert_answers(users, reference, method):
+    rows = [('Yes', 'C1.R1.M1', 'ada@example.com', 1),
+            dict(response='No', measure=reference['C1.R1.M2'], online_user=users['alan@example.com'],
+                 formstack_submission_id='2'),
+            ('Unsure', str(reference['C2.R1.M1']), str(users['ada@example.com']), None),
+            ('Not applicable', reference['C2.R2.M2'].hex, 'alan@example.com', 1),
+            (None, 'C1.R2.M1', None, None)]
+    session = base.Session()
+    # COPY is only used on PostgreSQL; on SQLite it falls back to executemany
+    assert bulk.bulk_insert_answers(session, iter(rows), chunk_size=2, method=method) == 5
+    session.close()
+
+    session = base.Session()
+    assert _answers(session) == [
+        ('No', 'C1.R1.M2', 'alan@example.com', 2), ('Not applicable', 'C2.R2.M2', 'alan@example.com', 1),
+        ('Unsure', 'C2.R1.M1', 'ada@example.com', None), ('Yes', 'C1.R1.M1', 'ada@example.com', 1)]
+    assert session.query(Answer).filter(Answer.response.is_(None), Answer.online_user_id.is_(None)).count() == 1
+    session.close()
+
+
+def test_copy_writes_csv(users, reference, monkeypatch):
+    """
+    The COPY path (PostgreSQL only) writes each chunk as CSV, with NULLs as unquoted empty fields.
+    """
+    copied = list()
+
+    class Cursor:
+        def copy_expert(self, sql, buffer):
+            copied.append((sql, list(csv.reader(buffer))))
+
+        def close(self):
+            pass
+
+    class Connection:
+        class connection:
+            @staticmethod
+            def cursor():
+                return Cursor()
+
+    monkeypatch.setattr(rollup, 'MAINTAIN_ANSWER_COUNTS', False)
+    session = base.Session()
+    writer = bulk.AnswerWriter(session, chunk_size=10, method=bulk.BulkMethod.EXECUTEMANY, commit=False)
+    writer.method = bulk.BulkMethod.COPY
+    session.connection = Connection
+    assert writer.write([('Yes', 'C1.R1.M1', 'ada@example.com', 1), (None, 'C1.R1.M2', None, None)]) == 2
+    session.close()
+
+    [(sql, rows)] = copied
+    assert sql == 'COPY answer (id, response, measure_id, online_user_id, formstack_submission_id) FROM STDIN ' \
+                  'WITH (FORMAT csv)'
+    assert [row[1:] for row in rows] == [['Yes', reference['C1.R1.M1'].hex, users['ada@example.com'].hex, '1'],
+                                         ['', reference['C1.R1.M2'].hex, '', '']]
+    assert all(len(row[0]) == 32 for row in rows)
+
+
+def test_bulk_insert_quickstart_answers(users, reference):
+    user = users['grace@example.com']
+    rows = [(QuickstartLikertAnswer.agree, 'Question 1', 'grace@example.com'),
+            ('strongly_disagree', reference['Q2'], user), (5, str(reference['Q1']), user.hex),
+            dict(answer='3', question='Question 2', quickstart_user=user)]
+    session = base.Session()
+    assert bulk.bulk_insert_quickstart_answers(session, rows, method='executemany') == 4
+    assert sorted((answer.answer.value, answer.question.question_text) for answer in session.query(QuickstartAnswer)) \
+        == [(1, 'Question 2'), (3, 'Question 2'), (4, 'Question 1'), (5, 'Question 1')]
+    session.close()
+
+
+@pytest.mark.parametrize('row, message', [
+    (('Maybe', 'C1.R1.M1', 'ada@example.com', 1), "'Maybe' is not a valid answer response"),
+    (('Yes', 'C3.R1.M1', 'ada@example.com', 1), "No measure 'C3.R1.M1'"),
+    (('Yes', 'C1.R1.M1', 'bob@example.com', 1), 'No OnlineUser with the email(s): bob@example.com'),
+    (('Yes', 'C1.R1.M1', '00000000-0000-4000-8000-000000000000', 1),
+     'No OnlineUser with the id(s): 00000000-0000-4000-8000-000000000000'),
+    (('Yes', 'C1.R1.M1', 'ada@example.com', 3), 'No FormstackSubmission with the id(s): 3'),
+    (('Yes', 'C1.R1.M1', 'ada@example.com', 'first'), "'first' is not a Formstack submission id"),
+])
+def test_bulk_insert_answers_errors(users, row, message):
+    session = base.Session()
+    with pytest.raises(bulk.BulkWriteError, match=f'^{re.escape(message)}$'):
+        # The bad row is in the second chunk; the first is committed
+        bulk.bulk_insert_answers(session, [('Yes', 'C1.R1.M1', 'ada@example.com', 1), row], chunk_size=1)
+    session.rollback()
+    assert session.query(Answer).count() == 1
+    session.close()
+
+
+def test_bulk_insert_answers_with_a_shared_email(users):
+    session = base.Session()
+    session.add(OnlineUser(email='ada@example.com', company=Company(company_name='Other company')))
+    session.commit()
+    with pytest.raises(bulk.BulkWriteError, match='More than one OnlineUser has the email ada@example.com'):
+        bulk.bulk_insert_answers(session, [('Yes', 'C1.R1.M1', 'ada@example.com', 1)])
+    session.close()
+
+
+@pytest.mark.parametrize('row, message', [
+    (('often', 'Question 1', 'grace@example.com'), "'often' is not a valid quickstart answer"),
+    ((6, 'Question 1', 'grace@example.com'), '6 is not a valid quickstart answer'),
+    ((1, 'Question 3', 'grace@example.com'), "No quickstart question 'Question 3'"),
+    ((1, 'Question 1', 'ada@example.com'), 'No QuickstartUser with the email'),
+    ((1, 'Question 1', '00000000-0000-4000-8000-000000000000'), 'No QuickstartUser with the id'),
+])
+def test_bulk_insert_quickstart_answers_errors(users, row, message):
+    session = base.Session()
+    with pytest.raises(bulk.BulkWriteError, match=message):
+        bulk.bulk_insert_quickstart_answers(session, [row])
+    session.close()
@@ -0,0 +1,97 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import contextlib
+import typing
+
+from sqlalchemy import event
+
+from rtb_model import base
+from rtb_model.catalog import ReferenceCatalog, get_catalog, invalidate_catalog
+from rtb_model.component import Component
+from rtb_model.criterion import Criterion
+from rtb_model.measure import Measure
+
+
+@contextlib.contextmanager
+def count_queries() -> typing.Iterator[typing.List[str]]:
+    """
+    Yields a list of the statements run on the configured engine while the context is active.
+    """
+    statements = list()
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(base.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(base.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def test_load(reference):
+    session = base.Session()
+    with count_queries() as statements:
+        catalog = ReferenceCatalog.load(session)
+    session.close()
+
+    # One query for the component/criterion/measure tree and one for the quickstart questions
+    assert len([statement for statement in statements if statement.lstrip().upper().startswith('SELECT')]) == 2
+    assert (len(catalog.components), len(catalog.criteria), len(catalog.measures),
+            len(catalog.quickstart_questions)) == (2, 4, 8, 2)
+    assert {question.question_text for question in catalog.quickstart_questions} == {'Question 1', 'Question 2'}
+
+    # Identifiers are read from the detached objects without querying
+    with count_queries() as statements:
+        assert [measure.identifier for measure in catalog.measures if measure.criterion.component.number == 2] \
+            == ['C2.R1.M1', 'C2.R1.M2', 'C2.R2.M1', 'C2.R2.M2']
+    assert statements == []
+
+
+def test_identifier_round_trip(reference):
+    catalog = get_catalog()
+    for identifier in ('C2', 'C1.R2', 'C2.R1.M2'):
+        obj = catalog[identifier]
+        assert obj.id == reference[identifier]
+        assert obj.identifier == identifier
+        assert catalog.identifier(obj) == catalog.identifier(obj.id) == identifier
+        assert catalog.by_id(obj.id) is obj
+    assert 'C2.R1.M2' in catalog and 'C3.R1.M1' not in catalog
+    assert catalog.get('C3.R1.M1') is None
+
+
+def test_get_catalog_reloads_after_invalidation(reference):
+    catalog = get_catalog()
+    assert get_catalog() is catalog
+
+    session = base.Session()
+    session.add(Measure(number=3, text='Measure 1.1.3', criterion_id=reference['C1.R1']))
+    session.commit()
+    session.close()
+    # The catalog is not reloaded until it is invalidated
+    assert 'C1.R1.M3' not in get_catalog()
+
+    version = invalidate_catalog()
+    reloaded = get_catalog()
+    assert reloaded is not catalog and reloaded.version == version
+    assert reloaded['C1.R1.M3'].identifier == 'C1.R1.M3'
+    assert len(reloaded.measures) == 9
+
+
+def test_identifiers_of_loaded_objects_use_the_catalog(reference):
+    get_catalog()
+    session = base.Session()
+    measures = session.query(Measure).order_by(Measure.text).all()
+    criteria = session.query(Criterion).order_by(Criterion.name).all()
+    with count_queries() as statements:
+        assert [measure.identifier for measure in measures][:3] == ['C1.R1.M1', 'C1.R1.M2', 'C1.R2.M1']
+        assert [criterion.identifier for criterion in criteria] == ['C1.R1', 'C1.R2', 'C2.R1', 'C2.R2']
+    assert statements == []
+
+    # Objects added since the catalog was loaded are identified from their relationships
+    component = session.query(Component).filter_by(number=2).one()
+    criterion = Criterion(number=3, name='Criterion 2.3', short_name='2.3', component=component)
+    session.add(Measure(number=1, text='Measure 2.3.1', criterion=criterion))
+    session.commit()
+    assert session.query(Measure).filter_by(text='Measure 2.3.1').one().identifier == 'C2.R3.M1'
+    session.close()
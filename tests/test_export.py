@@ -0,0 +1,119 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import csv
+import datetime as dt
+import io
+
+import pytest
+
+from rtb_model import base, export
+from rtb_model.answer import Answer
+from rtb_model.company import Company
+from rtb_model.formstacksubmission import FormstackSubmission
+from rtb_model.onelineuser import OnlineUser
+
+
+@pytest.fixture
+def answers(reference):
+    """
+    Company 'One' (submitted 1 January 2020), whose user 'ada' answered three measures in submission 1 (2 January),
+    and company 'Two' (submitted 1 February), whose user 'alan' answered one measure without a submission. Maps each
+    company's name to its id.
+    """
+    session = base.Session()
+    one = Company(company_name='One', abn=111, date_submit=dt.datetime(2020, 1, 1), operate_australia=True)
+    two = Company(company_name='Two', date_submit=dt.datetime(2020, 2, 1))
+    ada = OnlineUser(first_name='Ada', email='ada@example.com', company=one)
+    alan = OnlineUser(first_name='Alan', email='alan@example.com', company=two)
+    timestamp = dt.datetime(2020, 1, 2)
+    session.add(FormstackSubmission(id=1, date_submit=timestamp, date_last_update=timestamp))
+    session.add_all([Answer(response=response, measure_id=reference[measure], online_user=ada,
+                            formstack_submission_id=1)
+                     for response, measure in [('No', 'C2.R1.M1'), ('Yes', 'C1.R1.M1'), (None, 'C1.R2.M2')]])
+    session.add(Answer(response='Unsure', measure_id=reference['C1.R1.M2'], online_user=alan))
+    session.commit()
+    ids = {company.company_name: company.id for company in (one, two)}
+    session.close()
+    return ids
+
+
+def _read_csv(file) -> list:
+    return list(csv.DictReader(file))
+
+
+def test_export_answers_to_csv(answers, tmp_path):
+    path = tmp_path / 'answers.csv'
+    with base.read_only() as session:
+        assert export.export_answers(session, path, chunk_size=2) == 4
+
+    with open(path, newline='') as file:
+        rows = _read_csv(file)
+    assert list(rows[0]) == [column.name for column in export.answer_export_statement().selected_columns]
+    ones = [row for row in rows if row['company_id'] == str(answers['One'])]
+    # Ordered by company, user and measure
+    assert [(row['measure'], row['component'], row['criterion'], row['response']) for row in ones] == [
+        ('C1.R1.M1', 'C1', 'C1.R1', 'Yes'), ('C1.R2.M2', 'C1', 'C1.R2', ''), ('C2.R1.M1', 'C2', 'C2.R1', 'No')]
+    assert {(row['first_name'], row['abn'], row['formstack_submission_id']) for row in ones} == {('Ada', '111', '1')}
+    assert ones[0]['measure_text'] == 'Measure 1.1.1'
+    [two] = [row for row in rows if row['company_id'] == str(answers['Two'])]
+    assert (two['email'], two['measure'], two['response'], two['formstack_submission_id']) \
+        == ('alan@example.com', 'C1.R1.M2', 'Unsure', '')
+    # Answers are dated by their submission, or by their company's submission if they have none
+    assert {row['measure']: row['date_submit'][:10] for row in rows} == {
+        'C1.R1.M1': '2020-01-02', 'C1.R2.M2': '2020-01-02', 'C2.R1.M1': '2020-01-02', 'C1.R1.M2': '2020-02-01'}
+
+
+@pytest.mark.parametrize('filters, expected', [
+    (dict(company_ids=['Two']), ['C1.R1.M2']),
+    (dict(components=['C2']), ['C2.R1.M1']),
+    (dict(components=[1]), ['C1.R1.M1', 'C1.R1.M2', 'C1.R2.M2']),
+    (dict(start=dt.datetime(2020, 1, 2), end=dt.datetime(2020, 1, 3)), ['C1.R1.M1', 'C1.R2.M2', 'C2.R1.M1']),
+    (dict(start=dt.datetime(2020, 1, 3)), ['C1.R1.M2']),
+    (dict(end=dt.datetime(2020, 1, 2)), []),
+])
+def test_export_answers_filters(answers, filters, expected):
+    if 'company_ids' in filters:
+        filters['company_ids'] = [answers[name] for name in filters['company_ids']]
+    file = io.StringIO()
+    session = base.Session()
+    assert export.export_answers(session, file, **filters) == len(expected)
+    session.close()
+    file.seek(0)
+    assert sorted(row['measure'] for row in _read_csv(file)) == expected
+
+
+def test_export_companies(answers, tmp_path):
+    session = base.Session()
+    assert export.export_companies(session, tmp_path / 'companies.csv', start=dt.datetime(2020, 1, 15)) == 1
+    assert export.export_companies(session, tmp_path / 'all.csv', export_format='csv') == 2
+    session.close()
+
+    with open(tmp_path / 'all.csv', newline='') as file:
+        rows = _read_csv(file)
+    assert [(row['company_id'], row['company_name'], row['abn']) for row in rows] \
+        == [(str(answers['One']), 'One', '111'), (str(answers['Two']), 'Two', '')]
+    assert set(rows[0]) == {'company_id'} | {column for column in Company.__table__.columns.keys() if column != 'id'}
+
+
+def test_export_to_parquet(answers, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    session = base.Session()
+    # The format follows the file's name
+    assert export.export_answers(session, tmp_path / 'answers.parquet', chunk_size=3) == 4
+    with open(tmp_path / 'companies', 'wb') as file:
+        assert export.export_companies(session, file, export_format=export.ExportFormat.PARQUET) == 2
+    session.close()
+
+    answers_file = pq.ParquetFile(tmp_path / 'answers.parquet')
+    # Each chunk is a row group
+    assert answers_file.metadata.num_row_groups == 2
+    table = answers_file.read()
+    assert str(table.schema.field('formstack_submission_id').type) == 'int64'
+    assert str(table.schema.field('date_submit').type) == 'timestamp[us]'
+    assert sorted(table.column('measure').to_pylist()) == ['C1.R1.M1', 'C1.R1.M2', 'C1.R2.M2', 'C2.R1.M1']
+    assert sorted(table.column('response').to_pylist(), key=str) == ['No', None, 'Unsure', 'Yes']
+
+    companies = pq.read_table(tmp_path / 'companies')
+    assert companies.column('company_name').to_pylist() == ['One', 'Two']
+    assert companies.column('operate_australia').to_pylist() == [True, None]
+    assert str(companies.schema.field('abn').type) == 'int64'
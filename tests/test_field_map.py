@@ -0,0 +1,73 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import json
+
+import pytest
+
+from conftest import ASSESSMENT_FORM, ASSESSMENT_FORM_ID, assessment_submission
+from rtb_model import import_check
+from rtb_model.company import Company
+from rtb_model.field_map import FieldMap, FieldMapError
+from rtb_model.formstack_utilities import FormstackForm, FormstackSubmissionHelper
+from rtb_model.quickstartuser import QuickstartUser
+
+
+def test_compile_checks_required_fields():
+    form = FormstackForm(ASSESSMENT_FORM_ID, dict(ASSESSMENT_FORM, fields=ASSESSMENT_FORM['fields'] + [
+        {'id': '1', 'label': 'Section', 'description': '', 'type': 'section'}]))
+    field_map = FieldMap(fields={'company_name': 87125019, 'heading': 1, 'comment': 2}, optional=['comment'],
+                         repeated={'email': [87125332, 87125337, 3]})
+    # Sections are not fields; optional fields may be missing
+    with pytest.raises(FieldMapError, match=r'^Form 1 has no field\(s\) for: heading \(#1\), email\[3\] \(#3\)$'):
+        field_map.compile(form)
+    assert FieldMap(fields={'company_name': 87125019, 'comment': 2}, optional=['comment']).compile(form).form is form
+
+
+def test_company_from_formstack():
+    form = FormstackForm(ASSESSMENT_FORM_ID, ASSESSMENT_FORM)
+    company = Company.from_formstack(FormstackSubmissionHelper(7, assessment_submission(7), form=form))
+    assert (company.company_name, company.abn, company.abs_group, company.abs_subdivision, company.submission_id) \
+        == ('Company 7', '10000000007', 'B', '06', 7)
+    assert (company.operate_australia, company.operate_new_zealand, company.operate_internationally) \
+        == (True, True, False)
+
+
+def test_reading_a_submission_does_not_import_pandas():
+    # Run in a fresh interpreter, as other tests have already imported pandas
+    statement = f'''import json
+from rtb_model.company import Company
+from rtb_model.formstack_utilities import FormstackForm, FormstackSubmissionHelper
+form = FormstackForm({ASSESSMENT_FORM_ID}, json.loads({json.dumps(ASSESSMENT_FORM)!r}))
+Company.from_formstack(FormstackSubmissionHelper(7, json.loads({json.dumps(assessment_submission(7))!r}), form=form))
+'''
+    _, modules = import_check.time_import(statement)
+    assert 'rtb_model.company' in modules
+    assert 'pandas' not in modules
+
+
+def test_company_subdivision_is_read_from_its_group():
+    form = FormstackForm(ASSESSMENT_FORM_ID, ASSESSMENT_FORM)
+    # Groups R and S are read from the same field, whose answer is only used for the group it starts with
+    submissions = [FormstackSubmissionHelper(i, assessment_submission(i, field_87125022=group, field_87125257=answer),
+                                             form=form)
+                   for i, group, answer in [(1, 'R Arts', 'R90 Creative'), (2, 'S Other', 'S94 Repair'),
+                                            (3, 'S Other', 'R90 Creative')]]
+    assert [Company.from_formstack(submission).abs_subdivision for submission in submissions] == ['90', '94', None]
+    rows = Company.rows_from_formstack(submissions)
+    assert list(rows['abs_group']) == ['R', 'S', 'S']
+    assert list(rows['abs_subdivision']) == ['90', '94', None]
+
+
+def test_quickstart_user_from_formstack():
+    fields = QuickstartUser.formstack_field_map.field_ids()
+    form = FormstackForm(2, {'id': '2', 'fields': [{'id': str(field_id), 'label': name, 'type': 'text'}
+                                                    for field_id, name in fields.items()]})
+    values = {'first_name': 'Grace', 'last_name': 'Hopper', 'email': 'grace@example.com', 'job_title': 'Admiral'}
+    submission = FormstackSubmissionHelper(9, {'id': '9', 'form': '2', 'timestamp': '2020-01-01 09:00:00', 'data': [
+        {'field': str(field_id), 'value': values[name]} for field_id, name in fields.items()]}, form=form)
+
+    # The first name is read from its own field, not the email field
+    user = QuickstartUser.from_formstack(submission)
+    assert (user.first_name, user.last_name, user.email, user.job_title) == \
+        ('Grace', 'Hopper', 'grace@example.com', 'Admiral')
+    assert QuickstartUser.rows_from_formstack([submission]).to_dict('records') == [dict(submission_id=9, **values)]
@@ -0,0 +1,134 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import asyncio
+import os
+import time
+
+import pytest
+
+from conftest import StubFormstack
+from rtb_model import formstack_replay, formstack_transport
+from rtb_model.formstack_async import AsyncFormstackUtility, fetch_submissions
+from rtb_model.formstack_transport import FormstackAuthError, FormstackNotFoundError, FormstackRateLimitError, \
+    FormstackServerError
+
+FORM = {'id': '1', 'name': 'Assessment', 'fields': [{'id': '10', 'label': 'Company name', 'type': 'text'}]}
+
+
+def _submission(submission_id: int) -> dict:
+    return {'id': str(submission_id), 'form': '1', 'timestamp': '2020-01-01 00:00:00',
+            'data': [{'field': '10', 'value': f'Company {submission_id}'}]}
+
+
+def _serve_submissions(formstack, ids, delay: float = 0.0) -> None:
+    formstack.routes[('GET', '/form/1')] = lambda query, body: FORM
+    for submission_id in ids:
+        def route(query, body, submission_id=submission_id):
+            time.sleep(delay)
+            return _submission(submission_id)
+        formstack.routes[('GET', f'/submission/{submission_id}')] = route
+
+
+def _failing(statuses, then):
+    """
+    :return: a route answering with each of `statuses` in turn, then with `then`.
+    """
+    statuses = list(statuses)
+
+    def route(query, body):
+        if statuses:
+            return statuses.pop(0), {'error': 'Try again'}, {'Retry-After': '0'}
+        return then
+    return route
+
+
+def test_fetch_submissions_in_order_within_concurrency(formstack):
+    ids = list(range(100, 140))
+    _serve_submissions(formstack, ids, delay=0.05)
+
+    helpers = asyncio.run(fetch_submissions(1, ids, concurrency=4, base_url=formstack.url))
+
+    assert [helper.submission_id for helper in helpers] == ids
+    assert all(helper.form is helpers[0].form for helper in helpers)
+    # The form definition is fetched once and shared
+    assert formstack.count('GET', '/form/1') == 1
+    assert 1 < formstack.max_in_flight <= 4
+
+
+def test_retries_rate_limits_and_server_errors(formstack):
+    _serve_submissions(formstack, [1])
+    formstack.routes[('GET', '/submission/2')] = _failing([429, 503, 502], _submission(2))
+
+    helpers = asyncio.run(fetch_submissions(1, [1, 2], base_url=formstack.url))
+
+    assert [helper.submission_id for helper in helpers] == [1, 2]
+    assert formstack.count('GET', '/submission/2') == 4
+
+
+@pytest.mark.parametrize('status, error', [(401, FormstackAuthError), (404, FormstackNotFoundError),
+                                           (429, FormstackRateLimitError), (500, FormstackServerError)])
+def test_errors_are_mapped_once_retries_are_exhausted(formstack, status, error):
+    formstack.routes[('GET', '/submission/3')] = _failing([status] * 10, _submission(3))
+
+    async def fetch():
+        async with AsyncFormstackUtility(base_url=formstack.url, max_retries=2, scheduler=None) as utility:
+            return await utility.get('submission/3')
+
+    with pytest.raises(error) as raised:
+        asyncio.run(fetch())
+    assert raised.value.status_code == status
+    retried = status in (429, 500)
+    assert formstack.count('GET', '/submission/3') == (3 if retried else 1)
+
+
+def test_writes_are_not_retried_on_server_errors(formstack):
+    formstack.routes[('POST', '/form/1/submission')] = _failing([503], {'id': '4'})
+
+    async def submit():
+        async with AsyncFormstackUtility(base_url=formstack.url) as utility:
+            return await utility.post('form/1/submission', {'field_10': 'Company 4'})
+
+    with pytest.raises(FormstackServerError):
+        asyncio.run(submit())
+    assert formstack.count('POST', '/form/1/submission') == 1
+
+
+def test_records_and_replays_through_a_cassette(formstack, tmp_path):
+    ids = [1, 2, 3]
+    _serve_submissions(formstack, ids)
+    with formstack_replay.recording(str(tmp_path)):
+        recorded = asyncio.run(fetch_submissions(1, ids))
+
+    formstack.routes.clear()
+    with formstack_replay.replaying(str(tmp_path)):
+        replayed = asyncio.run(fetch_submissions(1, ids))
+
+    assert [helper.json_data for helper in replayed] == [helper.json_data for helper in recorded]
+    assert [helper.submission_id for helper in replayed] == ids
+    assert formstack.count('GET', '/submission/1') == 1
+
+
+def test_settings_without_the_shared_transport(monkeypatch):
+    # No shared transport, and no FORMSTACK_* settings to build one from
+    previous = formstack_transport.set_transport(None)
+    for name in list(os.environ):
+        if name.startswith('FORMSTACK_'):
+            monkeypatch.delenv(name)
+    monkeypatch.setenv('FORMSTACK_READ_TIMEOUT', '12.5')
+    stub = StubFormstack()
+    try:
+        _serve_submissions(stub, [1])
+
+        async def fetch():
+            async with AsyncFormstackUtility(base_url=stub.url, access_token='token', max_retries=1) as utility:
+                return utility, await utility.get('submission/1')
+
+        utility, submission = asyncio.run(fetch())
+        assert submission == _submission(1)
+        # Each setting not given has the default the shared transport would have
+        assert (utility.connect_timeout, utility.read_timeout, utility.max_retries, utility.backoff_factor,
+                utility.max_backoff, utility.scheduler) == (5.0, 12.5, 1, 0.5, 60.0, None)
+        assert formstack_transport.set_transport(None) is None
+    finally:
+        formstack_transport.set_transport(previous)
+        stub.close()
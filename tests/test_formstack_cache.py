@@ -0,0 +1,75 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import threading
+import time
+
+from rtb_model.formstack_cache import FormCache
+
+
+class Form:
+    def __init__(self, form_id, json_data: dict = None):
+        self.form_id = form_id
+        self.json_data = json_data if json_data is not None else {'id': str(form_id), 'fields': list()}
+
+
+class Factory:
+    """
+    Builds `Form`s, slowly if fetching, counting the fetches of each form.
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.fetches = dict()
+        self._lock = threading.Lock()
+
+    def __call__(self, form_id, json_data: dict = None):
+        if json_data is None:
+            with self._lock:
+                self.fetches[form_id] = self.fetches.get(form_id, 0) + 1
+            time.sleep(self.delay)
+        return Form(form_id, json_data)
+
+
+def test_concurrent_gets_share_one_fetch():
+    factory = Factory(delay=0.05)
+    cache = FormCache(factory)
+    forms = list()
+    threads = [threading.Thread(target=lambda form_id=form_id: forms.append(cache.get(form_id)))
+               for form_id in [1, 2] * 10]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert factory.fetches == {1: 1, 2: 1}
+    assert len({id(form) for form in forms}) == 2
+    assert (cache.hits, cache.misses) == (18, 2)
+    # Load locks are only kept while a form is loading
+    assert cache._load_locks == dict()
+
+
+def test_expiry_eviction_and_persistence(tmp_path):
+    factory = Factory()
+    cache = FormCache(factory, max_size=2, ttl=60, persist_dir=str(tmp_path))
+    first = cache.get(1)
+    cache.get(2)
+    cache.get(1)
+    cache.get(3)
+    # Form 2 was the least recently used
+    assert cache.peek(2) is None and cache.peek(1) is first
+    assert factory.fetches == {1: 1, 2: 1, 3: 1}
+
+    # Another process reuses the persisted definitions rather than fetching them
+    other = FormCache(factory, persist_dir=str(tmp_path))
+    assert other.get(2).json_data == {'id': '2', 'fields': []}
+    assert factory.fetches == {1: 1, 2: 1, 3: 1}
+
+    cache.invalidate(2)
+    # Invalidating a form that is no longer persisted is harmless
+    cache.invalidate(2)
+    assert FormCache(factory, persist_dir=str(tmp_path)).get(2) is not None
+    assert factory.fetches == {1: 1, 2: 2, 3: 1}
+
+    cache.configure(ttl=0)
+    time.sleep(0.01)
+    assert cache.peek(1) is None
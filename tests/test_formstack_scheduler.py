@@ -0,0 +1,146 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from rtb_model import formstack_scheduler
+from rtb_model.formstack_scheduler import FormstackQueueTimeoutError, Priority, RateLimitScheduler
+from rtb_model.formstack_transport import FormstackTransport
+
+
+def _send(scheduler: RateLimitScheduler, count: int = 1, **acquire) -> float:
+    """
+    Sends `count` successful requests through the scheduler, one after another.
+    :return: the seconds taken.
+    """
+    start = time.monotonic()
+    for _ in range(count):
+        scheduler.acquire(**acquire)
+        scheduler.release(200)
+    return time.monotonic() - start
+
+
+def test_token_bucket():
+    # 3 tokens, refilled at 10 a second
+    scheduler = RateLimitScheduler(rate_limit=13, period=1.0, burst=3)
+    assert scheduler.rate == 10.0
+    assert _send(scheduler, 3) < 0.05
+    assert 0.05 < _send(scheduler) < 0.3
+
+    # Requests that cannot be sent in time leave the queue
+    with pytest.raises(FormstackQueueTimeoutError, match='could not be sent within 0.01s'):
+        scheduler.acquire(timeout=0.01)
+    assert (scheduler.in_flight, scheduler._waiting) == (0, [])
+
+
+def test_rate_limit_headers():
+    scheduler = RateLimitScheduler(rate_limit=13, period=1.0, burst=3)
+    scheduler.acquire()
+    scheduler.acquire()
+    scheduler.release(200, {'X-RateLimit-Limit': '23', 'X-RateLimit-Remaining': '1'})
+    # The other request in flight has taken the last token the header counts
+    assert (scheduler.rate_limit, scheduler.remaining, scheduler.tokens) == (23, 1, 0.0)
+    scheduler.release(200, {'X-RateLimit-Remaining': 'unknown'})
+    assert scheduler.remaining == 1
+
+    # A 429 empties the bucket and pauses every request for its Retry-After
+    scheduler.tokens = 3.0
+    scheduler.acquire()
+    scheduler.release(429, {'Retry-After': '0.2'})
+    assert scheduler.tokens <= 0.0
+    assert 0.15 < _send(scheduler) < 0.5
+
+
+def test_interactive_requests_go_first():
+    scheduler = RateLimitScheduler(rate_limit=12, period=1.0, burst=2, interactive_reserve=0.0)
+    scheduler.tokens = 0.0
+    sent = list()
+
+    def send(name: str, request_priority: Priority):
+        with formstack_scheduler.priority(request_priority):
+            _send(scheduler)
+        sent.append(name)
+
+    threads = [threading.Thread(target=send, args=('background', Priority.BACKGROUND)),
+               threading.Thread(target=send, args=('interactive', Priority.INTERACTIVE))]
+    for thread in threads:
+        thread.start()
+        # The background request is queued first
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+    assert sent == ['interactive', 'background']
+
+
+def test_background_requests_leave_a_reserve():
+    scheduler = RateLimitScheduler(rate_limit=11, period=1000.0, burst=10, interactive_reserve=0.5)
+    with formstack_scheduler.background():
+        assert formstack_scheduler.current_priority() is Priority.BACKGROUND
+        # Background requests need 1 token beyond the reserve of 5
+        _send(scheduler, 5)
+        with pytest.raises(FormstackQueueTimeoutError):
+            scheduler.acquire(timeout=0.05)
+        # Interactive requests may still take the reserve
+        with formstack_scheduler.priority(Priority.INTERACTIVE):
+            _send(scheduler, 5)
+        assert formstack_scheduler.current_priority() is Priority.BACKGROUND
+    assert formstack_scheduler.current_priority() is Priority.INTERACTIVE
+    assert scheduler.tokens < 1.0
+
+
+def test_adaptive_concurrency():
+    scheduler = RateLimitScheduler(max_concurrency=5, min_concurrency=1, initial_concurrency=4)
+    # Grows by one for every `concurrency` successes
+    _send(scheduler, 4)
+    assert 4.9 < scheduler.concurrency <= 5.0
+    _send(scheduler, 20)
+    assert scheduler.concurrency == 5.0
+
+    # Halves on every throttle, server error or failed connection, down to the minimum
+    concurrency = list()
+    for status in (429, 503, None, 500):
+        scheduler.acquire()
+        scheduler.release(status, {'Retry-After': '0'})
+        concurrency.append(scheduler.concurrency)
+    assert concurrency == [2.5, 1.25, 1.0, 1.0]
+
+    # Requests beyond the concurrency wait for those in flight
+    scheduler.acquire()
+    with pytest.raises(FormstackQueueTimeoutError):
+        scheduler.acquire(timeout=0.1)
+    scheduler.release(200)
+    assert scheduler.in_flight == 0
+
+
+def test_acquire_async():
+    scheduler = RateLimitScheduler(rate_limit=13, period=1.0, burst=3)
+
+    async def send(count: int) -> float:
+        start = time.monotonic()
+        for _ in range(count):
+            await scheduler.acquire_async(Priority.BACKGROUND)
+            scheduler.release(200)
+        return time.monotonic() - start
+
+    # The reserve of the 3-token bucket is 0.6 tokens, so the third background request waits for it
+    assert 0.02 < asyncio.run(send(3)) < 0.3
+    assert (scheduler.in_flight, scheduler._waiting) == (0, [])
+
+
+def test_transport_waits_for_the_scheduler(formstack):
+    scheduler = RateLimitScheduler(rate_limit=103, period=1.0, burst=3, initial_concurrency=4)
+    transport = FormstackTransport(formstack.url, 'token', max_retries=3, backoff_factor=5.0, scheduler=scheduler)
+    responses = [(429, {'error': 'Slow down'}, {'Retry-After': '0.2'}), {'id': '1'}]
+    formstack.routes[('GET', '/form/1')] = lambda query, body: responses.pop(0)
+
+    start = time.monotonic()
+    assert transport.request('GET', 'form/1').json() == {'id': '1'}
+    # Retried after the pause the 429 asked for, not the transport's own backoff
+    assert 0.15 < time.monotonic() - start < 2.0
+    assert formstack.count('GET', '/form/1') == 2
+    # Halved by the 429, then grown by the success
+    assert (scheduler.in_flight, scheduler.concurrency) == (0, 2.5)
+    transport.close()
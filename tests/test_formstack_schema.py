@@ -0,0 +1,136 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import json
+import os
+import time
+
+import pytest
+
+from rtb_model.formstack_schema import FieldChange, plan_schema
+from rtb_model.formstack_utilities import FormstackForm, form_cache
+
+FORM_ID = 5
+FIELDS = [{'id': '1', 'label': 'Company name', 'type': 'text', 'description': '', 'required': '1'},
+          {'id': '2', 'label': 'Size', 'type': 'select', 'description': '', 'required': '0',
+           'options': [{'label': 'Small', 'value': 's'}, {'label': 'Large', 'value': 'l'}]},
+          {'id': '3', 'label': 'Details', 'type': 'section', 'description': ''},
+          {'id': '4', 'label': 'Old question', 'type': 'text', 'description': 'Unused'},
+          {'id': '5', 'label': 'Comments', 'type': 'textarea', 'description': ''}]
+
+
+@pytest.fixture
+def schema_form(formstack):
+    """
+    Form 5 with `FIELDS`, served by the stub Formstack. Fields added or changed are recorded in `formstack.changes`.
+    """
+    fields = [dict(field) for field in FIELDS]
+    formstack.changes = list()
+
+    def add(query, body):
+        # Slow enough that adds sent together would arrive out of order
+        time.sleep(0.01)
+        data = json.loads(body)
+        fields.append({'id': str(100 + len(fields)), 'label': data['label'], 'type': data['field_type'],
+                       'description': data['description'] or ''})
+        formstack.changes.append(('add', data['label']))
+        return {'id': fields[-1]['id']}
+
+    def change(field_id):
+        def route(query, body):
+            formstack.changes.append(('update', field_id, json.loads(body)) if body else ('delete', field_id))
+            return {'success': '1'}
+        return route
+
+    formstack.routes[('GET', f'/form/{FORM_ID}')] = lambda query, body: {'id': str(FORM_ID), 'fields': list(fields)}
+    formstack.routes[('POST', f'/form/{FORM_ID}/field')] = add
+    for field in FIELDS:
+        formstack.routes[('PUT', f'/field/{field["id"]}')] = change(int(field['id']))
+        formstack.routes[('DELETE', f'/field/{field["id"]}')] = change(int(field['id']))
+    return FormstackForm(FORM_ID)
+
+
+DESIRED = [
+    {'label': 'Company name', 'required': True},
+    {'id': 2, 'label': 'Size', 'options': ['Small', 'Medium', 'Large'], 'required': False},
+    {'label': 'Website', 'field_type': 'text'},
+    {'label': 'Employees', 'field_type': 'number', 'description': 'Full time'},
+    {'label': 'Founded', 'field_type': 'date'},
+]
+
+
+def test_plan_schema(schema_form):
+    plan = plan_schema(schema_form, DESIRED)
+
+    # Fields are matched by id or by label, and only the arguments that differ are updated
+    assert [(change.action, change.label, change.field_id, change.arguments) for change in plan.changes] == [
+        (FieldChange.UPDATE, 'Size', 2, {'options': ['Small', 'Medium', 'Large']}),
+        (FieldChange.ADD, 'Website', None, {'label': 'Website', 'field_type': 'text'}),
+        (FieldChange.ADD, 'Employees', None, {'label': 'Employees', 'field_type': 'number',
+                                              'description': 'Full time'}),
+        (FieldChange.ADD, 'Founded', None, {'label': 'Founded', 'field_type': 'date'})]
+    assert plan.changes[0].differences == {'options': (['Small', 'Large'], ['Small', 'Medium', 'Large'])}
+    assert plan.unchanged == 1
+    assert repr(plan) == 'Schema of form #5: 3 to add, 1 to update, 0 to delete, 1 unchanged'
+
+    # Labels are matched ignoring case and surrounding whitespace, and then updated to the desired label
+    [change] = plan_schema(schema_form, [{'label': ' company NAME '}]).changes
+    assert (change.action, change.field_id, change.arguments) == (FieldChange.UPDATE, 1, {'label': ' company NAME '})
+
+
+def test_plan_schema_deletes_unlisted_fields_only_if_asked(schema_form):
+    desired = [{'label': 'Company name'}, {'label': 'Size'}]
+    # Unlisted fields are kept by default
+    assert not plan_schema(schema_form, desired)
+    # Sections are never deleted
+    assert [(change.action, change.field_id) for change in plan_schema(schema_form, desired, delete=True).changes] \
+        == [(FieldChange.DELETE, 4), (FieldChange.DELETE, 5)]
+
+
+@pytest.mark.parametrize('desired, message', [
+    ([{'label': 'Size', 'colour': 'red'}], r"Unknown field arguments \['colour'\] for field 'Size'"),
+    ([{'id': 9, 'label': 'Size'}], 'Form 5 has no field #9'),
+    ([{'field_type': 'text'}], 'Desired fields need an id or a label'),
+    ([{'id': 2}, {'id': '2', 'label': 'Size'}], r"Field #2 \('Size'\) is desired more than once"),
+])
+def test_plan_schema_errors(schema_form, desired, message):
+    with pytest.raises(ValueError, match=message):
+        plan_schema(schema_form, desired)
+
+
+def test_sync_schema(formstack, schema_form, tmp_path, monkeypatch):
+    monkeypatch.setattr(form_cache, 'persist_dir', str(tmp_path))
+    form_cache.put(schema_form)
+
+    plan = schema_form.sync_schema(DESIRED + [{'id': 5, 'description': 'Anything else'}], delete=True, concurrency=4)
+
+    assert not plan.failed
+    # Adds are sent one at a time in their desired order, as Formstack appends each to the end of the form
+    assert [change for change in formstack.changes if change[0] == 'add'] \
+        == [('add', 'Website'), ('add', 'Employees'), ('add', 'Founded')]
+    assert sorted(change[:2] for change in formstack.changes if change[0] != 'add') \
+        == [('delete', 4), ('update', 2), ('update', 5)]
+    assert ('update', 5, {'description': 'Anything else'}) in formstack.changes
+
+    # The form is refreshed once, at the end, and cached (and persisted) rather than dropped from the cache
+    assert formstack.count('GET', f'/form/{FORM_ID}') == 2
+    assert form_cache.peek(FORM_ID) is schema_form
+    assert [field['label'] for field in schema_form.json_data['fields']][-3:] == ['Website', 'Employees', 'Founded']
+    with open(os.path.join(str(tmp_path), f'form_{FORM_ID}.json')) as file:
+        assert json.load(file)['json_data'] == schema_form.json_data
+
+
+def test_sync_schema_continues_past_failed_changes(formstack, schema_form):
+    formstack.routes[('PUT', '/field/2')] = lambda query, body: (400, {'error': 'Invalid options'})
+
+    plan = schema_form.sync_schema(DESIRED)
+
+    assert [(change.action, change.field_id) for change in plan.failed] == [(FieldChange.UPDATE, 2)]
+    assert [change for change in formstack.changes if change[0] == 'add'] \
+        == [('add', 'Website'), ('add', 'Employees'), ('add', 'Founded')]
+
+
+def test_sync_schema_dry_run(formstack, schema_form):
+    plan = schema_form.sync_schema(DESIRED, delete=True, dry_run=True)
+    assert len(plan.changes) == 6
+    assert formstack.changes == []
+    assert formstack.requests == [('GET', f'/form/{FORM_ID}')]
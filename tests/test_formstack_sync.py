@@ -0,0 +1,58 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+from rtb_model import base, rollup
+from rtb_model.formstack_sync import FormstackSync
+from rtb_model.formstacksubmission import FormstackSubmission
+from rtb_model.formstacksyncstate import FormstackSyncState
+from rtb_model.onelineuser import OnlineUser
+
+from conftest import ASSESSMENT_FORM_ID, assessment_submission, serve_assessments
+
+
+def _run(full: bool = False):
+    return FormstackSync(ASSESSMENT_FORM_ID, batch_size=10).run(full=full)
+
+
+def test_sync_ingests_new_submissions_once(formstack, database):
+    submissions = {i: assessment_submission(i, f'2020-01-{i:02d} 09:00:00') for i in range(1, 26)}
+    serve_assessments(formstack, submissions)
+
+    result = _run()
+    assert (result.new, result.updated, result.skipped, result.failed) == (25, 0, 0, [])
+
+    # Only the submissions within the overlap before the watermark are listed again
+    result = _run()
+    assert (result.new, result.updated, result.skipped) == (0, 0, 1)
+    session = base.Session()
+    assert session.query(FormstackSubmission).count() == 25
+    assert session.query(OnlineUser).count() == 50
+    assert str(session.query(FormstackSyncState).get(ASSESSMENT_FORM_ID).watermark) == '2020-01-25 14:00:00'
+    # The answer counts of the companies written were rebuilt with them
+    assert rollup.stale_companies(session) == []
+    session.close()
+
+
+def test_sync_ingests_edits_that_keep_their_timestamp(formstack, database):
+    submissions = {i: assessment_submission(i, f'2020-01-{i:02d} 09:00:00') for i in range(1, 4)}
+    serve_assessments(formstack, submissions)
+    _run()
+
+    # Formstack keeps the timestamp of an edited submission
+    submissions[3] = assessment_submission(3, '2020-01-03 09:00:00', field_87125333='CFO')
+    result = _run()
+    assert (result.new, result.updated, result.skipped) == (0, 1, 0)
+
+    # An edit to a submission made before the watermark's overlap is only listed by a full run
+    submissions[1] = assessment_submission(1, '2020-01-01 09:00:00', field_87125333='COO')
+    assert _run().updated == 0
+    result = _run(full=True)
+    assert (result.new, result.updated, result.skipped) == (0, 1, 2)
+
+    session = base.Session()
+    assert {email: title for email, title in session.query(OnlineUser.email, OnlineUser.job_title)
+            .filter(OnlineUser.email.like('ada%'))} == {'ada1@example.com': 'COO', 'ada2@example.com': 'CEO',
+                                                         'ada3@example.com': 'CFO'}
+    # Updated submissions are dated by their Formstack timestamp, as new ones are
+    assert {submission.id: str(submission.date_last_update) for submission in session.query(FormstackSubmission)} \
+        == {1: '2020-01-01 14:00:00', 2: '2020-01-02 14:00:00', 3: '2020-01-03 14:00:00'}
+    session.close()
@@ -0,0 +1,129 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import json
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import pytest
+
+from rtb_model import base
+from rtb_model.company import Company
+from rtb_model.formstack_webhook import WebhookIngestor, WebhookServer
+from rtb_model.formstacksubmission import FormstackSubmission
+from rtb_model.onelineuser import OnlineUser
+
+from conftest import ASSESSMENT_FORM_ID, assessment_submission
+
+
+def _webhook_payload(i: int) -> dict:
+    # A webhook sends the submission keyed by field id, with sub-fields (e.g. of a name) as a dict
+    payload = {'FormID': str(ASSESSMENT_FORM_ID), 'UniqueID': str(i), 'timestamp': '2020-01-01 09:00:00'}
+    for item in assessment_submission(i)['data']:
+        value = item['value']
+        if ' = ' in value:
+            value = dict(line.split(' = ', 1) for line in value.splitlines())
+        payload[item['field']] = value
+    return payload
+
+
+def _form_encode(payload: dict) -> bytes:
+    fields = list()
+    for key, value in payload.items():
+        if isinstance(value, dict):
+            fields.extend((f'{key}[{sub_key}]', sub_value) for sub_key, sub_value in value.items())
+        else:
+            fields.append((key, value))
+    return urllib.parse.urlencode(fields).encode()
+
+
+def _post(url: str, body: bytes, content_type: str) -> int:
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': content_type}, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def _post_json(url: str, payload: dict) -> int:
+    return _post(url, json.dumps(payload).encode(), 'application/json')
+
+
+def _post_form(url: str, payload: dict) -> int:
+    return _post(url, _form_encode(payload), 'application/x-www-form-urlencoded')
+
+
+@pytest.fixture
+def webhook_server(assessment_form, database):
+    server = WebhookServer(WebhookIngestor(batch_size=10, max_delay=0.05), port=0, handshake_key='secret').start()
+    try:
+        yield server
+    finally:
+        server.stop()
+
+
+def test_webhooks_are_ingested_once(webhook_server):
+    url = webhook_server.url
+    for i in range(1, 4):
+        assert _post_json(url, dict(_webhook_payload(i), HandshakeKey='secret')) == 202
+    for i in range(4, 6):
+        assert _post_form(url, dict(_webhook_payload(i), HandshakeKey='secret')) == 202
+    # A submission in the API's format is taken as it is
+    assert _post_json(url, dict(assessment_submission(6), HandshakeKey='secret')) == 202
+    webhook_server.ingestor.flush()
+
+    # Sent again unchanged, by the webhook and as form data
+    assert _post_json(url, dict(_webhook_payload(1), HandshakeKey='secret')) == 202
+    assert _post_form(url, dict(_webhook_payload(4), HandshakeKey='secret')) == 202
+    # A payload with a key that is not a field of the form
+    assert _post_json(url, {'FormID': str(ASSESSMENT_FORM_ID), 'UniqueID': '7', 'HandshakeKey': 'secret',
+                            'Favourite colour': 'blue'}) == 202
+    webhook_server.ingestor.flush()
+
+    result = webhook_server.ingestor.result
+    assert (result.received, result.ingested, result.skipped, len(result.failed)) == (9, 6, 2, 1)
+    session = base.Session()
+    assert session.query(FormstackSubmission).count() == 6
+    assert session.query(Company).count() == 6
+    assert session.query(OnlineUser).count() == 12
+    assert {name: email for name, email in session.query(OnlineUser.first_name, OnlineUser.email)
+            .filter(OnlineUser.email.in_(('ada4@example.com', 'alan5@example.com')))} == \
+        {'Ada': 'ada4@example.com', 'Alan': 'alan5@example.com'}
+    session.close()
+
+
+def test_webhooks_need_the_handshake_key(webhook_server):
+    assert _post_json(webhook_server.url, _webhook_payload(1)) == 403
+    assert _post_form(webhook_server.url, dict(_webhook_payload(1), HandshakeKey='wrong')) == 403
+    assert _post(webhook_server.url, b'{', 'application/json') == 400
+    webhook_server.ingestor.flush()
+    assert webhook_server.ingestor.result.received == 0
+
+
+def test_server_refuses_other_addresses_without_a_handshake_key(monkeypatch):
+    monkeypatch.delenv('FORMSTACK_WEBHOOK_HANDSHAKE_KEY', raising=False)
+    with pytest.raises(ValueError):
+        WebhookServer(WebhookIngestor(), host='0.0.0.0', port=0)
+
+
+def test_results_of_concurrent_submits_and_failed_commits(assessment_form, database):
+    class FailingCommitSession(base.RoutingSession):
+        def commit(self):
+            raise RuntimeError('Connection lost')
+
+    ingestor = WebhookIngestor(session_factory=lambda: FailingCommitSession(bind=base.get_engine()), batch_size=100,
+                               max_delay=0.05)
+    threads = [threading.Thread(target=lambda i=i: ingestor.submit(_webhook_payload(i))) for i in range(1, 41)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ingestor.start()
+    ingestor.flush()
+    ingestor.stop()
+
+    # Payloads of a batch that could not be committed are counted as failed only
+    result = ingestor.result
+    assert (result.received, result.ingested, result.skipped, len(result.failed), result.batches) == (40, 0, 0, 40, 0)
@@ -0,0 +1,37 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import logging
+
+from sqlalchemy import text
+
+from rtb_model import base, index_check
+from rtb_model.company import Company
+
+
+def test_lookups_use_their_indexes(database):
+    session = base.Session()
+    results = index_check.check_indexes(session)
+    assert set(results) == {name for name, _, _ in index_check.LOOKUPS}
+    assert all(ok for ok, _ in results.values())
+    # Indexes SQLite builds for unique constraints are reported under the constraints' names
+    assert results['company of a submission'] == (True, {'uq_company_submission_id'})
+    assert results['users by email'] == (True, {'uq_onlineuser_email_company_id'})
+
+    plan = index_check.explain(session, session.query(Company).filter(Company.abn == 1))
+    assert index_check.indexes_used(plan) == {'ix_company_abn'}
+    session.close()
+
+
+def test_a_missing_index_is_reported(database, caplog):
+    with database.begin() as connection:
+        connection.execute(text('DROP INDEX ix_answer_measure_id'))
+
+    session = base.Session()
+    results = index_check.check_indexes(session)
+    session.close()
+    assert [name for name, (ok, _) in results.items() if not ok] == ['answers to a measure']
+    assert 'ix_answer_measure_id' not in results['answers to a measure'][1]
+
+    caplog.set_level(logging.INFO)
+    assert index_check.main() == 1
+    assert 'answers to a measure: expected ix_answer_measure_id, but uses' in caplog.text
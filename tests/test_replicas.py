@@ -0,0 +1,114 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from rtb_model import base, replicas
+from rtb_model.catalog import invalidate_catalog
+from rtb_model.company import Company
+from rtb_model.replicas import ReplicaSet
+
+
+@pytest.fixture
+def replicated_database(tmp_path):
+    """
+    A primary SQLite database and two replicas of it, in files. Each holds one company, named after the database, so
+    that reads show where they were sent. Maps each name to its URL.
+    """
+    urls = {name: f'sqlite:///{tmp_path / name}.db' for name in ('primary', 'replica1', 'replica2')}
+    for name, url in urls.items():
+        base.configure(url=url)
+        base.create_all()
+        session = base.Session()
+        session.add(Company(company_name=name))
+        session.commit()
+        session.close()
+    base.configure(url=urls['primary'], replica_urls=[urls['replica1'], urls['replica2']])
+    invalidate_catalog()
+    try:
+        yield urls
+    finally:
+        base.configure()
+        invalidate_catalog()
+
+
+def _read() -> str:
+    with base.read_only() as session:
+        return session.query(Company.company_name).scalar()
+
+
+def test_reads_go_to_replicas_in_turn(replicated_database):
+    assert [_read() for _ in range(4)] == ['replica1', 'replica2', 'replica1', 'replica2']
+
+    # Sessions that are not read-only, and read-only sessions once they have written, use the primary
+    session = base.Session()
+    assert session.query(Company.company_name).scalar() == 'primary'
+    session.close()
+    with base.read_only() as session:
+        session.add(Company(company_name='new'))
+        session.flush()
+        assert session.query(Company.company_name).order_by(Company.company_name).all() == [('new',), ('primary',)]
+
+
+def test_reads_go_to_the_primary_without_a_healthy_replica(replicated_database, tmp_path):
+    base.configure(url=replicated_database['primary'], replica_urls=[f'sqlite:///{tmp_path / "missing" / "r.db"}'])
+    assert [_read() for _ in range(2)] == ['primary', 'primary']
+    assert [replica.healthy for replica in base.get_replicas().check()] == [False]
+
+
+def test_a_disconnected_replica_is_skipped_until_its_next_check(replicated_database, monkeypatch):
+    assert [_read() for _ in range(2)] == ['replica1', 'replica2']
+    replica = base.get_replicas().replicas[0]
+    # Any error on the replica is taken for a lost connection
+    monkeypatch.setattr(replica.engine.dialect, 'is_disconnect', lambda *args: True)
+    with pytest.raises(Exception):
+        with replica.engine.connect() as connection:
+            connection.execute(text('SELECT * FROM missing'))
+    monkeypatch.undo()
+
+    assert not replica.healthy
+    assert [_read() for _ in range(2)] == ['replica2', 'replica2']
+    replica.checked_at = time.monotonic() - base.get_replicas().check_interval
+    assert [_read() for _ in range(2)] == ['replica1', 'replica2']
+
+
+def test_replicas_too_far_behind_are_skipped(monkeypatch):
+    replica_set = ReplicaSet([create_engine('sqlite://')], max_lag=60.0)
+    replica = replica_set.replicas[0]
+    # SQLite has no replication lag; pretend to be a PostgreSQL replica 120 s behind
+    monkeypatch.setattr(replica.engine.dialect, 'name', 'postgresql')
+    monkeypatch.setattr(replicas, '_LAG_QUERY', text('SELECT 120.0'))
+
+    assert replica_set.choose() is None
+    assert (replica.healthy, replica.lag) == (False, 120.0)
+    replica_set.max_lag = 180.0
+    assert replica.check(replica_set.max_lag)
+    # No lag limit
+    assert replica.check(0)
+
+
+def test_concurrent_readers_check_a_replica_once(monkeypatch):
+    replica_set = ReplicaSet([create_engine('sqlite://'), create_engine('sqlite://')])
+    checks = list()
+    for replica in replica_set.replicas:
+        def check(max_lag=None, replica=replica, check=replica.check):
+            checks.append(replica)
+            time.sleep(0.05)
+            return check(max_lag)
+        monkeypatch.setattr(replica, 'check', check)
+
+    chosen = list()
+    threads = [threading.Thread(target=lambda: chosen.append(replica_set.choose())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Readers arriving while a replica is checked skip it (to the primary, if neither has been checked yet)
+    assert sorted(id(replica) for replica in checks) == sorted(id(replica) for replica in replica_set.replicas)
+    assert {engine for engine in chosen} <= {None} | {replica.engine for replica in replica_set.replicas}
+    assert not any(replica.checking for replica in replica_set.replicas)
+    assert [replica_set.choose() for _ in range(2)] == [replica.engine for replica in replica_set.replicas]
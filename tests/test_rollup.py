@@ -0,0 +1,162 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import datetime as dt
+import logging
+import time
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import text
+
+from rtb_model import base, bulk, import_check, rollup
+from rtb_model.answer import Answer
+from rtb_model.company import Company
+from rtb_model.onelineuser import OnlineUser
+
+
+@pytest.fixture
+def users(reference):
+    """
+    'ada' of company 'One' and 'alan' of company 'Two'. Maps each name, and each company's name, to its id.
+    """
+    session = base.Session()
+    users = {'ada': OnlineUser(email='ada@example.com', company=Company(company_name='One')),
+             'alan': OnlineUser(email='alan@example.com', company=Company(company_name='Two'))}
+    session.add_all(users.values())
+    session.commit()
+    ids = {name: user.id for name, user in users.items()}
+    ids.update({user.company.company_name: user.company_id for user in users.values()})
+    session.close()
+    return ids
+
+
+def _counts(session) -> dict:
+    return {(row.company_id, row.criterion, row.response): row.count
+            for row in rollup.answer_counts(session).itertuples()}
+
+
+def _rebuilt_counts(session) -> dict:
+    rollup.rebuild_answer_counts(session, commit=True)
+    return _counts(session)
+
+
+def test_flushed_answers_are_counted(users, reference):
+    session = base.Session()
+    answers = [Answer(response='Yes', measure_id=reference['C1.R1.M1'], online_user_id=users['ada']),
+               Answer(response='Yes', measure_id=reference['C1.R1.M2'], online_user_id=users['ada']),
+               Answer(response='No', measure_id=reference['C2.R1.M1'], online_user_id=users['alan']),
+               # Not counted
+               Answer(response=None, measure_id=reference['C1.R2.M1'], online_user_id=users['ada']),
+               Answer(response='Yes', measure_id=reference['C1.R2.M1'], online_user_id=None)]
+    session.add_all(answers)
+    session.commit()
+    assert _counts(session) == {(users['One'], 'C1.R1', 'Yes'): 2, (users['Two'], 'C2.R1', 'No'): 1}
+
+    answers[0].response = 'No'
+    # Moves the answer to the other company
+    answers[1].online_user_id = users['alan']
+    session.delete(answers[2])
+    answers[3].response = 'Unsure'
+    session.commit()
+    expected = {(users['One'], 'C1.R1', 'No'): 1, (users['Two'], 'C1.R1', 'Yes'): 1,
+                (users['One'], 'C1.R2', 'Unsure'): 1}
+    assert _counts(session) == expected
+
+    # Rolled back changes are not counted
+    session.add(Answer(response='Yes', measure_id=reference['C2.R2.M1'], online_user_id=users['ada']))
+    session.flush()
+    session.rollback()
+    assert _counts(session) == expected == _rebuilt_counts(session)
+    session.close()
+
+
+def test_answers_of_read_only_and_bulk_writes_are_counted(users, reference):
+    # The listeners are registered on every session made by `base.Session`, including read-only ones
+    with base.read_only() as session:
+        session.add(Answer(response='Yes', measure_id=reference['C1.R1.M1'], online_user_id=users['ada']))
+        session.commit()
+
+    session = base.Session()
+    bulk.bulk_insert_answers(session, [('Yes', 'C1.R1.M2', 'ada@example.com', None),
+                                       ('Unsure', 'C2.R2.M2', 'alan@example.com', None)])
+    expected = {(users['One'], 'C1.R1', 'Yes'): 2, (users['Two'], 'C2.R2', 'Unsure'): 1}
+    assert _counts(session) == expected == _rebuilt_counts(session)
+    session.close()
+
+
+def test_stale_companies_are_refreshed(users, reference, caplog):
+    session = base.Session()
+    # Answers written other than through the library are only counted once rebuilt
+    session.execute(Answer.__table__.insert().values(id=uuid4(), response='Yes', measure_id=reference['C1.R1.M1'],
+                                                     online_user_id=users['ada']))
+    session.commit()
+    assert _counts(session) == dict()
+    # Companies are stale until they are first rebuilt
+    assert set(rollup.stale_companies(session)) == {users['One'], users['Two']}
+    assert rollup.stale_companies(session, [users['Two']]) == [users['Two']]
+
+    assert set(rollup.refresh_answer_counts(session, commit=True)) == {users['One'], users['Two']}
+    assert _counts(session) == {(users['One'], 'C1.R1', 'Yes'): 1}
+    assert rollup.stale_companies(session) == []
+    assert rollup.main(['check']) == 0
+
+    # Updating (e.g. re-ingesting) a company makes it stale again
+    time.sleep(0.01)
+    session.get(Company, users['Two']).date_last_update = dt.datetime.utcnow()
+    session.commit()
+    time.sleep(0.01)
+    caplog.set_level(logging.INFO)
+    assert rollup.main(['check']) == 1
+    assert f'Stale: {users["Two"]}' in caplog.text
+    assert rollup.main(['unknown']) == 2
+
+    # A read can refresh the stale companies first, in a session of its own
+    with base.read_only() as reader:
+        rollup.answer_counts(reader, refresh=True)
+    assert rollup.stale_companies(session) == []
+    session.close()
+
+
+def test_progress(users, reference):
+    session = base.Session()
+    session.add_all([Answer(response=response, measure_id=reference[measure], online_user_id=users['ada'])
+                     for response, measure in [('Yes', 'C1.R1.M1'), ('No', 'C1.R2.M2'), ('Yes', 'C2.R1.M1')]])
+    session.commit()
+
+    table = rollup.progress(session)
+    # Each component has four measures, and each company one user
+    assert table.loc[(users['One'], 'C1')].to_dict() == {'answered': 2, 'expected': 4, 'fraction': 0.5}
+    assert table.loc[(users['One'], 'C2')].to_dict() == {'answered': 1, 'expected': 4, 'fraction': 0.25}
+    assert table.loc[(users['Two'], 'C1')].to_dict() == {'answered': 0, 'expected': 4, 'fraction': 0.0}
+    assert list(rollup.progress(session, [users['Two']]).index.get_level_values('company_id').unique()) \
+        == [users['Two']]
+    session.close()
+
+
+def test_counts_are_not_maintained_if_disabled(users, reference, monkeypatch):
+    monkeypatch.setattr(rollup, 'MAINTAIN_ANSWER_COUNTS', False)
+    session = base.Session()
+    session.add(Answer(response='Yes', measure_id=reference['C1.R1.M1'], online_user_id=users['ada']))
+    session.commit()
+    assert _counts(session) == dict()
+    assert rollup.refresh_answer_counts(session) == []
+    session.close()
+
+
+def test_counts_are_not_maintained_without_their_table(users, reference, caplog):
+    with base.get_engine().begin() as connection:
+        connection.execute(text('DROP TABLE answercount'))
+    session = base.Session()
+    for measure in ('C1.R1.M1', 'C1.R1.M2'):
+        session.add(Answer(response='Yes', measure_id=reference[measure], online_user_id=users['ada']))
+        session.commit()
+    assert session.query(Answer).count() == 2
+    assert caplog.text.count('has no answercount table') == 1
+    session.close()
+
+
+def test_answers_do_not_import_the_rollup():
+    # Run in a fresh interpreter, as other tests have already imported it
+    _, modules = import_check.time_import('import rtb_model.answer')
+    assert 'rtb_model.answer' in modules
+    assert 'rtb_model.rollup' not in modules
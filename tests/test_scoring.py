@@ -0,0 +1,110 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import math
+
+import pytest
+
+from rtb_model import base, scoring
+from rtb_model.answer import Answer
+from rtb_model.company import Company
+from rtb_model.onelineuser import OnlineUser
+from rtb_model.quickstartanswer import QuickstartAnswer, QuickstartLikertAnswer
+from rtb_model.quickstartuser import QuickstartUser
+
+
+@pytest.fixture
+def companies(reference):
+    """
+    Companies 'A' (two users), 'B' and 'C' (one user each), by name, with their answers.
+    """
+    session = base.Session()
+    companies = {name: Company(company_name=name) for name in 'ABC'}
+    users = {name: OnlineUser(email=f'{name}@example.com', company=companies[name[0]])
+             for name in ('A1', 'A2', 'B1', 'C1')}
+    session.add_all(list(companies.values()) + list(users.values()))
+    session.flush()
+    for user, measure, response in [
+            ('A1', 'C1.R1.M1', 'Yes'), ('A2', 'C1.R1.M1', 'No'), ('A1', 'C1.R1.M2', 'Yes'),
+            ('A1', 'C1.R2.M1', 'Unsure'), ('A1', 'C1.R2.M2', 'Not applicable'), ('A2', 'C2.R1.M1', 'Yes'),
+            ('B1', 'C1.R1.M1', 'Not applicable'), ('B1', 'C2.R2.M2', 'Yes'),
+            ('C1', 'C1.R1.M1', 'Not applicable'), ('C1', 'C1.R1.M2', None)]:
+        session.add(Answer(online_user=users[user], measure_id=reference[measure], response=response))
+    session.commit()
+    ids = {name: company.id for name, company in companies.items()}
+    session.close()
+    return ids
+
+
+def _scores(table, company_id) -> dict:
+    return {identifier: score for identifier, score in table.loc[company_id].items() if not math.isnan(score)}
+
+
+def test_scores_roll_up_measure_criterion_component(companies):
+    session = base.Session()
+    scores = scoring.score_companies(session)
+    session.close()
+
+    a, b = companies['A'], companies['B']
+    # Companies with no scored answer ('Not applicable', or no response) have no scores
+    assert set(scores.overall.index) == {a, b}
+    assert list(scores.measures.columns) == ['C1.R1.M1', 'C1.R1.M2', 'C1.R2.M1', 'C2.R1.M1', 'C2.R2.M2']
+    assert list(scores.criteria.columns) == ['C1.R1', 'C1.R2', 'C2.R1', 'C2.R2']
+    assert list(scores.components.columns) == ['C1', 'C2']
+
+    # A measure is the mean of the company's answers, and each level above the mean of the level below
+    assert _scores(scores.measures, a) == {'C1.R1.M1': 0.5, 'C1.R1.M2': 1.0, 'C1.R2.M1': 0.0, 'C2.R1.M1': 1.0}
+    assert _scores(scores.criteria, a) == {'C1.R1': 0.75, 'C1.R2': 0.0, 'C2.R1': 1.0}
+    assert _scores(scores.components, a) == {'C1': 0.375, 'C2': 1.0}
+    assert scores.overall[a] == pytest.approx(0.6875)
+
+    # A measure that is not applicable has no score, rather than a score of 0
+    assert _scores(scores.measures, b) == {'C2.R2.M2': 1.0}
+    assert _scores(scores.components, b) == {'C2': 1.0}
+    assert scores.overall[b] == 1.0
+
+
+def test_scores_of_some_companies(companies):
+    session = base.Session()
+    scores = scoring.score_companies(session, [companies['B']])
+    session.close()
+    assert list(scores.overall.index) == [companies['B']]
+    assert list(scores.measures.columns) == ['C2.R2.M2']
+
+
+def test_scores_with_other_response_scores(companies):
+    session = base.Session()
+    scores = scoring.score_companies(session, [companies['A']], response_scores={'Yes': 1.0, 'Unsure': 0.5})
+    session.close()
+    assert _scores(scores.measures, companies['A']) == {'C1.R1.M1': 1.0, 'C1.R1.M2': 1.0, 'C1.R2.M1': 0.5,
+                                                        'C2.R1.M1': 1.0}
+
+
+def test_no_answers(reference):
+    session = base.Session()
+    scores = scoring.score_companies(session)
+    session.close()
+    assert scores.overall.empty and scores.measures.empty
+
+
+def test_quickstart_scores_average_likert_answers_by_component(companies, reference):
+    session = base.Session()
+    users = {email: QuickstartUser(email=email, onlineuser_id=online_user_id)
+             for email, online_user_id in [('A1', session.query(OnlineUser.id).filter_by(email='A1@example.com')
+                                            .scalar()),
+                                           ('B1', session.query(OnlineUser.id).filter_by(email='B1@example.com')
+                                            .scalar()),
+                                           ('nobody', None)]}
+    for user, question, answer in [
+            ('A1', 'Q1', QuickstartLikertAnswer.strongly_agree), ('A1', 'Q1', QuickstartLikertAnswer.agree),
+            ('A1', 'Q2', QuickstartLikertAnswer.disagree), ('B1', 'Q1', QuickstartLikertAnswer.unsure),
+            # Quickstart users without an online user belong to no company
+            ('nobody', 'Q1', QuickstartLikertAnswer.strongly_disagree)]:
+        session.add(QuickstartAnswer(quickstart_user=users[user], question_id=reference[question], answer=answer))
+    session.commit()
+
+    scores = scoring.quickstart_scores(session)
+    session.close()
+    assert list(scores.columns) == ['C1', 'C2']
+    assert _scores(scores, companies['A']) == {'C1': 4.5, 'C2': 2.0}
+    assert _scores(scores, companies['B']) == {'C1': 3.0}
+    assert set(scores.index) == {companies['A'], companies['B']}
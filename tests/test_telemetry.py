@@ -0,0 +1,128 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import pytest
+
+from rtb_model import base, formstack_transport, telemetry
+from rtb_model.company import Company
+from rtb_model.measure import Measure
+
+
+@pytest.fixture
+def recording(monkeypatch):
+    """
+    Records telemetry from empty metrics, finding N+1s from three runs of a statement.
+    """
+    monkeypatch.setattr(telemetry, '_n_plus_one_threshold', 3)
+    telemetry.reset()
+    telemetry.enable()
+    try:
+        yield telemetry.registry
+    finally:
+        telemetry.disable()
+        telemetry.reset()
+
+
+def test_statements_and_sessions_are_recorded(reference, recording, caplog):
+    session = base.Session()
+    session.add(Company(company_name='Company'))
+    session.flush()
+    # One measure at a time, as an unloaded relationship would be
+    for identifier in ('C1.R1.M1', 'C1.R1.M2', 'C1.R2.M1', 'C1.R2.M2'):
+        session.query(Measure).filter(Measure.id == reference[identifier]).one()
+
+    stats = telemetry.session_stats(session)
+    assert (stats.queries, len(stats.n_plus_one)) == (5, 1)
+    assert stats.n_plus_one[0].startswith('SELECT measure.id')
+    assert 'Possible N+1: statement run 3 times with different parameters in one session' in caplog.text
+    session.commit()
+    assert telemetry.session_stats(session) is None
+    session.close()
+
+    database = telemetry.stats()['database']
+    assert database['queries'] == {'INSERT': 1, 'SELECT': 4}
+    # sqlite3 does not report the rows a SELECT returned; statements without a result return none
+    assert (database['rows'], database['rows_unknown']) == ({'INSERT': 0}, {'SELECT': 4})
+    assert database['latency']['SELECT']['count'] == 4
+    assert database['sessions']['queries']['count'] == 1
+    assert database['sessions']['queries']['buckets']['5'] == 1
+    assert list(database['n_plus_one'].values()) == [1]
+
+
+def test_repeated_statements_with_the_same_parameters_are_not_n_plus_one(reference, recording):
+    session = base.Session()
+    for _ in range(5):
+        session.query(Measure).filter(Measure.id == reference['C1.R1.M1']).one()
+    assert telemetry.session_stats(session).n_plus_one == []
+    # Each transaction is counted on its own
+    session.rollback()
+    for identifier in ('C1.R1.M1', 'C1.R1.M2'):
+        session.query(Measure).filter(Measure.id == reference[identifier]).one()
+    assert telemetry.session_stats(session).queries == 2
+    session.close()
+    assert telemetry.stats()['database']['n_plus_one'] == dict()
+
+
+def test_formstack_requests_are_recorded(recording, formstack):
+    formstack.routes[('GET', '/form/1')] = lambda query, body: {'id': '1'}
+    formstack.routes[('GET', '/form/2')] = lambda query, body: {'id': '2'}
+    transport = formstack_transport.get_transport()
+    for endpoint in ('form/1', 'form/2?full=1'):
+        transport.request('GET', endpoint)
+    with pytest.raises(formstack_transport.FormstackNotFoundError):
+        transport.request('GET', 'form/3')
+
+    [(name, form)] = telemetry.stats()['formstack'].items()
+    # Ids in endpoints are replaced, so that every form shares its metrics
+    assert name == 'GET form/{id}'
+    assert form['requests'] == {'200': 2, '404': 1}
+    assert form['bytes'] == len(b'{"id": "1"}') * 2 + len(b'{"error": "Not found"}')
+    assert form['latency']['count'] == 3
+
+
+def test_disabled_telemetry_records_nothing(reference, recording, formstack):
+    telemetry.disable()
+    formstack.routes[('GET', '/form/1')] = lambda query, body: {'id': '1'}
+    formstack_transport.get_transport().request('GET', 'form/1')
+    session = base.Session()
+    session.query(Measure).all()
+    assert telemetry.session_stats(session) is None
+    session.close()
+    stats = telemetry.stats()
+    assert (stats['database']['queries'], stats['formstack']) == (dict(), dict())
+
+
+def test_prometheus_text(reference, recording, formstack):
+    formstack.routes[('GET', '/form/1/submission')] = lambda query, body: {'submissions': []}
+    formstack_transport.get_transport().request('GET', 'form/1/submission')
+    session = base.Session()
+    session.query(Measure).all()
+    session.close()
+
+    lines = telemetry.prometheus_text().splitlines()
+    assert '# TYPE rtb_db_queries_total counter' in lines
+    assert 'rtb_db_queries_total{operation="SELECT"} 1' in lines
+    assert 'rtb_db_query_seconds_count{operation="SELECT"} 1' in lines
+    assert 'rtb_db_session_queries_bucket{le="+Inf"} 1' in lines
+    assert 'rtb_formstack_requests_total{method="GET",endpoint="form/{id}/submission",status="200"} 1' in lines
+    assert all(line.startswith('#') or len(line.rsplit(' ', 1)) == 2 for line in lines)
+
+
+@pytest.mark.parametrize('endpoint, template', [
+    ('form/1234/submission', 'form/{id}/submission'),
+    ('/submission/5?data=1', 'submission/{id}'),
+    ('12/field', '{id}/field'),
+    ('form', 'form'),
+    ('form/v2', 'form/v2'),
+])
+def test_endpoint_template(endpoint, template):
+    assert telemetry.endpoint_template(endpoint) == template
+
+
+def test_histogram():
+    histogram = telemetry.Histogram([1, 5, 10])
+    assert histogram.quantile(0.5) is None
+    for value in (0.5, 1, 3, 7, 20):
+        histogram.observe(value)
+    assert (histogram.quantile(0.4), histogram.quantile(0.6), histogram.quantile(1.0)) == (1, 5, float('inf'))
+    assert histogram.to_dict() == dict(count=5, sum=31.5, p50=5, p95=float('inf'),
+                                       buckets={'1': 2, '5': 3, '10': 4, '+Inf': 5})
@@ -0,0 +1,90 @@
+#  Copyright (c) 2020 Curtis West <curtis@curtiswest.net>. All Rights Reserved
+
+import pytest
+from sqlalchemy import event
+
+from rtb_model import base, upsert
+from rtb_model.company import Company
+from rtb_model.onelineuser import OnlineUser
+
+
+@pytest.fixture(params=['returning', 'requery'])
+def session(request, database, monkeypatch):
+    """
+    A session whose upserts read back their ids with INSERT ... RETURNING (if the database supports it here), or by
+    querying for them afterwards. Its statements are recorded in `session.statements`.
+    """
+    session = base.Session()
+    if request.param == 'returning' and not upsert.returns_rows(session):
+        session.close()
+        pytest.skip('INSERT ... RETURNING is not supported on this database')
+    if request.param == 'requery':
+        monkeypatch.setattr(upsert, 'returns_rows', lambda session: False)
+    session.statements = list()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        session.statements.append(statement)
+
+    event.listen(database, 'before_cursor_execute', record)
+    try:
+        yield session
+    finally:
+        event.remove(database, 'before_cursor_execute', record)
+        session.close()
+
+
+def _companies(session) -> list:
+    return sorted((company.submission_id or 0, company.abn or 0, company.company_name)
+                  for company in session.query(Company))
+
+
+def test_upsert_companies(session):
+    ids = upsert.upsert_companies(session, [dict(submission_id=1, abn=111, company_name='One'),
+                                            Company(submission_id=2, company_name='Two'),
+                                            dict(abn=111, company_name='By hand')], batch_size=2)
+    assert sorted(ids, key=str) == [1, 111, 2]
+    assert _companies(session) == [(0, 111, 'By hand'), (1, 111, 'One'), (2, 0, 'Two')]
+    if upsert.returns_rows(session):
+        assert all('RETURNING' in statement for statement in session.statements if statement.startswith('INSERT'))
+    else:
+        assert not any('RETURNING' in statement for statement in session.statements)
+
+    # Companies are matched on their submission, or on their ABN if they have none; the last of duplicates wins
+    again = upsert.upsert_companies(session, [dict(submission_id=1, company_name='One renamed'),
+                                              dict(submission_id=2, company_name='Two renamed'),
+                                              dict(submission_id=2, company_name='Two renamed again'),
+                                              dict(abn=111, company_name='By hand renamed'),
+                                              dict(submission_id=3, abn=111, company_name='Three')])
+    assert {key: again[key] for key in ids} == ids
+    assert _companies(session) == [(0, 111, 'By hand renamed'), (1, 111, 'One renamed'),
+                                   (2, 0, 'Two renamed again'), (3, 111, 'Three')]
+    assert all(company.date_last_update is not None for company in session.query(Company))
+
+    with pytest.raises(ValueError, match='A company needs a submission_id or an abn to be upserted'):
+        upsert.upsert_companies(session, [dict(company_name='Nameless')])
+
+
+def test_upsert_online_users(session):
+    company_id = upsert.upsert_companies(session, [dict(submission_id=1, company_name='One')])[1]
+    rows = [dict(email='ada@example.com', company_id=company_id, first_name='Ada'),
+            OnlineUser(email='alan@example.com', company_id=company_id),
+            # Matched on the submission of its company
+            dict(email='grace@example.com', submission_id=1),
+            # Cannot be matched, so always inserted
+            dict(email=None, company_id=company_id, first_name='Nobody')]
+    ids = upsert.upsert_online_users(session, rows, batch_size=3)
+    assert len(set(ids)) == 4
+    assert {user.id for user in session.query(OnlineUser)} == set(ids)
+
+    again = upsert.upsert_online_users(session, [dict(email='ada@example.com', company_id=company_id,
+                                                      first_name='Augusta'),
+                                                 dict(email='grace@example.com', submission_id=1)])
+    # Users given only their key are left as they are, but their ids are still returned
+    assert set(again) < set(ids) and len(again) == 2
+    assert sorted((user.email or '', user.first_name or '') for user in session.query(OnlineUser)) == [
+        ('', 'Nobody'), ('ada@example.com', 'Augusta'), ('alan@example.com', ''), ('grace@example.com', '')]
+
+    upsert.upsert_online_users(session, [dict(email=None, company_id=company_id)])
+    assert session.query(OnlineUser).filter(OnlineUser.email.is_(None)).count() == 2
+    with pytest.raises(ValueError, match='No company has the submission id 9'):
+        upsert.upsert_online_users(session, [dict(email='ada@example.com', submission_id=9)])